@@ -0,0 +1 @@
+../../py_sauron/plugins/cfn_common.py
\ No newline at end of file
@@ -1,9 +1,17 @@
 import os.path
-import time
-import copy
+from datetime import datetime, timezone
 
 import boto3
-import yaml
+from botocore.exceptions import ClientError
+
+# cfn_common is shared with py_sauron (it links to py_sauron/plugins/cfn_common.py), so both detect changes alike
+from . import cfn_common
+from .cfn_common import DEFAULT_TIMEOUT, SUCCESS_STATUSES, UNCHANGED_STATUSES, StackWatcher, template_hash, \
+    stack_template_hash, expected_parameters, stack_parameters, is_empty_change_set, wait_for_change_set
+
+
+# Parsed templates, keyed by the SHA-256 of the template body
+parsed_templates = {}
 
 
 def create_client():
@@ -23,6 +31,7 @@ def create_load_stacks(services, swarm):
             cloudformation template is located in the cloudformation directory
     '''
     cloudformation_client = create_client()
+    started = datetime.now(timezone.utc)
     docker_stack_name = next(iter(services))
     cf_stacks = []
     for service in services[docker_stack_name]:
@@ -41,31 +50,35 @@ def create_load_stacks(services, swarm):
             parameter_keys = get_parameters(template_body)
             parameters = create_parameters(
                 parameter_keys, parameter_values)
+            stack_name = service.replace('_', '-')
             try:
-                cloudformation_client.describe_stacks(
-                    StackName=service.replace('_', '-'))
-                stack_exists = True
+                stack = cloudformation_client.describe_stacks(
+                    StackName=stack_name)['Stacks'][0]
             except:
-                stack_exists = False
-            if stack_exists:
+                stack = None
+            if stack is not None:
                 try:
-                    response = cloudformation_client.update_stack(
-                        StackName=service.replace('_', '-'),
-                        TemplateBody=template_body,
-                        Parameters=parameters
-                    )
-                except:
-                    print("There was no updated required for - " + service.replace('_', '-'))
+                    if stack_unchanged(cloudformation_client, stack, template_body, parameters):
+                        print("There was no updated required for - " + stack_name)
+                        continue
+                    updating = update_stack_change_set(cloudformation_client, stack_name, template_body, parameters)
+                except ClientError as e:
+                    # Ex: the stack is in ROLLBACK_COMPLETE or already being updated, carry on with the others
+                    print("Could not update " + stack_name + ": " + str(e))
                     continue
+                if not updating:
+                    continue
+                print("Building " + service + " loadbalancer stack")
+                cf_stacks.append(stack_name)
             else:
                 response = cloudformation_client.create_stack(
-                    StackName=service.replace('_', '-'),
+                    StackName=stack_name,
                     TemplateBody=template_body,
                     Parameters=parameters
                 )
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                print("Building " + service + " loadbalancer stack")
-                cf_stacks.append(service.replace('_', '-'))
+                if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
+                    print("Building " + service + " loadbalancer stack")
+                    cf_stacks.append(stack_name)
 
         else:
             print(stack_cf_template_file +
@@ -73,7 +86,7 @@ def create_load_stacks(services, swarm):
             sys.exit()
 
     print("----------------------------------------------------------------")
-    stack_check_status = stacks_check(cloudformation_client, cf_stacks)
+    stack_check_status = stacks_check(cloudformation_client, cf_stacks, started)
     print("Congrats! All CloudFormation Stacks are built!")
     stack_outputs(cloudformation_client, cf_stacks)
 
@@ -102,8 +115,7 @@ def get_parameters(template_body, use_defaults=True):
     Returns - 
             parameters (list) - a list containing all the parameters of a file
     '''
-    template_body_sanitize = template_body.replace('!', '')
-    template_dict = yaml.load(template_body_sanitize)
+    template_dict = load_template(template_body)
     parameters = []
     for parameter in template_dict['Parameters']:
         if use_defaults:
@@ -114,6 +126,20 @@ def get_parameters(template_body, use_defaults=True):
     return parameters
 
 
+def load_template(template_body):
+    '''Purpose: Parse a cf template, only parsing each distinct template once
+    Dependencies -
+        Parameters -
+            template_body (str) - the contents of the template file as a string
+    Returns -
+            template (dict) - the parsed template, do not modify it
+    '''
+    digest = template_hash(template_body)
+    if digest not in parsed_templates:
+        parsed_templates[digest] = cfn_common.load_template(template_body)
+    return parsed_templates[digest]
+
+
 def create_parameters(keys, values):
     '''Purpose:  Create Parameters list for cf deploy
     Dependencies - 
@@ -133,58 +159,97 @@ def create_parameters(keys, values):
     return parameters
 
 
-def stacks_check(cloudformation_client, stacks):
-    '''Purpose:  Loop through all the stacks and check the status of all the stacks
+def stack_unchanged(cloudformation_client, stack, template_body, parameters):
+    '''Purpose: Check locally if deploying the template to an existing stack would change it, so unchanged
+    stacks can be skipped without an update. The parameters are compared first, since they come with the stack
+    description, and the template is only downloaded if they match
     Dependencies -
-        Parameter   - 
+        Parameters -
             cloudformation_client (obj) - connection client to AWS
-            stacks (list) - list of all the deployed cf stacks
+            stack (dict) - the stack as returned by describe_stacks
+            template_body (str) - the contents of the template file as a string
+            parameters (list) - list of parameter dictionaries, the rest take their template defaults
     Returns -
-        boolean - if all the stacks are complete return true, else return false
+        boolean - True if the stack already has this template and these parameters
     '''
-    stack_queue = copy.deepcopy(stacks)
-    while True:
-        for stack in stacks:
-            if stack in stack_queue:
-                print(stack + ": stack events - ")
-                stack_status = check_stack_status(cloudformation_client, stack)
-            if stack_status and (stack in stack_queue):
-                print(stack + " COMPLETE!")
-                stack_queue.remove(stack)
-            print("\n")
-        if not stack_queue:
-            break
-        print("----------------------------------------------------------------")
-        time.sleep(10)
-
-    if not stack_queue:
-        return True
-    else:
+    if stack['StackStatus'] not in UNCHANGED_STATUSES:
         return False
+    template_parameters = load_template(template_body).get('Parameters') or {}
+    defaults = {key: (settings or {}).get('Default') for key, settings in template_parameters.items()}
+    # NoEcho parameters come back masked, so they never match and are left to the change set
+    if stack_parameters(stack) != expected_parameters(defaults, parameters):
+        return False
+    current_template = cloudformation_client.get_template(
+        StackName=stack['StackId'], TemplateStage='Original')['TemplateBody']
+    return stack_template_hash(current_template) == stack_template_hash(template_body)
 
 
-def check_stack_status(cloudformation_client, stack):
-    '''Purpose:  Get status of a stack and print out the events
+def update_stack_change_set(cloudformation_client, stack_name, template_body, parameters):
+    '''Purpose: Update a stack through a change set, only executing it if it has changes
     Dependencies -
-        Parameter   - 
+        Parameters -
             cloudformation_client (obj) - connection client to AWS
-            stacks (list) - list of all the deployed cf stacks
+            stack_name (str) - name of the stack
+            template_body (str) - the contents of the template file as a string
+            parameters (list) - list of parameter dictionaries
     Returns -
-        boolean - if all the stacks are complete return true, else return false
+        boolean - True if the stack is being updated, False if there was nothing to update or the change set failed
     '''
-    stack_state = cloudformation_client.describe_stacks(StackName=stack)
-    if "COMPLETE" in stack_state['Stacks'][0]['StackStatus']:
-        return True
-    else:
-        response = cloudformation_client.describe_stack_events(StackName=stack)
-        message_queue = []
-        for event in response['StackEvents']:
-            if event['LogicalResourceId'] not in message_queue:
-                if event['LogicalResourceId'] != stack:
-                    print(event['LogicalResourceId'] +
-                          " status: " + event['ResourceStatus'])
-                    message_queue.append(event['LogicalResourceId'])
+    change_set_name = 'deploy-' + datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+    cloudformation_client.create_change_set(
+        StackName=stack_name,
+        ChangeSetName=change_set_name,
+        ChangeSetType='UPDATE',
+        TemplateBody=template_body,
+        Parameters=parameters
+    )
+    status, reason = wait_for_change_set(cloudformation_client, stack_name, change_set_name)
+    if status != 'CREATE_COMPLETE':
+        reason = reason or ("change set still " + status + ", giving up")
+        cloudformation_client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if is_empty_change_set(reason):
+            print("There was no updated required for - " + stack_name)
+        else:
+            print("Could not update " + stack_name + ": " + reason)
         return False
+    cloudformation_client.execute_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+    return True
+
+
+def stacks_check(cloudformation_client, stacks, since=None, timeout=DEFAULT_TIMEOUT):
+    '''Purpose:  Wait for all the stacks to finish, printing the new events of each stack as they happen
+    The stacks are checked quickly at first, then less often while nothing is changing, or straight away when throttled
+    Dependencies -
+        Parameter   -
+            cloudformation_client (obj) - connection client to AWS
+            stacks (list) - list of all the deployed cf stacks
+            since (datetime) - only print events from this time onwards, Ex: when the deploy started
+            timeout (int) - seconds to wait for all the stacks to finish, the same as the boto waiters
+    Returns -
+        boolean - if all the stacks completed successfully return true, else return false
+    '''
+    watcher = StackWatcher(cloudformation_client, on_event=print_stack_event, on_finish=print_stack_finished,
+                           on_throttled=print_throttled, timeout=timeout)
+    for stack in stacks:
+        watcher.track(stack, since)
+    finished = True
+    for tracked in watcher.wait():
+        if not tracked.finished:
+            print(tracked.name + " DID NOT FINISH IN TIME!")
+            finished = False
+    return finished and all(x.status in SUCCESS_STATUSES for x in watcher.stacks)
+
+
+def print_stack_event(stack, event):
+    print(stack + ": " + event['LogicalResourceId'] + " status: " + event['ResourceStatus'])
+
+
+def print_stack_finished(tracked):
+    print(tracked.name + " " + (tracked.status or "DOES NOT EXIST") + "!")
+
+
+def print_throttled():
+    print("Throttled while checking the stacks, slowing down")
 
 
 def stack_outputs(cloudformation_client, cf_stacks):
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import logging
 import argparse
+from base64 import b64decode
 import os
 import sys
 import re
 
-from consul import Consul
+from consul import Consul, ConsulException
+
+# Read the whole prefix when at least this share of its keys are required
+RECURSE_RATIO = 0.25
+# Consul rejects transactions with more than 64 operations
+TXN_MAX_OPS = 64
 
 def get_cli_opts():
     description = 'Build a .env file for Docker Compose'
@@ -98,23 +104,82 @@ def get_from_env(env_items, prefix=''):
     return dict(pairs)
     
 
+def list_consul_keys(conn, prefix):
+    '''
+    List every key under a consul prefix, without their values
+    '''
+    index, listed = conn.kv.get(prefix, recurse=True, keys=True)
+    return listed or []
+
+def read_consul_recursive(conn, prefix, keys):
+    '''
+    Read the whole prefix in one request, and pick out the required keys
+    '''
+    required = set(keys)
+    index, data = conn.kv.get(prefix, recurse=True)
+    found = {}
+    for record in data or []:
+        key = record['Key'][len(prefix):]
+        if key in required:
+            found[key] = record['Value']
+    return found
+
+def read_consul_txn(conn, prefix, keys):
+    '''
+    Read only the required keys, batching TXN_MAX_OPS reads into each transaction
+    A transaction fails if any key in it doesn't exist, so keys should come from list_consul_keys
+    '''
+    found = {}
+    for start in range(0, len(keys), TXN_MAX_OPS):
+        batch = keys[start:start + TXN_MAX_OPS]
+        operations = [{'KV': {'Verb': 'get', 'Key': prefix + x}} for x in batch]
+        try:
+            raw = conn.txn.put(operations)
+        except ConsulException:
+            # A key was deleted since it was listed, fall back to reading this batch one key at a time
+            for key in batch:
+                index, data = conn.kv.get(prefix + key)
+                if data:
+                    found[key] = data['Value']
+            continue
+        for result in raw.get('Results') or []:
+            record = result['KV']
+            value = record.get('Value')
+            found[record['Key'][len(prefix):]] = b64decode(value) if value is not None else None
+    return found
+
 def get_keys_consul(keys, prefix='', **overrides):
+    '''
+    Look up the required keys under a consul prefix.
+    The prefix's keys are listed first. If the required keys are a large enough share of them (RECURSE_RATIO),
+    the whole prefix is read with a single recursive query. Otherwise only the required keys are read,
+    in batched transactions, so a few keys from a huge prefix don't pull down every value under it
+    '''
     conn = Consul(**overrides)
     if len(prefix) > 0:
         prefix = '{}/'.format(prefix.strip('/'))
+    keys = list(keys)
+    listed = set(list_consul_keys(conn, prefix))
+    present = [x for x in keys if prefix + x in listed]
+    if present:
+        if len(present) / len(listed) >= RECURSE_RATIO:
+            logging.info('Reading {} of {} keys under {} recursively'.format(len(present), len(listed), prefix))
+            values = read_consul_recursive(conn, prefix, present)
+        else:
+            logging.info('Reading {} of {} keys under {} in transactions'.format(len(present), len(listed), prefix))
+            values = read_consul_txn(conn, prefix, present)
+    else:
+        values = {}
     items = {}
-    for key in keys:
-        index, data = conn.kv.get(prefix+key)
-        if data:
-            if data['Value'] != None:
-                items[key] = data['Value'].decode()
+    for key, value in values.items():
+        if value != None:
+            items[key] = value.decode()
     missing = [x for x in keys if x not in items]
     if len(missing) > 0:
         raise KeyError('The following items are missing: {}'.format(missing))
     return items
 
 
-
 if __name__ == '__main__':
     args = get_cli_opts()
     items = read_keyfile(args.key)
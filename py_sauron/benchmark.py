@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the py_sauron primitives and plugins
+
+Each benchmark runs against synthetic items in a forked child process, so the peak RSS of one case
+doesn't leak into the next. Plugins are run against the in-process stubs in tests/stubs.py instead of real
+consul or cloudformation endpoints.
+
+Ex: ./benchmark.py --sizes 1000 100000 --save-baseline baseline.json
+    ./benchmark.py --sizes 1000 100000 --baseline baseline.json
+"""
+from argparse import ArgumentParser
+import asyncio
+from functools import partial
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import time
+import tracemalloc
+
+from primitives.item_primitives import Item, item_action, get_by_prefix, dedup_prefix_keys, fill_values
+from primitives.item_primitives import new_prefix, join_prefix, make_valid, operate
+from tests.stubs import CFN_LATENCY, FakeKV, FakeConsul, FakeStreamingConsul, SlowFakeKV, SlowFakeTxn, \
+    FakeAsyncConsul, FakeStack, FakeCfnResource
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+PREFIX_COUNT = 100
+ASYNC_CONCURRENCY = 64
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    Register a benchmark. The function is given the number of items to generate, and returns
+    a function that performs the operation being measured
+    """
+    BENCHMARKS[func.__name__.replace('bench_', '', 1)] = func
+    return func
+
+
+# Synthetic data
+
+def make_items(size, prefix_count=PREFIX_COUNT):
+    return [Item(prefix='dev/app{}'.format(i % prefix_count),
+                 key='KEY_{}'.format(i),
+                 value='value-{}'.format(i)) for i in range(size)]
+
+def make_keyfile_items(size):
+    return [Item(key='KEY_{}'.format(i), value='value-{}'.format(i)) for i in range(size)]
+
+
+# Benchmarks
+
+@benchmark
+def bench_item_action(size):
+    items = make_items(size)
+    actions = [make_valid, partial(new_prefix, prefix='dev/destination'), partial(join_prefix, sep='/')]
+    return lambda: operate(item_action(items, actions))
+
+@benchmark
+def bench_get_by_prefix(size):
+    items = make_items(size)
+    def run():
+        res = get_by_prefix(items, 'dev/app0')
+        return (operate(res.result), operate(res.invalid))
+    return run
+
+@benchmark
+def bench_dedup_prefix_keys(size):
+    items = make_items(size)
+    # Every tenth item is repeated further along the stream
+    items = items + items[::10]
+    return lambda: dedup_prefix_keys(items)
+
+@benchmark
+def bench_fill_values(size):
+    source = make_keyfile_items(size)
+    required = [Item(key=x.key) for x in source[::10]]
+    return lambda: fill_values(required, source)
+
+@benchmark
+def bench_serialize_keyfile(size):
+    from plugins.keyfile import serialize_keyfile
+    items = make_keyfile_items(size)
+    return lambda: serialize_keyfile(items).output
+
+@benchmark
+def bench_serialize_shell(size):
+    from plugins.keyfile import serialize_shell
+    items = make_keyfile_items(size)
+    return lambda: serialize_shell(items).output
+
+@benchmark
+def bench_consul_round_trip(size):
+    from plugins.consul_kv import put_consul, get_consul_by_prefix, is_consul_prefix
+    items = make_items(size)
+    prefixes = sorted(set(x.prefix for x in items))
+    def run():
+        conn = FakeConsul()
+        operate(item_action(items, [is_consul_prefix, partial(put_consul, conn=conn)]))
+        return [operate(get_consul_by_prefix(Item(prefix=x), conn).result) for x in prefixes]
+    return run
+
+def _consul_tree(size):
+    """
+    A consul stub holding a tree of size keys, spread over 1000 directories (200 services with 5 environments each)
+    Key names are repeated in every directory, like the same settings being stored for each service
+    """
+    conn = FakeConsul()
+    for i in range(size):
+        key = 'dev/service{}/env{}/KEY_{}'.format(i % 200, (i // 200) % 5, i // 1000)
+        conn.kv.data[key] = ('value-{}'.format(i).encode(), i)
+    return conn
+
+def _consul_tree_read(size, interning):
+    from plugins.consul_kv import get_consul_by_prefix
+    from primitives.interning import set_interning
+    set_interning(interning)
+    conn = _consul_tree(size)
+    return lambda: operate(get_consul_by_prefix(Item(prefix='dev'), conn).result)
+
+@benchmark
+def bench_consul_tree_interned(size):
+    """
+    Read a consul tree into items with prefix and key interning on (the default)
+    Compare its memory use with consul_tree_not_interned, Ex: --sizes 1000000 -k consul_tree
+    """
+    return _consul_tree_read(size, True)
+
+@benchmark
+def bench_consul_tree_not_interned(size):
+    return _consul_tree_read(size, False)
+
+@benchmark
+def bench_consul_stream_read(size):
+    """
+    Stream a recursive read of the consul tree from a json response, like a real consul client
+    """
+    from plugins.consul_kv import get_consul_by_prefix
+    conn = FakeStreamingConsul()
+    conn.kv.data = _consul_tree(size).kv.data
+    return lambda: operate(get_consul_by_prefix(Item(prefix='dev'), conn).result)
+
+@benchmark
+def bench_consul_bulk_write(size):
+    from plugins.consul_kv import put_consul_many
+    items = make_items(size)
+    return lambda: operate(put_consul_many(items, FakeConsul()))
+
+@benchmark
+def bench_consul_sync_unchanged(size):
+    """
+    Sync items to a consul prefix that already holds all of them, so nothing is written
+    """
+    from plugins.consul_kv import sync_consul
+    items = [x.clone(prefix='dev/app') for x in make_keyfile_items(size)]
+    conn = FakeConsul()
+    _loaded_kv(items, conn.kv)
+    return lambda: operate(sync_consul(items, 'dev/app', conn))
+
+def _loaded_kv(items, kv):
+    for s_item in items:
+        FakeKV.put(kv, join_prefix(s_item, '/').key, s_item.value)
+    return kv
+
+def _slow_consul(items):
+    conn = FakeConsul()
+    conn.kv = _loaded_kv(items, SlowFakeKV())
+    conn.txn = SlowFakeTxn(conn.kv)
+    return conn
+
+@benchmark
+def bench_consul_get_serial(size):
+    """
+    Look up every item, one request at a time, against a consul stub with CONSUL_LATENCY per request
+    Compare with consul_get_async. Every request waits, so keep the sizes small, Ex: --sizes 1000 -k consul_get
+    """
+    from plugins.consul_kv import get_consul
+    items = make_items(size)
+    conn = _slow_consul(items)
+    return lambda: operate(item_action(items, [partial(get_consul, conn=conn)]))
+
+@benchmark
+def bench_consul_get_async(size):
+    from plugins.consul_kv_aio import get_consul
+    from primitives.item_async import async_item_action
+    items = make_items(size)
+    conn = FakeAsyncConsul(_loaded_kv(items, FakeKV()))
+    actions = [partial(get_consul, conn=conn)]
+    return lambda: asyncio.run(async_item_action(items, actions, ASYNC_CONCURRENCY))
+
+@benchmark
+def bench_consul_put_serial(size):
+    from plugins.consul_kv import put_consul
+    items = make_items(size)
+    conn = _slow_consul([])
+    return lambda: operate(item_action(items, [partial(put_consul, conn=conn)]))
+
+@benchmark
+def bench_consul_chunked_get(size):
+    """
+    Read back a rendered config of size lines written with put_consul(chunked=True), against a consul stub
+    with CONSUL_LATENCY per request. Configs over CHUNK_THRESHOLD are stored in chunks that are fetched in parallel
+    """
+    from plugins.consul_kv import put_consul, get_consul
+    s_item = Item(prefix='dev/app', key='CONFIG', value=''.join('KEY_{0}=value-{0}\n'.format(i) for i in range(size)))
+    conn = _slow_consul([])
+    put_consul(s_item, conn, chunked=True)
+    return lambda: operate(get_consul(Item(prefix='dev/app', key='CONFIG'), conn).result)
+
+@benchmark
+def bench_consul_put_async(size):
+    from plugins.consul_kv_aio import put_consul
+    from primitives.item_async import async_item_action
+    items = make_items(size)
+    conn = FakeAsyncConsul(FakeKV())
+    actions = [partial(put_consul, conn=conn)]
+    return lambda: asyncio.run(async_item_action(items, actions, ASYNC_CONCURRENCY))
+
+@benchmark
+def bench_cloudformation_read(size):
+    from plugins.cloudformation import get_cfn_stack
+    outputs = [{'OutputKey': 'Output{}'.format(i), 'OutputValue': 'value-{}'.format(i)} for i in range(size)]
+    parameters = [{'ParameterKey': 'Param{}'.format(i), 'ParameterValue': 'value-{}'.format(i)} for i in range(size)]
+    cfn_resource = FakeCfnResource({'bench-stack': FakeStack('bench-stack', parameters, outputs)})
+    return lambda: operate(get_cfn_stack('bench-stack', cfn_resource).result)
+
+
+def _cfn_stacks(size):
+    stacks = {}
+    for i in range(size):
+        name = 'stack-{}'.format(i)
+        outputs = [{'OutputKey': 'Output{}'.format(x), 'OutputValue': 'value-{}'.format(x)} for x in range(5)]
+        stacks[name] = FakeStack(name, [], outputs)
+    return FakeCfnResource(stacks, CFN_LATENCY)
+
+@benchmark
+def bench_cloudformation_read_stacks(size):
+    """
+    Read the outputs of size stacks with get_cfn_stacks, from a listing of every stack
+    Compare with cloudformation_read_stacks_serial, which describes each stack. Ex: --sizes 100 1000 -k read_stacks
+    """
+    from plugins.cloudformation import get_cfn_stacks
+    cfn_resource = _cfn_stacks(size)
+    names = sorted(cfn_resource.stacks)
+    return lambda: operate(get_cfn_stacks(names, 'Outputs', cfn_resource).result)
+
+@benchmark
+def bench_cloudformation_read_stacks_serial(size):
+    from plugins.cloudformation import get_cfn_stacks
+    cfn_resource = _cfn_stacks(size)
+    names = sorted(cfn_resource.stacks)
+    return lambda: operate(get_cfn_stacks(names, 'Outputs', cfn_resource, threshold=size).result)
+
+
+# Running and reporting
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _measure(name, size, repeat):
+    run = BENCHMARKS[name](size)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    peak_rss = _peak_rss_mb()
+
+    # Memory is measured on a separate run, tracemalloc slows everything down too much to time with it on.
+    # Python doesn't count allocations as they happen, so what is reported is the peak traced memory, and the
+    # blocks allocated during the run that are still held once it returns (by its result, or any caches it filled)
+    tracemalloc.start()
+    kept = run()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    tracemalloc.stop()
+    held_blocks = sum(x.count for x in snapshot.statistics('filename'))
+    del kept, snapshot
+
+    best = min(timings)
+    return {'name': name,
+            'size': size,
+            'seconds': best,
+            'items_per_second': size / best if best else None,
+            'peak_rss_mb': peak_rss,
+            'traced_peak_mb': traced_peak / (1024 * 1024),
+            'held_blocks': held_blocks}
+
+def _measure_in_child(conn, name, size, repeat):
+    try:
+        conn.send(_measure(name, size, repeat))
+    except Exception as e:
+        conn.send({'name': name, 'size': size, 'error': repr(e)})
+    finally:
+        conn.close()
+
+def run_benchmark(name, size, repeat=3):
+    """
+    Run a single benchmark in a forked process and return its measurements
+    """
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure_in_child, args=(child_conn, name, size, repeat))
+    proc.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    proc.join()
+    return result
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline, returning a list of regression messages
+    A benchmark has regressed if its throughput dropped, or its peak memory grew, by more than tolerance
+    """
+    base_lookup = {(x['name'], x['size']): x for x in baseline['results']}
+    regressions = []
+    for res in results:
+        base = base_lookup.get((res['name'], res['size']))
+        if base is None or 'error' in res or 'error' in base:
+            continue
+        if res['items_per_second'] < base['items_per_second'] * (1 - tolerance):
+            regressions.append('{} ({} items): {:.0f} items/s, baseline {:.0f} items/s'.format(
+                res['name'], res['size'], res['items_per_second'], base['items_per_second']))
+        if res['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{} ({} items): peak RSS {:.1f}MB, baseline {:.1f}MB'.format(
+                res['name'], res['size'], res['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+def parse_args():
+    description = 'Benchmark py_sauron primitives and plugins'
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=DEFAULT_SIZES,
+                        help='Numbers of items to benchmark with (Ex: --sizes 1000 5000000)')
+
+    parser.add_argument('-k', '--filter',
+                        default='.*',
+                        help='Only run benchmarks with names matching this regex')
+
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of timed runs for each benchmark, the fastest is reported')
+
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this json file')
+
+    parser.add_argument('--save-baseline',
+                        dest='save_baseline',
+                        help='Write the results to this json file, to be used as a later --baseline')
+
+    parser.add_argument('--baseline',
+                        help='Compare against a baseline file, exits non zero on any regressions')
+
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='Allowed fractional drop in throughput or growth in memory before failing')
+
+    parser.add_argument('--list',
+                        action='store_true',
+                        help='List the available benchmarks')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.list:
+        print('\n'.join(sorted(BENCHMARKS)))
+        return 0
+    names = [x for x in sorted(BENCHMARKS) if re.search(args.filter, x)]
+
+    results = []
+    row = '{:<28} {:>9} {:>14} {:>11} {:>12} {:>14}'
+    print(row.format('benchmark', 'items', 'items/s', 'rss MB', 'traced MB', 'held blocks'))
+    for name in names:
+        for size in args.sizes:
+            res = run_benchmark(name, size, args.repeat)
+            results.append(res)
+            if 'error' in res:
+                print('{:<28} {:>9} {}'.format(name, size, res['error']))
+                continue
+            print(row.format(name, size,
+                             '{:.0f}'.format(res['items_per_second']),
+                             '{:.1f}'.format(res['peak_rss_mb']),
+                             '{:.1f}'.format(res['traced_peak_mb']),
+                             res['held_blocks']))
+
+    report = {'python': sys.version, 'results': results}
+    for destination in (args.output, args.save_baseline):
+        if destination:
+            with open(destination, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\nRegressions compared to {}:'.format(args.baseline))
+            print('\n'.join(regressions))
+            return 1
+        print('\nNo regressions compared to {}'.format(args.baseline))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,15 +2,19 @@
 
 import yaml
 import logging
-from itertools import chain
+from functools import partial
 import os
 
 import argparse
 
 from primitives.item_primitives import Item, item_action, get_by_prefix, new_prefix
-from primitives.item_primitives import operate, fill_values, drop_prefix
-from plugins.cloudformation import get_cfn_stack, create_cfn_stack, get_cfn_template
-from plugins.consul_kv import put_consul, get_consul_by_prefix, is_consul_prefix
+from primitives.item_primitives import resolve_layers, drop_prefix
+from primitives.retry import RetryScheduler, retry_call
+from primitives.instrumentation import INSTRUMENTATION, enable_instrumentation
+from plugins.cloudformation import get_cfn_stack, get_cfn_stacks, create_cfn_stacks, get_cfn_template, DEFAULT_PARALLEL
+from plugins.consul_kv import put_consul_many, get_consul_by_prefix, is_consul_prefix, ConsulSync
+from plugins.environment_vars import lookup_env_many
+from plugins.keyfile import read_keyfile
 
 try:
     debug = os.environ['SAURON_LOGLEVEL']
@@ -73,7 +77,38 @@ def get_cli_opts():
 
     parser.add_argument('--build-stack-name',
                         dest='build_stack_name',
-                        help='The name to use if building a new stack')
+                        nargs='+',
+                        help='The name to use if building a new stack. Given several names, a stack is built for each '
+                             'and its outputs are written under <destination prefix>/<stack name>')
+
+    parser.add_argument('--parallel',
+                        dest='parallel',
+                        type=int,
+                        default=DEFAULT_PARALLEL,
+                        help='Number of stacks to read or build at once')
+
+    parser.add_argument('--instrument',
+                        dest='instrument',
+                        help='If set, time each action and write a json summary to this path at the end of the run')
+
+    parser.add_argument('--env-prefix',
+                        dest='env_prefix',
+                        help='If set, build parameters missing from the source are looked up in environment variables with this prefix')
+
+    parser.add_argument('--keyfile',
+                        dest='keyfile',
+                        type=argparse.FileType('r'),
+                        help='If set, build parameters are taken from this KEY=value file first, ahead of the source')
+
+    parser.add_argument('--sync',
+                        dest='sync',
+                        action='store_true',
+                        help='Read the destination prefix first, and only write the keys that were added or changed')
+
+    parser.add_argument('--delete-orphans',
+                        dest='delete_orphans',
+                        action='store_true',
+                        help='With --sync, delete keys under the destination prefix that are not in the source')
 
     return parser.parse_args()
 
@@ -84,29 +119,39 @@ def handle_stack(s_stack_name, src_prefix):
     (most likely Output) update the prefix to match the stack name, and return our
     final items
     """
-    stack_res = get_cfn_stack(s_stack_name)
+    stack_res = retry_call(get_cfn_stack, s_stack_name)
+    if stack_res.retry:
+        raise stack_res.exception
     if stack_res.result:
         stack_items = get_by_prefix(stack_res.result, src_prefix).result
-        operations = [lambda x: new_prefix(x, s_stack_name)]
+        operations = [partial(new_prefix, prefix=s_stack_name)]
         final = item_action(stack_items, operations)
     else:
         raise KeyError('Stack {} not found'.format(s_stack_name))
     return final
 
 
-def build_stack(build_name, raw_template, source_items=[]):
+def build_stacks(build_names, raw_template, source_layers=[], parallel=DEFAULT_PARALLEL):
     """
     Pull the items from our cloudformation template, and get therequired parameters
-    for our template. Fill in the required items from our source_items list, and build the
-    template. Return the boto Stack object of the new stack
+    for our template. Fill in the required items from our source layers (highest precedence first),
+    falling back to the template defaults, and build a stack from the template for each name,
+    up to parallel of them at once. Return the boto Stack objects of the new stacks, in the same order
     """
 
     all_template_items = get_cfn_template(raw_template).result
     all_template_params = get_by_prefix(all_template_items, 'Parameters').result
     dropped_prefix = map(drop_prefix, all_template_params)
-    filled = fill_values(dropped_prefix, source_items).result
-    raw = create_cfn_stack(build_name, raw_template, filled)
-    return raw
+    filled = list(resolve_layers(dropped_prefix, source_layers).result)
+    for param in filled:
+        logging.debug('Parameter {} filled from {}'.format(param.key, param.extra['layer']))
+    results = create_cfn_stacks([(x, raw_template, filled) for x in build_names], parallel)
+    failed = [x for x in results if x.invalid]
+    for res in failed:
+        logging.error('Failed to build stack {}: {}'.format(res.invalid.key, res.exception))
+    if failed:
+        raise failed[0].exception
+    return [x.result for x in results]
 
 def parse_composefile(template_file):
     return yaml.load(template_file)
@@ -117,17 +162,19 @@ def construct_stack_names(base_name, service):
     logging.debug('Stack Names: {}'.format(stack_name))
     return stack_name
 
-def handle_multi_stacks(stack_names, src_prefix = 'Outputs'):
-    result_items = []
+def handle_multi_stacks(stack_names, src_prefix = 'Outputs', parallel=DEFAULT_PARALLEL):
+    """
+    Get the items matching src_prefix from every stack, prefixed with their stack name
+    All the stacks are looked up together, see get_cfn_stacks
+    """
     stack_names = list(stack_names)
-    logging.debug('Handle Multi Stack Items: {}'.format(list(stack_names)))
-    for stack in stack_names:
-        stack_items = handle_stack(stack, src_prefix)
-        logging.debug('Stack Items handle_multi: {}'.format(stack_items))
-        updated_prefix = map(lambda x: x.clone(prefix=stack), stack_items)
-        result_items.append(updated_prefix)
-    logging.debug('Handle multi_stacks result_items: {}'.format(result_items))
-    return chain.from_iterable(result_items)
+    logging.debug('Handle Multi Stack Items: {}'.format(stack_names))
+    stacks_res = retry_call(get_cfn_stacks, stack_names, section=src_prefix, parallel=parallel)
+    if stacks_res.retry:
+        raise stacks_res.exception
+    if stacks_res.invalid:
+        raise KeyError('Stacks {} not found'.format(', '.join(x.key for x in stacks_res.invalid)))
+    return stacks_res.result
 
 def does_service_have_ports(service_name, service_dict):
     try:
@@ -143,12 +190,18 @@ def get_key(items, key):
 def prefix_to_key(items):
     return map(lambda x: x.clone(key=x.prefix, drop=['prefix']), items)
 
-def do_docker_cfn(dockerfile, base_name):
+def nest_prefix(s_item, prefix):
+    """
+    Move an item beneath prefix, keeping its own prefix, Ex: an Output of stack-a moved to 'dev' ends up in 'dev/stack-a'
+    """
+    return s_item.clone(prefix='{}/{}'.format(prefix, s_item.prefix))
+
+def do_docker_cfn(dockerfile, base_name, parallel=DEFAULT_PARALLEL):
     parsed = parse_composefile(dockerfile)
     has_ports = filter(lambda x: does_service_have_ports(*x), parsed['services'].items())
     service_names = map(lambda x: x[0], has_ports)
     stack_names = map(lambda x: construct_stack_names(base_name, x), service_names)
-    all_stack_items = list(handle_multi_stacks(stack_names))
+    all_stack_items = list(handle_multi_stacks(stack_names, parallel=parallel))
     only_urls = get_key(all_stack_items, 'StackUrl')
     return prefix_to_key(only_urls)
 
@@ -163,15 +216,36 @@ def main():
         raise ValueError('--build-stack-name is required for --build-template')
     if not args.build_template and args.build_stack_name:
         raise ValueError('--build-template is required for --build-stack-name')
-
-    if args.source == 'cfn_stack':
-        stack_name = args.source_name
-        stack_prefix = args.source_prefix
-        base_source_items = handle_stack(stack_name, stack_prefix)
-    elif args.source == 'consul':
-        base_source_items = get_consul_by_prefix(Item(prefix=args.source_prefix)).result
-    elif args.source == 'docker-cfn':
-        base_source_items = do_docker_cfn(args.build_template, args.source_name)
+    if args.keyfile and not args.build_template:
+        raise ValueError('--build-template is required for --keyfile')
+    if args.delete_orphans and not args.sync:
+        raise ValueError('--sync is required for --delete-orphans')
+    multi_build = args.build_stack_name is not None and len(args.build_stack_name) > 1
+    if multi_build and args.sync:
+        raise ValueError('--sync only supports building a single stack')
+    if args.parallel < 1:
+        raise ValueError('--parallel must be at least 1')
+    if args.sync and args.destination_prefix.startswith('/'):
+        # Every item would be rejected by is_consul_prefix, and the sync would see an empty source
+        raise ValueError('--destination-prefix {} is not a valid consul prefix'.format(args.destination_prefix))
+
+    if args.instrument:
+        enable_instrumentation()
+
+    with INSTRUMENTATION.timer('source:{}'.format(args.source)):
+        if args.source == 'cfn_stack':
+            stack_name = args.source_name
+            stack_prefix = args.source_prefix
+            base_source_items = handle_stack(stack_name, stack_prefix)
+        elif args.source == 'consul':
+            res = retry_call(get_consul_by_prefix, Item(prefix=args.source_prefix))
+            # The items are streamed, so a read can also fail while they are consumed
+            base_source_items = list(res.result or [])
+            # An empty prefix is an empty source, but a failed read mustn't look like one
+            if res.exception is not None:
+                raise res.exception
+        elif args.source == 'docker-cfn':
+            base_source_items = do_docker_cfn(args.build_template, args.source_name, args.parallel)
 
     if args.build_template and not args.source == 'docker-cfn':
         """
@@ -186,9 +260,14 @@ def main():
             available_source_items = base_source_items
 
         fill_with = map(drop_prefix, available_source_items)
+        source_layers = [('source', fill_with)]
+        if args.keyfile is not None:
+            source_layers.insert(0, ('keyfile', read_keyfile(args.keyfile)))
+        if args.env_prefix is not None:
+            source_layers.append(('environment', partial(lookup_env_many, env_prefix=args.env_prefix)))
         raw_template = args.build_template.read()
-        raw = build_stack(args.build_stack_name, raw_template, fill_with)
-        stack_items = handle_stack(args.build_stack_name, 'Outputs')
+        build_stacks(args.build_stack_name, raw_template, source_layers, args.parallel)
+        stack_items = handle_multi_stacks(args.build_stack_name, 'Outputs', args.parallel)
         source_items = list(stack_items)
     else:
         """
@@ -199,21 +278,46 @@ def main():
 
     logging.info('Source Items: {}'.format(source_items))
     # Update the items with the new prefix if required
-    if args.destination_prefix:
-        dest_prefix = [lambda x: new_prefix(x, args.destination_prefix)]
+    if args.destination_prefix and multi_build:
+        dest_prefix = [partial(nest_prefix, prefix=args.destination_prefix)]
+    elif args.destination_prefix:
+        dest_prefix = [partial(new_prefix, prefix=args.destination_prefix)]
     else:
-        dest_prefix = [lambda x: x]
+        dest_prefix = []
     
     if args.destination == 'consul':
-        dest_actions = [is_consul_prefix,
-                        put_consul]
+        dest_actions = [is_consul_prefix]
+        if args.sync:
+            dest_batch = ConsulSync(args.destination_prefix, delete_orphans=args.delete_orphans)
+        else:
+            dest_batch = put_consul_many
 
     # join the actions to be performed on the prefix, and the actions for the destination
     actions = dest_prefix + dest_actions
 
-    # Perform our accumulated actions our our source_items
-    for operation in operate(item_action(source_items, actions)):
+    # Perform our accumulated actions our our source_items, then write them all out in bulk
+    # Anything that fails with a transient error (Ex: a timeout) is retried after a backoff
+    retry_func = dest_batch.retry if args.sync else None
+    scheduler = RetryScheduler(actions, dest_batch, retry_func)
+    report = scheduler.run(source_items)
+    for operation in report.result:
         logging.debug(operation)
+    for operation in report.invalid:
+        logging.error('Failed: {} {}'.format(operation.invalid, operation.exception or ''))
+    failed = len(report.invalid)
+    if report.retried:
+        logging.info('Retried {} items over {} attempts'.format(report.retried, report.attempts))
+    if args.sync and dest_batch.diff is None:
+        print('Failed to sync {}, {} failed'.format(args.destination_prefix, failed))
+    elif args.sync:
+        counts = dest_batch.diff.counts()
+        print('Synced {}: {} added, {} changed, {} removed{}, {} unchanged, {} failed'.format(
+            args.destination_prefix, counts['added'], counts['changed'], counts['removed'],
+            '' if args.delete_orphans else ' (not deleted)', counts['unchanged'], failed))
+    for stage in scheduler.pipeline.stats():
+        logging.info('Stage {}: {} passed, {} rejected'.format(stage.name, stage.passed, stage.rejected))
+    if args.instrument:
+        INSTRUMENTATION.write_summary(args.instrument)
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+from functools import partial
+
 from plugins.consul_kv import get_consul, put_consul, is_consul_prefix, get_consul_by_prefix
 from primitives.item_primitives import Item, make_valid, item_action, new_prefix
 
@@ -12,7 +14,7 @@ demo_list = [lambda s_item: make_valid(s_item),
              is_consul_prefix,
              put_consul]
 
-copy_to_new_prefix = [lambda x: new_prefix(x, 'Outputs'),
+copy_to_new_prefix = [partial(new_prefix, prefix='Outputs'),
                       put_consul]
 
 for y in item_action(demo_items, demo_list):
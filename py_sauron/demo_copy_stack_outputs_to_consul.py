@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+from functools import partial
+
 from primitives.item_primitives import item_action, get_by_prefix, new_prefix, operate
 from plugins.cloudformation import get_cfn_stack
 from plugins.consul_kv import put_consul, is_consul_prefix
@@ -6,7 +8,7 @@ from plugins.consul_kv import put_consul, is_consul_prefix
 
 stack_name = 'testing-exceptions'
 
-operations = [lambda x: new_prefix(x, stack_name),
+operations = [partial(new_prefix, prefix=stack_name),
               is_consul_prefix,
               put_consul]
 
@@ -0,0 +1,294 @@
+"""
+Cloudformation helpers shared by the py_sauron plugins and the deploy scripts.
+
+deploy/ml_py_deploy/cfn_common.py is a symlink to this file, so both parse and hash templates, decide if a stack
+would change, and poll stacks and change sets the same way. deploy can't import anything else from py_sauron, so keep
+this module to the standard library and yaml. AWS errors are told apart by their error code rather than by importing
+botocore's ClientError.
+
+StackWatcher tracks a set of stacks with operations in flight. Each poll checks the status of every pending stack
+together (a DescribeStacks listing once there are more than a few), and tails only the events each stack has had
+since the last one seen. It polls quickly at first, and backs off while nothing is happening, so short operations
+finish within seconds of completing and long ones don't get throttled.
+"""
+from datetime import datetime, timezone
+import hashlib
+import json
+import time
+
+import yaml
+
+# Seconds between stack polls: the first delay, the most it can grow to, and how much it grows while nothing changes
+MIN_POLL_DELAY = 2
+MAX_POLL_DELAY = 30
+POLL_BACKOFF = 1.5
+# How long to wait for every stack to finish, the same as the boto waiters
+DEFAULT_TIMEOUT = 3600
+# Above this many pending stacks, statuses are read from a listing of every stack rather than one call per stack
+LIST_THRESHOLD = 3
+# Change sets are usually ready within seconds, so they are polled more often than stacks
+MIN_CHANGE_SET_DELAY = 1
+MAX_CHANGE_SET_DELAY = 5
+SUCCESS_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE']
+# Stacks in these statuses are left alone if building them again wouldn't change anything
+UNCHANGED_STATUSES = SUCCESS_STATUSES + ['UPDATE_ROLLBACK_COMPLETE']
+# Error codes cloudformation (and the AWS apis in general) use when a request was rate limited
+THROTTLING_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """
+    A yaml SafeLoader that turns the short form intrinsic function tags into their long form,
+    Ex: !Ref Swarm becomes {'Ref': 'Swarm'}, and !GetAtt Alb.DNSName becomes {'Fn::GetAtt': ['Alb', 'DNSName']}
+    """
+
+def _construct_intrinsic(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix in ('Ref', 'Condition'):
+        return {tag_suffix: value}
+    if tag_suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    return {'Fn::{}'.format(tag_suffix): value}
+
+TemplateLoader.add_multi_constructor('!', _construct_intrinsic)
+
+
+def load_template(template_body):
+    """
+    Parse a yaml (or json) cloudformation template into a dictionary
+    """
+    return yaml.load(template_body, Loader=TemplateLoader)
+
+def template_hash(template_body):
+    if isinstance(template_body, str):
+        template_body = template_body.encode()
+    return hashlib.sha256(template_body).hexdigest()
+
+def stack_template_hash(template_body):
+    """
+    Hash a template so it can be compared with a stack's current template. get_template returns json templates
+    already parsed, so those are hashed in a canonical json form, and yaml templates by their exact body
+    """
+    if isinstance(template_body, (str, bytes)):
+        try:
+            template_body = json.loads(template_body)
+        except ValueError:
+            return template_hash(template_body)
+    return template_hash(json.dumps(template_body, sort_keys=True, separators=(',', ':')))
+
+def parameter_value(value):
+    """
+    Format a parameter's value the way cloudformation reports it, Ex: true as 'true', and lists comma separated
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return ','.join(map(parameter_value, value))
+    return str(value)
+
+def expected_parameters(defaults, build_parameters):
+    """
+    The parameters a stack will have once it is built, from the template's defaults by key
+    and the ParameterKey/ParameterValue dictionaries it is built with
+    """
+    given = {x['ParameterKey']: x['ParameterValue'] for x in build_parameters}
+    return {key: parameter_value(given.get(key, default)) for key, default in defaults.items()}
+
+def stack_parameters(stack):
+    """
+    The current parameters of a stack (as returned by DescribeStacks) by key
+    NoEcho parameters come back masked, so they never match expected_parameters
+    """
+    return {x['ParameterKey']: x.get('ParameterValue') for x in stack.get('Parameters') or []}
+
+
+def error_code(exception):
+    """
+    The error code of a botocore ClientError, Ex: 'ValidationError', or None for anything else
+    """
+    return (getattr(exception, 'response', None) or {}).get('Error', {}).get('Code')
+
+def is_finished(status):
+    """
+    Check if a stack status is final, successful or not. Ex: UPDATE_COMPLETE_CLEANUP_IN_PROGRESS isn't
+    """
+    return status is not None and not status.endswith('_IN_PROGRESS')
+
+def is_empty_change_set(status_reason):
+    """
+    Check if a FAILED change set just had nothing to change
+    """
+    reason = status_reason or ''
+    return "didn't contain changes" in reason or 'No updates are to be performed' in reason
+
+def wait_for_change_set(cfn_client, stack_name, change_set_name, min_delay=MIN_CHANGE_SET_DELAY,
+                        max_delay=MAX_CHANGE_SET_DELAY, backoff=POLL_BACKOFF, timeout=DEFAULT_TIMEOUT,
+                        sleep=time.sleep, clock=time.time):
+    """
+    Poll a change set until it has been created (or failed to be), without boto's waiter and its 30 second delay
+    Returns the change set's final status and status reason, which is still CREATE_PENDING or CREATE_IN_PROGRESS
+    if it didn't finish within timeout seconds. Throttled polls wait max_delay and try again
+    """
+    started = clock()
+    delay = min_delay
+    status = 'CREATE_PENDING'
+    reason = None
+    while True:
+        try:
+            change_set = cfn_client.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            status, reason = change_set['Status'], change_set.get('StatusReason')
+        except Exception as e:
+            if error_code(e) not in THROTTLING_CODES:
+                raise
+            delay = max_delay
+        if status not in ('CREATE_PENDING', 'CREATE_IN_PROGRESS') or clock() - started >= timeout:
+            return status, reason
+        sleep(delay)
+        delay = min(max_delay, delay * backoff)
+
+
+class TrackedStack(object):
+    """
+    A stack being waited on by a StackWatcher
+      * since: events before this time are from earlier operations, and aren't reported
+      * last_event_id: the newest event seen so far
+      * finished: set once the stack reaches a final status, or turns out not to exist
+    """
+    __slots__ = ['name', 'since', 'last_event_id', 'status', 'reason', 'finished']
+    def __init__(self, name, since=None):
+        self.name = name
+        self.since = since
+        self.last_event_id = None
+        self.status = None
+        self.reason = None
+        self.finished = False
+
+
+class StackWatcher(object):
+    """
+    Wait for operations on many stacks to finish, reporting what happens to them as it happens
+    Call track(name) for each stack just before starting its create or update, then wait()
+      * on_event(stack_name, event) is called for every new event, in the order they happened
+      * on_finish(tracked) is called with the TrackedStack once a stack finishes
+      * on_throttled() is called when a poll was throttled, and the next one is put off as long as possible
+    """
+    def __init__(self, cfn_client, on_event=None, on_finish=None, on_throttled=None, min_delay=MIN_POLL_DELAY,
+                 max_delay=MAX_POLL_DELAY, backoff=POLL_BACKOFF, timeout=DEFAULT_TIMEOUT, sleep=time.sleep,
+                 clock=time.time):
+        self.client = cfn_client
+        self.on_event = on_event
+        self.on_finish = on_finish
+        self.on_throttled = on_throttled
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+        self.stacks = []
+    def track(self, stack_name, since=None):
+        """
+        Start tracking a stack, only reporting events from since onwards (now by default)
+        """
+        if since is None:
+            since = datetime.now(timezone.utc)
+        self.stacks.append(TrackedStack(stack_name, since))
+    def _statuses(self, stacks):
+        """
+        The current description of each stack by name, or None if it doesn't exist
+        """
+        found = {}
+        if len(stacks) > LIST_THRESHOLD:
+            for page in self.client.get_paginator('describe_stacks').paginate():
+                for stack in page['Stacks']:
+                    found[stack['StackName']] = found[stack['StackId']] = stack
+        else:
+            for tracked in stacks:
+                try:
+                    found[tracked.name] = self.client.describe_stacks(StackName=tracked.name)['Stacks'][0]
+                except Exception as e:
+                    # A stack that doesn't exist is a ValidationError, anything else (Ex: throttling) is passed on
+                    if error_code(e) != 'ValidationError':
+                        raise
+        return {x.name: found.get(x.name) for x in stacks}
+    def _new_events(self, tracked):
+        """
+        The events for a stack since the last one seen, oldest first. Events come newest first,
+        so pages are only read until reaching the last event seen (or one from before tracking started)
+        """
+        events = []
+        kwargs = {'StackName': tracked.name}
+        while True:
+            page = self.client.describe_stack_events(**kwargs)
+            for event in page['StackEvents']:
+                if event['EventId'] == tracked.last_event_id:
+                    return events[::-1]
+                if tracked.since is not None and event['Timestamp'] < tracked.since:
+                    return events[::-1]
+                events.append(event)
+            if not page.get('NextToken'):
+                return events[::-1]
+            kwargs['NextToken'] = page['NextToken']
+    def poll(self, stacks):
+        """
+        Check on the pending stacks once, reporting their new events
+        Returns the number of new events seen
+        """
+        seen = 0
+        statuses = self._statuses(stacks)
+        for tracked in stacks:
+            stack = statuses[tracked.name]
+            if stack is None:
+                tracked.reason = 'Stack does not exist'
+                tracked.finished = True
+            else:
+                if self.on_event is not None:
+                    events = self._new_events(tracked)
+                    for event in events:
+                        self.on_event(tracked.name, event)
+                    if events:
+                        tracked.last_event_id = events[-1]['EventId']
+                        seen += len(events)
+                if stack['StackStatus'] != tracked.status:
+                    seen += 1
+                tracked.status = stack['StackStatus']
+                tracked.reason = stack.get('StackStatusReason')
+                tracked.finished = is_finished(tracked.status)
+            if tracked.finished and self.on_finish is not None:
+                self.on_finish(tracked)
+        return seen
+    def wait(self):
+        """
+        Poll until every tracked stack has finished, or the timeout runs out
+        Returns the tracked stacks, any that were still going at the timeout aren't finished
+        """
+        started = self.clock()
+        delay = self.min_delay
+        pending = list(self.stacks)
+        while pending:
+            try:
+                changes = self.poll(pending)
+            except Exception as e:
+                if error_code(e) not in THROTTLING_CODES:
+                    raise
+                if self.on_throttled is not None:
+                    self.on_throttled()
+                changes = 0
+                delay = self.max_delay
+            pending = [x for x in pending if not x.finished]
+            if not pending or self.clock() - started >= self.timeout:
+                break
+            self.sleep(delay)
+            # Poll more often while things are happening, and back off while they aren't
+            if changes:
+                delay = max(self.min_delay, delay / self.backoff)
+            else:
+                delay = min(self.max_delay, delay * self.backoff)
+        return self.stacks
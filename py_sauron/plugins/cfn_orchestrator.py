@@ -0,0 +1,49 @@
+"""
+Waiting on many cloudformation stacks at once, instead of a blocking waiter per stack.
+
+StackOrchestrator is the StackWatcher from cfn_common (shared with the deploy scripts), logging each stack's
+events as they happen and returning the outcome of every stack as a Result.
+"""
+import logging
+
+from primitives.item_primitives import Item, Result
+from plugins.cfn_common import SUCCESS_STATUSES, StackWatcher
+
+
+class StackOperationError(Exception):
+    """
+    A stack create or update that finished in anything other than a successful status, Ex: ROLLBACK_COMPLETE
+    """
+
+
+def log_event(stack_name, event):
+    logging.info('{}: {} {} {}'.format(stack_name, event['LogicalResourceId'], event['ResourceStatus'],
+                                       event.get('ResourceStatusReason') or ''))
+
+def log_throttled():
+    logging.info('Throttled while checking stacks, slowing down')
+
+
+class StackOrchestrator(StackWatcher):
+    """
+    Wait for operations on many stacks to finish, reporting their new events as they happen
+    Call track(name) for each stack just before starting its create or update, then wait()
+    on_event(stack_name, event) is called for every new event, in the order they happened
+    """
+    def __init__(self, cfn_client, on_event=log_event, **kwargs):
+        super().__init__(cfn_client, on_event, on_throttled=log_throttled, **kwargs)
+    def wait(self):
+        """
+        Poll until every tracked stack has finished, or the timeout runs out
+        Returns a Result with an Item for each stack, keyed by its name with its final status as the value.
+        Stacks that failed (or were still going at the timeout) are invalid, with their status reason in extra
+        """
+        result = []
+        invalid = []
+        for tracked in super().wait():
+            s_item = Item(key=tracked.name, value=tracked.status, extra={'reason': tracked.reason})
+            if tracked.status in SUCCESS_STATUSES:
+                result.append(s_item)
+            else:
+                invalid.append(s_item)
+        return Result(result=result, invalid=invalid)
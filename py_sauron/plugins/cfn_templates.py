@@ -0,0 +1,225 @@
+"""
+Offline parsing of cloudformation templates, with a content addressed cache of the results.
+
+Templates are loaded with a yaml loader that understands the intrinsic function tags (!Ref, !Sub, !GetAtt...),
+instead of stripping the exclamation marks (see plugins.cfn_common). The analysis of a template (its parameters and their defaults,
+its outputs and exports, and the values it imports) is stored under the SHA-256 of the template body, so
+the remote validate_template call only has to be made the first time a template is seen.
+
+The cache also keeps a snapshot of each stack built from a template (see stack_snapshot), so checking whether
+a stack would change can skip downloading its current template when the stack hasn't been touched since.
+
+The cache is a directory of json files, ~/.cache/sauron/cfn_templates by default. Set SAURON_CFN_TEMPLATE_CACHE
+to use another directory, or to an empty string to turn it off (or call configure_template_cache).
+"""
+import json
+import os
+from tempfile import NamedTemporaryFile
+import threading
+
+import boto3
+
+from plugins.cfn_common import load_template, template_hash, parameter_value
+
+# Bump this when the analysis format changes, so older entries are ignored
+ANALYSIS_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+                                 'sauron', 'cfn_templates')
+
+
+def _find_imports(node, found):
+    if isinstance(node, dict):
+        if len(node) == 1 and 'Fn::ImportValue' in node:
+            name = node['Fn::ImportValue']
+            # A computed name is recorded as its Fn::Sub pattern, Ex: '${Env}-VpcId'
+            if isinstance(name, dict) and isinstance(name.get('Fn::Sub'), str):
+                name = name['Fn::Sub']
+            if isinstance(name, str):
+                found.add(name)
+        for value in node.values():
+            _find_imports(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            _find_imports(value, found)
+    return found
+
+def analyze_template(template_body):
+    """
+    Analyze a template offline, returning a dictionary of
+      * parameters: a list of dictionaries with the key, type, description, and default (None if there isn't one)
+      * outputs: a list of dictionaries with the key and export name (None if it isn't exported)
+      * imports: the names of the values the template imports with Fn::ImportValue
+    """
+    template = load_template(template_body) or {}
+    parameters = []
+    for key, settings in (template.get('Parameters') or {}).items():
+        settings = settings or {}
+        parameters.append({'key': key,
+                           'type': settings.get('Type'),
+                           'description': settings.get('Description'),
+                           'default': parameter_value(settings.get('Default'))})
+    outputs = []
+    for key, settings in (template.get('Outputs') or {}).items():
+        export = (settings or {}).get('Export') or {}
+        outputs.append({'key': key, 'export': export.get('Name')})
+    return {'version': ANALYSIS_VERSION,
+            'sha256': template_hash(template_body),
+            'parameters': parameters,
+            'outputs': outputs,
+            'imports': sorted(_find_imports(template, set())),
+            'validated': False}
+
+
+class TemplateCache(object):
+    """
+    Template analyses stored as json files named after the SHA-256 of the template body
+    Templates never change under the same hash, so entries never need to be invalidated
+    Stack snapshots are kept under stacks/, named after the SHA-256 of the stack id
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.memory = {}
+    def _file(self, digest):
+        return os.path.join(self.path, '{}.json'.format(digest))
+    def _snapshot_file(self, stack_id):
+        return os.path.join(self.path, 'stacks', '{}.json'.format(template_hash(stack_id)))
+    def _write(self, path, data):
+        # Write next to the entry and move it into place, so concurrent runs never read a partial file
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            json.dump(data, f)
+        os.replace(f.name, path)
+    def get(self, digest):
+        with self.lock:
+            if digest in self.memory:
+                return self.memory[digest]
+        try:
+            with open(self._file(digest)) as f:
+                analysis = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if analysis.get('version') != ANALYSIS_VERSION:
+            return None
+        with self.lock:
+            self.memory[digest] = analysis
+        return analysis
+    def put(self, digest, analysis):
+        with self.lock:
+            self.memory[digest] = analysis
+        self._write(self._file(digest), analysis)
+    def get_snapshot(self, stack_id):
+        """
+        The last snapshot recorded for a stack, or None
+        Snapshots change with the stack, so they are always read from disk
+        """
+        try:
+            with open(self._snapshot_file(stack_id)) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.get('version') != ANALYSIS_VERSION:
+            return None
+        return snapshot
+    def put_snapshot(self, stack_id, snapshot):
+        self._write(self._snapshot_file(stack_id), snapshot)
+    def clear(self):
+        with self.lock:
+            self.memory = {}
+        for path in (self.path, os.path.join(self.path, 'stacks')):
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    if name.endswith('.json'):
+                        os.remove(os.path.join(path, name))
+
+
+class _CacheConfig(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configured = False
+        self.cache = None
+    def configure(self, path=None):
+        with self.lock:
+            self.cache = TemplateCache(path) if path else None
+            self.configured = True
+        return self.cache
+    def get(self):
+        if not self.configured:
+            self.configure(os.environ.get('SAURON_CFN_TEMPLATE_CACHE', DEFAULT_CACHE_DIR))
+        return self.cache
+
+
+CACHE = _CacheConfig()
+
+def get_template_cache():
+    """
+    The shared template cache, or None if it is turned off
+    The first call reads SAURON_CFN_TEMPLATE_CACHE
+    """
+    return CACHE.get()
+
+def configure_template_cache(path=None):
+    """
+    Cache template analyses in the directory at path, or turn the cache off if path is None
+    """
+    return CACHE.configure(path)
+
+
+def stack_snapshot(stack, template_digest):
+    """
+    A snapshot of a stack (as returned by DescribeStacks) and the stack_template_hash of its current template
+    It is only valid while the stack's last update time stays the same
+    """
+    return {'version': ANALYSIS_VERSION,
+            'stack_id': stack['StackId'],
+            'updated': str(stack.get('LastUpdatedTime') or stack.get('CreationTime')),
+            'template_sha256': template_digest}
+
+def snapshot_template_hash(stack):
+    """
+    The stack_template_hash of a stack's current template from its cached snapshot,
+    or None if there isn't one or the stack has been updated since
+    """
+    cache = get_template_cache()
+    if cache is None:
+        return None
+    snapshot = cache.get_snapshot(stack['StackId'])
+    if snapshot is None or snapshot['updated'] != str(stack.get('LastUpdatedTime') or stack.get('CreationTime')):
+        return None
+    return snapshot['template_sha256']
+
+def record_stack_snapshot(stack, template_digest):
+    cache = get_template_cache()
+    if cache is not None:
+        cache.put_snapshot(stack['StackId'], stack_snapshot(stack, template_digest))
+
+
+def _merge_validation(analysis, validated):
+    # validate_template's defaults are the ones cloudformation will actually use, so they win
+    defaults = {x['ParameterKey']: x.get('DefaultValue') for x in validated.get('Parameters', [])}
+    for parameter in analysis['parameters']:
+        if parameter['key'] in defaults:
+            parameter['default'] = defaults[parameter['key']]
+    analysis['validated'] = True
+    return analysis
+
+def get_template_analysis(template_body, validate=True, cfn_client=None):
+    """
+    Analyze a template (see analyze_template) through the template cache
+    If validate is set, templates that haven't been validated before are also checked with cloudformation's
+    validate_template, which raises a ClientError for an invalid template. Cached templates make no requests at all
+    """
+    digest = template_hash(template_body)
+    cache = get_template_cache()
+    analysis = cache.get(digest) if cache is not None else None
+    if analysis is not None and (analysis['validated'] or not validate):
+        return analysis
+    analysis = analyze_template(template_body)
+    if validate:
+        if cfn_client is None:
+            cfn_client = boto3.client('cloudformation')
+        analysis = _merge_validation(analysis, cfn_client.validate_template(TemplateBody=template_body))
+    if cache is not None:
+        cache.put(digest, analysis)
+    return analysis
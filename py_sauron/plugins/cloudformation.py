@@ -1,67 +1,264 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 from itertools import chain
-import yaml
+import threading
 
 import boto3
+import boto3.session
 
 from primitives.item_primitives import Item, Result
+from primitives.retry import retry_call
+from plugins.cfn_common import load_template, stack_template_hash, expected_parameters, stack_parameters, \
+    error_code, is_empty_change_set, wait_for_change_set, THROTTLING_CODES, UNCHANGED_STATUSES
+from plugins.cfn_templates import get_template_analysis, snapshot_template_hash, record_stack_snapshot
+from plugins.cfn_orchestrator import StackOrchestrator, StackOperationError, log_event
 
 
 VALID_PREFIXES = ['Parameters', 'Outputs']
+# get_cfn_stacks lists every stack instead of describing each one when more than this many are requested
+DESCRIBE_ALL_THRESHOLD = 10
+# Stacks are read or built one at a time unless parallel is given
+DEFAULT_PARALLEL = 1
+
+
+def is_throttling_error(exception):
+    """
+    Check if a botocore ClientError was caused by rate limiting, and is worth retrying later
+    """
+    return error_code(exception) in THROTTLING_CODES
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def new_cfn_resource():
+    """
+    A cloudformation resource for a worker thread. boto3 resources aren't thread safe, so each task needs its own,
+    but they're all made from one shared session, so credentials are resolved and service models loaded once
+    Create them before handing them to the threads, the session itself isn't safe to use concurrently
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session()
+        return _SESSION.resource('cloudformation')
+
+def _run_parallel(func, tasks, parallel=DEFAULT_PARALLEL):
+    """
+    Call func with each tuple of arguments in tasks, on up to parallel threads
+    Returns the results in the same order as the tasks
+    """
+    if parallel <= 1 or len(tasks) <= 1:
+        return [func(*x) for x in tasks]
+    with ThreadPoolExecutor(min(parallel, len(tasks))) as pool:
+        return list(pool.map(lambda x: func(*x), tasks))
 
 
 def _create_stack(stack_name, stack_template, build_parameters, cfn_client):
+    """
+    Start creating the stack, returns False if it already exists
+    """
     # We need to collect the exception created by the botocore error factory
     AlreadyExistsException = cfn_client.meta.client.exceptions.AlreadyExistsException
 
-    # Create the stack and wait for it to create successfully
     try:
-        res = cfn_client.create_stack(StackName=stack_name,
-                                      TemplateBody=stack_template,
-                                      Parameters=build_parameters)
-        # Get a cloudformation waiter, and wait for the stack to finish building
-        waiter = cfn_client.meta.client.get_waiter('stack_create_complete')
-        waiter.wait(StackName=stack_name)
-        stack_obj = cfn_client.Stack(res.stack_name)
+        cfn_client.create_stack(StackName=stack_name,
+                                TemplateBody=stack_template,
+                                Parameters=build_parameters)
     except AlreadyExistsException:
-        return None
-    return stack_obj
+        return False
+    return True
 
 def _update_stack(stack_name, stack_template, build_parameters, cfn_client):
-    stack_object = cfn_client.Stack(stack_name)
-    # We need to collect the exception created by the botocore error factory
-    ClientError = stack_object.meta.client.exceptions.ClientError
+    """
+    Start updating the stack through a change set, returns False if there was nothing to update
+    Raises StackOperationError if the change set couldn't be created
+    """
+    client = cfn_client.meta.client
+    change_set_name = 'sauron-{}'.format(datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f'))
+    client.create_change_set(StackName=stack_name,
+                             ChangeSetName=change_set_name,
+                             ChangeSetType='UPDATE',
+                             TemplateBody=stack_template,
+                             Parameters=build_parameters)
+    status, reason = wait_for_change_set(client, stack_name, change_set_name)
+    if status != 'CREATE_COMPLETE':
+        # Failed change sets stick around until they're deleted
+        client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if is_empty_change_set(reason):
+            return False
+        raise StackOperationError('Change set for stack {} finished as {}: {}'.format(stack_name, status, reason))
+    client.execute_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+    return True
 
-    # Update the stack and wait for the update to complete
+def _describe_stack(stack_name, cfn_client):
+    """
+    Describe a single stack, or None if it doesn't exist
+    """
+    client = cfn_client.meta.client
     try:
-        raw = stack_object.update(TemplateBody=stack_template,
-                                  Parameters=build_parameters)
-        waiter = cfn_client.meta.client.get_waiter('stack_update_complete')
-        waiter.wait(StackName=stack_name)
-    # We will get a ClientError ValidationError if the template does not need to be updated
-
-    except ClientError:
-        pass
-    """ Reload the object even if we didn't change it
-    We may have passed in an arn instead of name
-    Reloading will make the .name and .stack_name correct for future references
-    To this stack object
-    """
-    stack_object.reload()
+        return client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except client.exceptions.ClientError as e:
+        # A stack that doesn't exist is a ValidationError, the same as for the orchestrator
+        if error_code(e) != 'ValidationError':
+            raise
+        return None
+
+def _expected_parameters(stack_template, build_params):
+    """
+    The parameters a stack will have once it is built from the template,
+    the ones given and the template defaults for the rest
+    """
+    analysis = get_template_analysis(stack_template, validate=False)
+    return expected_parameters({x['key']: x['default'] for x in analysis['parameters']}, build_params)
+
+def _is_unchanged(stack, stack_template, build_params, cfn_client):
+    """
+    Check locally whether building the stack (as returned by DescribeStacks) from the template would change it:
+    its parameters come with the description, and its current template is compared by hash, taken from the
+    stack's cached snapshot if it hasn't been updated since, or downloaded (and snapshotted) otherwise
+    Anything that can't be compared, like NoEcho parameters, counts as changed and is left to the change set
+    """
+    if stack['StackStatus'] not in UNCHANGED_STATUSES:
+        return False
+    if stack_parameters(stack) != _expected_parameters(stack_template, build_params):
+        return False
+    current_digest = snapshot_template_hash(stack)
+    if current_digest is None:
+        current_body = cfn_client.meta.client.get_template(StackName=stack['StackId'],
+                                                           TemplateStage='Original')['TemplateBody']
+        current_digest = stack_template_hash(current_body)
+        record_stack_snapshot(stack, current_digest)
+    return current_digest == stack_template_hash(stack_template)
+
+def _start_stack(stack_name, stack_template, build_parameters, cfn_client, listing=None):
+    """
+    Create the stack, or update it if it already exists and would change, without waiting for it to finish
+    listing holds the descriptions of every stack by name, otherwise the stack is described on its own
+    Returns the name the stack was built with, when the operation started (None if there was nothing to do),
+    and the operation: 'create', 'update', or None if the stack was unchanged
+    """
+    build_params = [{'ParameterKey': x.key, 'ParameterValue': x.value} for x in build_parameters]
+    v_stack_name = stack_name.replace('_', '-')
+    if listing is not None:
+        stack = listing.get(v_stack_name)
+    else:
+        stack = _describe_stack(v_stack_name, cfn_client)
+    since = datetime.now(timezone.utc)
+    if stack is None:
+        if _create_stack(v_stack_name, stack_template, build_params, cfn_client):
+            return v_stack_name, since, 'create'
+        # Someone else created it in the meantime
+        stack = _describe_stack(v_stack_name, cfn_client)
+    if stack is not None and _is_unchanged(stack, stack_template, build_params, cfn_client):
+        return stack['StackName'], None, None
+    if _update_stack(v_stack_name, stack_template, build_params, cfn_client):
+        return v_stack_name, since, 'update'
+    return v_stack_name, None, None
+
+def _finish_stack(v_stack_name, operation, stack_template, cfn_client):
+    """
+    The boto Stack object for a stack that was started with _start_stack
+    Stacks that were skipped as unchanged aren't reloaded, v_stack_name is already the name from their
+    description, so .name and .stack_name are correct even if an arn was passed in
+    """
+    stack_object = cfn_client.Stack(v_stack_name)
+    if operation is not None:
+        # Reload created or updated stacks, so their attributes reflect the operation that just finished
+        stack_object.reload()
+        # The stack now runs this template, so the next build can compare against it without downloading it
+        record_stack_snapshot(stack_object.meta.data, stack_template_hash(stack_template))
     return stack_object
 
+def _start_cfn_stack(stack, cfn_resource, listing=None):
+    """
+    Start creating or updating a stack (see _start_stack), returning a Result
+    Throttled requests are retryable, nothing was started by the request that was throttled
+    """
+    ClientError = cfn_resource.meta.client.exceptions.ClientError
+    try:
+        return Result(result=_start_stack(*(tuple(stack) + (cfn_resource, listing))))
+    except ClientError as e:
+        return Result(invalid=Item(key=stack[0]), exception=e, retry=is_throttling_error(e))
+    except StackOperationError as e:
+        return Result(invalid=Item(key=stack[0]), exception=e)
+
+def _list_stacks(cfn_client):
+    """
+    Describe every stack, or None if we were throttled and each stack should be described on its own
+    """
+    try:
+        return _describe_all_stacks(cfn_client)
+    except cfn_client.exceptions.ClientError as e:
+        if is_throttling_error(e):
+            return None
+        raise
+
+def create_cfn_stacks(stacks, parallel=DEFAULT_PARALLEL, resource_factory=new_cfn_resource, on_event=log_event,
+                      threshold=DESCRIBE_ALL_THRESHOLD):
+    """
+    Create or update many stacks, and wait for all of them to finish, so building them takes about as long
+    as the slowest one. The operations are started on up to parallel threads at once, then a single
+    StackOrchestrator waits on all of them, passing each new stack event to on_event
+    Stacks that already exist are only updated if their template or parameters would change (checked locally,
+    see _is_unchanged), and then through a change set, so unchanged stacks cost no updates and no waiting.
+    More than threshold stacks are checked against a single listing of every stack.
+    Starting a stack is retried with a backoff if cloudformation throttles it, see retry_call
+    stacks is a list of (stack_name, stack_template, build_parameters) tuples, the arguments to create_cfn_stack
+    Returns a Result for each stack in the same order, holding its boto Stack object,
+    or the stack name as an invalid Item along with the exception
+    """
+    stacks = [tuple(x) for x in stacks]
+    resources = [resource_factory() for x in stacks]
+    client = resource_factory().meta.client
+    listing = _list_stacks(client) if len(stacks) > threshold else None
+    started = _run_parallel(partial(retry_call, _start_cfn_stack),
+                            [(x, y, listing) for x, y in zip(stacks, resources)], parallel)
+
+    orchestrator = StackOrchestrator(client, on_event)
+    for res in started:
+        v_stack_name, since, operation = res.result or (None, None, None)
+        if since is not None:
+            orchestrator.track(v_stack_name, since)
+    failed = {}
+    if orchestrator.stacks:
+        failed = {x.key: x for x in orchestrator.wait().invalid}
+
+    results = []
+    to_finish = []
+    for stack, res, cfn_resource in zip(stacks, started, resources):
+        if res.invalid:
+            results.append(res)
+            continue
+        v_stack_name, since, operation = res.result
+        if v_stack_name in failed:
+            s_failed = failed[v_stack_name]
+            exception = StackOperationError('Stack {} finished as {}: {}'.format(
+                v_stack_name, s_failed.value, s_failed.extra['reason']))
+            results.append(Result(invalid=Item(key=stack[0]), exception=exception))
+        else:
+            results.append(None)
+            to_finish.append((len(results) - 1, (v_stack_name, operation, stack[1], cfn_resource)))
+    finished = _run_parallel(_finish_stack, [x for _, x in to_finish], parallel)
+    for (index, _), stack_object in zip(to_finish, finished):
+        results[index] = Result(result=stack_object)
+    return results
+
 def create_cfn_stack(stack_name,
                      stack_template,
                      build_parameters=[],
                      cfn_client=boto3.resource('cloudformation')):
     """
+    Create the stack, or update it if it already exists and would change, and wait for it to finish.
+    Returns the boto Stack object
+    Raises StackOperationError if it failed
     TODO: Wrap permissions exceptions so we can fall back if we've got default values
     """
-    build_params = [{'ParameterKey': x.key, 'ParameterValue': x.value} for x in build_parameters]
-    v_stack_name = stack_name.replace('_', '-')
-    res = _create_stack(v_stack_name, stack_template, build_params, cfn_client)
-    if res:
-        return res
-    return _update_stack(v_stack_name, stack_template, build_params, cfn_client)
+    res = create_cfn_stacks([(stack_name, stack_template, build_parameters)], resource_factory=lambda: cfn_client)[0]
+    if res.invalid:
+        raise res.exception
+    return res.result
 
 def _get_cfn_stack(stack_name, cfn_client):
     """
@@ -75,10 +272,16 @@ def _get_cfn_stack(stack_name, cfn_client):
 
     try:
         stack_object.reload()
-    except ClientError:
+    except ClientError as e:
+        if is_throttling_error(e):
+            return Result(invalid=Item(key=stack_name), exception=e, retry=True)
         return Result()
-    stack_params = stack_object.parameters
-    stack_outputs = stack_object.outputs
+    return Result(result=_stack_items(stack_object.parameters, stack_object.outputs))
+
+def _stack_items(stack_params, stack_outputs):
+    """
+    Wrap a stack's Parameters and Outputs (as returned by DescribeStacks) into Items
+    """
     if stack_params:
         params = map(lambda x: Item(key=x['ParameterKey'], value=x['ParameterValue'], prefix='Parameters'), stack_params)
     else:
@@ -87,16 +290,30 @@ def _get_cfn_stack(stack_name, cfn_client):
         outputs = map(lambda x: Item(key=x['OutputKey'], value=x['OutputValue'], prefix='Outputs'), stack_outputs)
     else:
         outputs = []
-    res = chain(outputs, params)
-    return Result(result=res)
+    return chain(outputs, params)
+
+def _describe_all_stacks(cfn_client):
+    """
+    List every stack with paginated DescribeStacks calls, indexed by both name and arn
+    """
+    stacks = {}
+    for page in cfn_client.get_paginator('describe_stacks').paginate():
+        for stack in page['Stacks']:
+            stacks[stack['StackName']] = stack
+            stacks[stack['StackId']] = stack
+    return stacks
+
+def _section_items(stack_name, stack_items, section=None):
+    if section is None:
+        return (x.clone(prefix='{}/{}'.format(stack_name, x.prefix)) for x in stack_items)
+    return (x.clone(prefix=stack_name) for x in stack_items if x.prefix == section)
 
 def _get_template(template_yaml):
     """
-    Take a raw cloudformation template, remove exclamation marks so we can easily parse it
-    and return a dictionary of the template
+    Take a raw cloudformation template and return a dictionary of the template
+    Intrinsic functions are parsed into their long form, Ex: !Ref Swarm becomes {'Ref': 'Swarm'}
     """
-    tem = template_yaml.replace('!', '')
-    return yaml.load(tem)
+    return load_template(template_yaml)
 
 def _make_template_items(template_dict):
     """
@@ -130,19 +347,58 @@ def get_cfn_stack(stack_name, cfn_resource=boto3.resource('cloudformation')):
     """
     return _get_cfn_stack(stack_name, cfn_resource)
 
-def _params_from_validate(template_dict):
-    param_items = []
-    for param in template_dict['Parameters']:
-        param_key = param['ParameterKey']
-        if 'DefaultValue' in param:
-            param_value = param['DefaultValue']
+def get_cfn_stacks(stack_names,
+                   section=None,
+                   cfn_resource=boto3.resource('cloudformation'),
+                   threshold=DESCRIBE_ALL_THRESHOLD,
+                   parallel=DEFAULT_PARALLEL,
+                   resource_factory=new_cfn_resource):
+    """
+    Get the Items for many stacks (by name or arn) in a single Result
+    If section is set (Ex: 'Outputs'), only the items from that section are returned, prefixed with their stack name,
+    otherwise each item is prefixed with '<stack name>/<section>'
+    More than threshold stacks are looked up in a listing of every stack (one DescribeStacks call per page),
+    fewer are described individually, on up to parallel threads (each with a resource from resource_factory).
+    The items are always in the order of stack_names. Stacks that don't exist are returned as invalid Items
+    """
+    stack_names = list(stack_names)
+    found = {}
+    if len(stack_names) > threshold:
+        ClientError = cfn_resource.meta.client.exceptions.ClientError
+        try:
+            described = _describe_all_stacks(cfn_resource.meta.client)
+        except ClientError as e:
+            if is_throttling_error(e):
+                return Result(invalid=[Item(key=x) for x in stack_names], exception=e, retry=True)
+            raise
+        for stack_name in stack_names:
+            if stack_name in described:
+                stack = described[stack_name]
+                found[stack_name] = _stack_items(stack.get('Parameters'), stack.get('Outputs'))
+    else:
+        if parallel > 1:
+            tasks = [(x, resource_factory()) for x in stack_names]
         else:
-            param_value = None
-        param_items.append(Item(key=param_key,value=param_value, prefix='Parameters'))
+            tasks = [(x, cfn_resource) for x in stack_names]
+        for stack_name, res in zip(stack_names, _run_parallel(_get_cfn_stack, tasks, parallel)):
+            if res.retry:
+                return Result(invalid=[Item(key=x) for x in stack_names], exception=res.exception, retry=True)
+            if res.result is not None:
+                found[stack_name] = res.result
+    result = chain.from_iterable(_section_items(x, found[x], section) for x in stack_names if x in found)
+    return Result(result=result, invalid=[Item(key=x) for x in stack_names if x not in found])
+
+def _params_from_analysis(analysis):
+    param_items = []
+    for param in analysis['parameters']:
+        param_items.append(Item(key=param['key'], value=param['default'], prefix='Parameters'))
     return Result(param_items)
-    
 
-def get_cfn_template(template_yaml):
-    cfn_client = boto3.client('cloudformation')
-    template_dict = cfn_client.validate_template(TemplateBody=template_yaml)
-    return _params_from_validate(template_dict)
+
+def get_cfn_template(template_yaml, validate=True):
+    """
+    Get the template's Parameters as Items, with their default values (or None)
+    The template is parsed locally, and only validated with cloudformation the first time it is seen,
+    see plugins.cfn_templates
+    """
+    return _params_from_analysis(get_template_analysis(template_yaml, validate))
@@ -0,0 +1,194 @@
+"""
+Optional on-disk read-through cache for consul reads, shared between processes.
+
+Set SAURON_CONSUL_CACHE to the path of a cache file (or call configure_cache) to turn it on. Each cached read
+keeps the records consul returned, with their ModifyIndex, along with the X-Consul-Index of the read.
+Reads younger than the TTL are served straight from the cache. Older ones are revalidated with a single
+recursive keys listing, which comes back with the same X-Consul-Index as long as nothing under the key has
+changed (for a single key, the ModifyIndex of its record), and only refetched when it has. Every CLI run in a job can then share the reads of the runs before it.
+"""
+from base64 import b64encode, b64decode
+import json
+import os
+import sqlite3
+import threading
+from time import time
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def _env_number(name, default, cast):
+    try:
+        return cast(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+def _encode_records(data):
+    def encode(record):
+        record = dict(record)
+        if record.get('Value') is not None:
+            record['Value'] = b64encode(record['Value']).decode()
+        return record
+    if data is None:
+        return json.dumps(None)
+    if isinstance(data, list):
+        return json.dumps([encode(x) for x in data])
+    return json.dumps(encode(data))
+
+def _scope(conn):
+    """
+    Entries are kept separate for each consul endpoint and datacenter, so one cache file can be shared
+    """
+    return '{} {}'.format(getattr(getattr(conn, 'http', None), 'base_uri', ''), getattr(conn, 'dc', None) or '')
+
+def _decode_records(raw):
+    def decode(record):
+        if record.get('Value') is not None:
+            record['Value'] = b64decode(record['Value'])
+        return record
+    data = json.loads(raw)
+    if data is None:
+        return None
+    if isinstance(data, list):
+        return [decode(x) for x in data]
+    return decode(data)
+
+def _validator(consul_index, records, recurse):
+    """
+    The index a keys listing of the key comes back with while a cached read is still current.
+    For a recursive read that is its X-Consul-Index, but a single key read has the index of the whole kv store,
+    so it is checked against the ModifyIndex of the record instead
+    """
+    if recurse:
+        return consul_index
+    record = json.loads(records)
+    if record is None:
+        return consul_index
+    return str(record['ModifyIndex'])
+
+
+class ConsulCache(object):
+    """
+    Cached consul kv reads in an sqlite database, keyed by the consul endpoint, the key, and whether the read was recursive
+    Entries older than ttl seconds are revalidated before use. Once there are more than max_entries,
+    the least recently used ones are evicted
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'scope TEXT, key TEXT, recurse INTEGER, consul_index TEXT, records TEXT, '
+                            'fetched REAL, used REAL, PRIMARY KEY (scope, key, recurse)) WITHOUT ROWID')
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def _load(self, scope, c_key, recurse):
+        return self.db.execute('SELECT consul_index, records, fetched FROM entries '
+                               'WHERE scope = ? AND key = ? AND recurse = ?',
+                               (scope, c_key, int(recurse))).fetchone()
+    def _touch(self, scope, c_key, recurse, fetched=None):
+        with self.db:
+            if fetched is None:
+                self.db.execute('UPDATE entries SET used = ? WHERE scope = ? AND key = ? AND recurse = ?',
+                                (time(), scope, c_key, int(recurse)))
+            else:
+                self.db.execute('UPDATE entries SET used = ?, fetched = ? WHERE scope = ? AND key = ? AND recurse = ?',
+                                (time(), fetched, scope, c_key, int(recurse)))
+    def _store(self, scope, c_key, recurse, consul_index, data):
+        now = time()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (scope, c_key, int(recurse), str(consul_index), _encode_records(data), now, now))
+            # Evict the least recently used entries past max_entries
+            self.db.execute('DELETE FROM entries WHERE (scope, key, recurse) IN '
+                            '(SELECT scope, key, recurse FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                            (self.max_entries,))
+    def get(self, conn, c_key, recurse=False, ttl=None):
+        """
+        Read a key (or a prefix, if recurse is set) through the cache
+        Returns (index, data) the same as conn.kv.get. Pass ttl=0 to always revalidate, Ex: before writing a diff
+        """
+        if ttl is None:
+            ttl = self.ttl
+        scope = _scope(conn)
+        with self.lock:
+            entry = self._load(scope, c_key, recurse)
+        if entry is not None:
+            consul_index, records, fetched = entry
+            now = time()
+            if now - fetched < ttl:
+                with self.lock:
+                    self._touch(scope, c_key, recurse)
+                return consul_index, _decode_records(records)
+            # A keys listing has the same index as a recursive read of the prefix, without the values
+            index, _ = conn.kv.get(c_key, recurse=True, keys=True)
+            if str(index) == _validator(consul_index, records, recurse):
+                with self.lock:
+                    self._touch(scope, c_key, recurse, fetched=now)
+                return consul_index, _decode_records(records)
+        index, data = conn.kv.get(c_key, recurse=recurse)
+        with self.lock:
+            self._store(scope, c_key, recurse, index, data)
+        return index, data
+    def invalidate(self, conn, c_key):
+        """
+        Drop every entry that could include c_key, Ex: after writing to it
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM entries WHERE scope = ? AND '
+                            '(key = ? OR (recurse = 1 AND substr(?, 1, length(key)) = key))',
+                            (_scope(conn), c_key, c_key))
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM entries')
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class _CacheConfig(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configured = False
+        self.cache = None
+    def configure(self, path=None, ttl=None, max_entries=None):
+        with self.lock:
+            if self.cache is not None:
+                self.cache.close()
+            self.cache = None
+            if path:
+                if ttl is None:
+                    ttl = _env_number('SAURON_CONSUL_CACHE_TTL', DEFAULT_TTL, float)
+                if max_entries is None:
+                    max_entries = _env_number('SAURON_CONSUL_CACHE_SIZE', DEFAULT_MAX_ENTRIES, int)
+                self.cache = ConsulCache(path, ttl, max_entries)
+            self.configured = True
+        return self.cache
+    def get(self):
+        if not self.configured:
+            self.configure(os.environ.get('SAURON_CONSUL_CACHE'))
+        return self.cache
+
+
+CACHE = _CacheConfig()
+
+def get_cache():
+    """
+    The shared cache, or None if caching is off.
+    The first call reads SAURON_CONSUL_CACHE, SAURON_CONSUL_CACHE_TTL and SAURON_CONSUL_CACHE_SIZE
+    """
+    return CACHE.get()
+
+def configure_cache(path=None, ttl=None, max_entries=None):
+    """
+    Turn the cache on with a cache file at path, or off if path is None
+    """
+    return CACHE.configure(path, ttl, max_entries)
@@ -0,0 +1,81 @@
+"""
+Shared, lazily created consul clients.
+
+Clients are only created the first time they are needed, so any configuration (or environment variables)
+set up before then is respected. Every plugin and script in a process shares the same client for the same
+settings, and with it a pool of keep-alive HTTP connections.
+"""
+import os
+import threading
+
+from consul import Consul
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+
+def _pool_size():
+    try:
+        return int(os.environ['SAURON_CONSUL_POOL_SIZE'])
+    except (KeyError, ValueError):
+        return DEFAULT_POOL_SIZE
+
+
+class ConsulConnections(object):
+    """
+    Process wide cache of consul clients, keyed by the settings used to create them
+    Settings are passed through to consul.Consul, which also reads CONSUL_HTTP_ADDR, CONSUL_HTTP_TOKEN,
+    CONSUL_HTTP_SSL and CONSUL_HTTP_SSL_VERIFY from the environment
+    """
+    def __init__(self):
+        self.defaults = {}
+        self.pool_size = None
+        self.clients = {}
+        self.lock = threading.Lock()
+    def configure(self, pool_size=None, **settings):
+        """
+        Set the default settings for clients created after this call
+        """
+        with self.lock:
+            self.defaults = settings
+            self.pool_size = pool_size
+    def _make_client(self, settings):
+        conn = Consul(**settings)
+        # The std client keeps a requests session, size its connection pool for concurrent use
+        session = getattr(conn.http, 'session', None)
+        if session is not None:
+            pool_size = self.pool_size or _pool_size()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return conn
+    def get(self, **overrides):
+        settings = dict(self.defaults, **overrides)
+        client_key = tuple(sorted(settings.items()))
+        with self.lock:
+            conn = self.clients.get(client_key)
+            if conn is None:
+                conn = self.clients[client_key] = self._make_client(settings)
+        return conn
+    def reset(self):
+        """
+        Drop every cached client, Ex: after the environment changes
+        """
+        with self.lock:
+            for conn in self.clients.values():
+                session = getattr(conn.http, 'session', None)
+                if session is not None:
+                    session.close()
+            self.clients = {}
+
+
+CONNECTIONS = ConsulConnections()
+
+def get_connection(**overrides):
+    """
+    Get the shared consul client for the default settings, updated with any overrides
+    """
+    return CONNECTIONS.get(**overrides)
+
+def configure_connection(pool_size=None, **settings):
+    CONNECTIONS.configure(pool_size, **settings)
@@ -1,12 +1,52 @@
+from base64 import b64encode, b64decode
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+from itertools import chain
+import json
+import logging
+import random
 import socket
+import time
+import zlib
 
-from consul import Consul, ConsulException
+from consul import ConsulException
+from consul.base import CB, Response, Timeout, ClientError, ACLDisabled, ACLPermissionDenied, NotFound
 
-from primitives.item_primitives import join_prefix, item_action, Result, Item, split_by_sep
+from primitives.item_primitives import join_prefix, item_action, Result, Item, split_by_sep, pure_action, SauronPrimitive
+from primitives.item_store import ItemStore, diff_items
+from primitives.retry import retry_call
+from plugins.consul_connection import get_connection
+from plugins.consul_cache import get_cache
 
 CONSUL_SEP = '/'
+# Consul rejects transactions with more than 64 operations
+TXN_MAX_OPS = 64
+# Bytes read from the response at a time when streaming a recursive read
+STREAM_CHUNK_SIZE = 64 * 1024
+# How long each blocking query waits for a change, and the bounds for backing off after a failed one (seconds)
+WATCH_WAIT = '5m'
+WATCH_MIN_BACKOFF = 1
+WATCH_MAX_BACKOFF = 60
+# put_consul(chunked=True) splits values over CHUNK_THRESHOLD bytes into CHUNK_SIZE chunks, consul rejects values over 512KB
+CHUNK_THRESHOLD = 256 * 1024
+CHUNK_SIZE = 128 * 1024
+# Chunks are stored under <key>/.chunks/<generation>/, and the key itself holds a manifest flagged with CHUNKED_FLAG
+CHUNK_DIR = '.chunks'
+CHUNKED_FLAG = 0x53524348
+# Consul also limits the size of a whole transaction, so chunks are written a few at a time (base64 encoded bytes)
+TXN_MAX_BYTES = 384 * 1024
+CHUNK_FETCH_WORKERS = 8
 
 
+class ChunkedValueError(ConsulException):
+    """
+    A chunked value couldn't be put back together, Ex: a newer write removed its chunks while they were being read
+    """
+
+
+@pure_action
 def is_consul_prefix(s_item):
     """
     Verify that the item's prefix is appropriate for consul
@@ -19,61 +59,687 @@ def is_consul_prefix(s_item):
         return Result(result=s_item)
     return Result(invalid=s_item)
 
+def is_retryable_error(exception):
+    """
+    Connection failures, timeouts, and consul server errors (5xx) are worth retrying.
+    Client errors, like a bad request or missing ACL permissions, will fail the same way again
+    """
+    if isinstance(exception, (ClientError, ACLDisabled, ACLPermissionDenied, NotFound)):
+        return False
+    if isinstance(exception, (Timeout, ChunkedValueError)):
+        return True
+    if isinstance(exception, ConsulException):
+        return str(exception)[:1] == '5'
+    # requests' connection errors and timeouts are subclasses of socket.error (OSError)
+    return isinstance(exception, socket.error)
+
+def _failed(s_item, exception):
+    return Result(invalid=s_item, exception=exception, retry=is_retryable_error(exception))
+
 def _put_consul(s_item, conn):
-    n_item = join_prefix(s_item, '/')
-    raw = conn.kv.put(n_item.key, s_item.value)
-    if raw:
-        return Result(s_item)
-    return Result(invalid=s_item)
+    if conn is None:
+        conn = get_connection()
+    # A transaction rather than a plain put, so the chunks of a chunked value being replaced go with it
+    return next(_txn_many([s_item], _txn_set, conn, TXN_MAX_OPS))
 
 
-def _get_consul(s_item, conn, recurse=False):
+def _read_key(s_item, recurse=False):
     """
-    If recurse is set, we will return all items matching this item's prefix
-    We may want validation to ensure we can't dump all of consul's key/value pairs
+    The consul key to read for an item, or None if there is nothing to read
     """
-
     if recurse and s_item.prefix is not None:
-        c_key = s_item.prefix
+        return s_item.prefix
     elif recurse and s_item.prefix is None:
-        return []
-    else:
-        c_key = join_prefix(s_item, CONSUL_SEP).key
+        return None
+    return join_prefix(s_item, CONSUL_SEP).key
 
-    index, data = conn.kv.get(c_key, recurse=recurse)
+def _record_value(record):
+    """
+    The raw bytes of a kv record's value. Values read with conn.kv.get are already decoded,
+    streamed ones are still base64 encoded
+    """
+    value = record.get('Value')
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        return b64decode(value)
+    return value
 
-    def to_item(intermediate_res):
-        print(intermediate_res)
-        try:
-            value = intermediate_res['Value'].decode()
-        except AttributeError:
-            value = ''
-        return  Item(key=intermediate_res['Key'],
-                     value=value)
+def _to_item(record):
+    """
+    Turn a single kv record into an item with the full consul key
+    """
+    return Item(key=record['Key'],
+                value=_record_value(record).decode(),
+                extra={'ModifyIndex': record.get('ModifyIndex')})
+
+def _is_chunk_key(c_key):
+    return '{0}{1}{0}'.format(CONSUL_SEP, CHUNK_DIR) in c_key
+
+def _chunk_key(c_key, generation, index):
+    return CONSUL_SEP.join([c_key, CHUNK_DIR, generation, '{:05d}'.format(index)])
+
+def _manifest(record):
+    """
+    The manifest stored in place of a chunked value, or None if the record holds a regular value
+    """
+    if not record or record.get('Flags') != CHUNKED_FLAG:
+        return None
+    try:
+        return json.loads(_record_value(record).decode())
+    except ValueError:
+        return None
+
+def _chunk_keys(record, manifest):
+    return [_chunk_key(record['Key'], manifest['generation'], x) for x in range(manifest['chunks'])]
+
+def _join_chunks(record, manifest, chunks):
+    """
+    Put a chunked value back together from the records of its chunks, in order
+    Returns a copy of the manifest's record holding the original value
+    """
+    if any(x is None for x in chunks):
+        raise ChunkedValueError('Missing chunks of {} (generation {})'.format(record['Key'], manifest['generation']))
+    value = b''.join(map(_record_value, chunks))
+    if manifest.get('compression') == 'zlib':
+        value = zlib.decompress(value)
+    if hashlib.sha256(value).hexdigest() != manifest['sha256']:
+        raise ChunkedValueError('Chunks of {} do not match its manifest'.format(record['Key']))
+    return dict(record, Value=value)
+
+def _fetch_chunks(record, conn, found=None, workers=CHUNK_FETCH_WORKERS):
+    """
+    Resolve a record to its full value if it holds a chunked value's manifest, otherwise return it unchanged
+    Chunks already in found (records by key, Ex: from a recursive read) are used as they are,
+    the rest are fetched in parallel
+    """
+    manifest = _manifest(record)
+    if manifest is None:
+        return record
+    keys = _chunk_keys(record, manifest)
+    found = found or {}
+    missing = [x for x in keys if x not in found]
+    if missing:
+        def fetch(c_key):
+            index, data = conn.kv.get(c_key)
+            return c_key, data
+        with ThreadPoolExecutor(min(workers, len(missing))) as pool:
+            found = dict(found, **dict(pool.map(fetch, missing)))
+    return _join_chunks(record, manifest, [found.get(x) for x in keys])
+
+def _resolve_chunks(records, conn):
+    """
+    Replace the manifests of chunked values in a list of records with their full values, and drop the chunks themselves
+    """
+    chunks = {x['Key']: x for x in records if _is_chunk_key(x['Key'])}
+    return [_fetch_chunks(x, conn, chunks) for x in records if not _is_chunk_key(x['Key'])]
+
+def _read_result(s_item, data, recurse=False, conn=None):
+    """
+    Turn the data returned by a consul kv read into a Result of items
+    If conn is given, chunked values are put back together, fetching their chunks if they weren't part of the read
+    """
+    if data and conn is not None:
+        if recurse:
+            data = _resolve_chunks(data, conn)
+        else:
+            data = _fetch_chunks(data, conn)
     if data:
         if recurse:
-            r_items = map(to_item, data)
+            r_items = map(_to_item, data)
         else:
-            r_items = to_item(data)
+            r_items = _to_item(data)
         result = map(lambda x: split_by_sep(x, CONSUL_SEP), r_items)
         return Result(result)
     return Result(invalid=s_item)
 
-def get_consul_by_prefix(s_item, conn=Consul()):
+def _iter_json_array(chunks):
+    """
+    Incrementally parse a json array of objects from an iterable of text chunks, yielding each object
+    as soon as it has been read. Only the object currently being parsed is held in memory
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    chunks = iter(chunks)
+    while True:
+        # Skip over the array's brackets, commas and whitespace between objects
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+            if buf[pos] == '[':
+                started = True
+            pos += 1
+        if started and pos < len(buf):
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                pass
+            else:
+                yield record
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            if buf[pos:].strip():
+                raise ValueError('Truncated json response: {}'.format(buf[pos:pos + 100]))
+            return
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def _stream_records(conn, c_key, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Make a recursive kv read over the client's requests session with a streamed response,
+    and yield the raw records as they are parsed
+    """
+    http = conn.http
+    params = [('recurse', '1')]
+    if conn.token:
+        params.append(('token', conn.token))
+    if conn.dc:
+        params.append(('dc', conn.dc))
+    if conn.consistency in ('consistent', 'stale'):
+        params.append((conn.consistency, '1'))
+    uri = http.uri('/v1/kv/{}'.format(c_key), params)
+    with http.session.get(uri, verify=http.verify, cert=http.cert, stream=True) as response:
+        if response.status_code == 404:
+            return
+        if response.status_code >= 400:
+            response.encoding = 'utf-8'
+            CB._status(Response(response.status_code, response.headers, response.text))
+        text = codecs.getincrementaldecoder('utf-8')()
+        chunks = (text.decode(x) for x in response.iter_content(chunk_size))
+        for record in _iter_json_array(chunks):
+            yield record
+
+def stream_consul_prefix(s_item, conn=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generator of every item under the item's prefix, parsed from the response as it arrives
+    so reading a huge prefix doesn't need the whole response (or all of its items) in memory at once.
+    The chunks of chunked values are skipped, and fetched separately when their manifest is read.
+    Falls back to a regular read for clients without a requests session
+    """
+    if conn is None:
+        conn = get_connection()
+    if s_item.prefix is None:
+        return
+    if getattr(getattr(conn, 'http', None), 'session', None) is None:
+        index, data = conn.kv.get(s_item.prefix, recurse=True)
+        records = data or []
+    else:
+        records = _stream_records(conn, s_item.prefix, chunk_size)
+    for record in records:
+        if _is_chunk_key(record['Key']):
+            continue
+        yield split_by_sep(_to_item(_fetch_chunks(record, conn)), CONSUL_SEP)
+
+def _stream_result(s_item, streamed):
+    """
+    Wrap a stream of items in a Result. A failure part way through ends the stream, and turns the Result
+    into the one _failed would have returned, so check its exception once the items have been consumed
+    """
+    res = Result()
+    def items():
+        try:
+            for s_streamed in streamed:
+                yield s_streamed
+        except (ConsulException, socket.error) as e:
+            failed = _failed(s_item, e)
+            res.result = None
+            res.invalid = failed.invalid
+            res.exception = failed.exception
+            res.retry = failed.retry
+    res.result = items()
+    return res
+
+def _get_consul(s_item, conn, recurse=False, ttl=None):
+    """
+    If recurse is set, we will return all items matching this item's prefix
+    We may want validation to ensure we can't dump all of consul's key/value pairs
+    If conn isn't given, the shared connection from get_connection is used
+    Reads go through the consul cache if it is turned on, ttl overrides how long a cached read is trusted
+    Otherwise recursive reads are streamed, see stream_consul_prefix and _stream_result
+    Failed reads come back as an invalid Result, with retry set if they are worth retrying
+    """
+    if conn is None:
+        conn = get_connection()
+
+    c_key = _read_key(s_item, recurse)
+    if c_key is None:
+        return []
+
+    cache = get_cache()
+    try:
+        if cache is None and recurse:
+            streamed = stream_consul_prefix(s_item, conn)
+            # Read up to the first item, so an empty prefix still comes back as invalid
+            first = next(streamed, None)
+            if first is None:
+                return Result(invalid=s_item)
+            return _stream_result(s_item, chain([first], streamed))
+        if cache is not None:
+            index, data = cache.get(conn, c_key, recurse, ttl)
+        else:
+            index, data = conn.kv.get(c_key, recurse=recurse)
+        return _read_result(s_item, data, recurse, conn)
+    except (ConsulException, socket.error) as e:
+        return _failed(s_item, e)
+
+def get_consul_by_prefix(s_item, conn=None):
     """
     Query consul recursively to get anything matching the items's prefix
     """
     return _get_consul(s_item, conn, recurse=True)
 
-def get_consul(s_item, conn=Consul()):
+def get_consul_many(s_items, prefix, conn=None):
+    """
+    Look up many keys under a single prefix with one recursive query, for use as a resolve_layers source
+    Only the items found directly under the prefix are returned, failing to read the prefix raises
+    """
+    if conn is None:
+        conn = get_connection()
+    required = set(x.key for x in s_items)
+    c_prefix = prefix.strip(CONSUL_SEP)
+    res = get_consul_by_prefix(Item(prefix=c_prefix), conn)
+    found = [x for x in res.result or [] if x.prefix == c_prefix and x.key in required]
+    # A failed read would otherwise quietly fall through to the next layer
+    if res.exception is not None:
+        raise res.exception
+    return found
+
+def get_consul(s_item, conn=None):
     """
     Query consul for the prefix and key of the provided item
     """
     return _get_consul(s_item, conn)
 
 
-def put_consul(s_item, conn=Consul()):
+def _value_bytes(value):
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+def _txn_batches(entries, max_ops=TXN_MAX_OPS, max_bytes=TXN_MAX_BYTES, get_operations=None):
+    """
+    Split operations into transactions of at most max_ops operations, and max_bytes of values
+    If the entries aren't operations themselves, get_operations gives the list of operations for each one,
+    Ex: the operations for an item, which are kept in the same transaction
+    """
+    batch = []
+    ops = 0
+    size = 0
+    for entry in entries:
+        operations = get_operations(entry) if get_operations is not None else [entry]
+        op_size = sum(len(x['KV'].get('Value', '')) for x in operations)
+        if batch and (ops + len(operations) > max_ops or size + op_size > max_bytes):
+            yield batch
+            batch = []
+            ops = 0
+            size = 0
+        batch.append(entry)
+        ops += len(operations)
+        size += op_size
+    if batch:
+        yield batch
+
+def _write_chunks(c_key, value, conn, compress=False):
+    """
+    Write a value as chunks under c_key/.chunks/<generation>/ followed by a manifest at c_key
+    The generation is a hash of the stored bytes, so the chunks of the value being replaced are left alone
+    for anyone still reading them. The manifest is written in the last transaction, along with as many chunks as fit
+    (all of them, unless the value is over a few hundred KB), so readers only ever see a complete value
+    Returns the generation written
+    """
+    payload = zlib.compress(value) if compress else value
+    generation = hashlib.sha256(payload).hexdigest()[:16]
+    operations = []
+    for index, start in enumerate(range(0, len(payload), CHUNK_SIZE)):
+        operations.append({'KV': {'Verb': 'set',
+                                  'Key': _chunk_key(c_key, generation, index),
+                                  'Value': b64encode(payload[start:start + CHUNK_SIZE]).decode()}})
+    manifest = {'generation': generation,
+                'chunks': len(operations),
+                'size': len(value),
+                'sha256': hashlib.sha256(value).hexdigest(),
+                'compression': 'zlib' if compress else None}
+    operations.append({'KV': {'Verb': 'set',
+                              'Key': c_key,
+                              'Value': _txn_value(json.dumps(manifest, sort_keys=True)),
+                              'Flags': CHUNKED_FLAG}})
+    # Any failed operation rolls back its whole transaction, and raises before the manifest is written
+    for batch in _txn_batches(operations):
+        conn.txn.put(batch)
+    return generation
+
+def _put_chunked(s_item, conn, compress=False):
+    if conn is None:
+        conn = get_connection()
+    c_key = join_prefix(s_item, CONSUL_SEP).key
+    value = _value_bytes(s_item.value)
+    try:
+        index, previous = conn.kv.get(c_key)
+        if len(value) > CHUNK_THRESHOLD:
+            generation = _write_chunks(c_key, value, conn, compress)
+            raw = True
+        else:
+            generation = None
+            raw = conn.kv.put(c_key, s_item.value)
+    except (ConsulException, socket.error) as e:
+        return _failed(s_item, e)
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(conn, c_key)
+    if not raw:
+        return Result(invalid=s_item)
+    # Clean up the chunks of the value that was replaced
+    old = _manifest(previous)
+    if old is not None and old['generation'] != generation:
+        old_chunks = CONSUL_SEP.join([c_key, CHUNK_DIR, old['generation'], ''])
+        try:
+            conn.kv.delete(old_chunks, recurse=True)
+        except (ConsulException, socket.error) as e:
+            logging.warning('Failed to delete the old chunks under {}: {}'.format(old_chunks, e))
+    return Result(s_item)
+
+def put_consul(s_item, conn=None, chunked=False, compress=False):
     """
     Write an item to consul
+    If chunked is set, values over CHUNK_THRESHOLD bytes are split into chunks (zlib compressed if compress is set)
+    that the consul getters put back together. Smaller values are written as they are either way,
+    but chunked writes need an extra read, to clean up the chunks of the value being replaced
     """
+    if chunked:
+        return _put_chunked(s_item, conn, compress)
     return _put_consul(s_item, conn)
+
+def _txn_value(value):
+    return b64encode(_value_bytes(value)).decode()
+
+def _modify_index(s_item):
+    """
+    The ModifyIndex an item was read with (see _get_consul), or 0 if it wasn't read from consul
+    A check-and-set with an index of 0 only succeeds if the key doesn't exist yet
+    """
+    if isinstance(s_item.extra, dict):
+        return s_item.extra.get('ModifyIndex') or 0
+    return 0
+
+def _txn_clear_chunks(c_key):
+    """
+    Delete any chunks under c_key, so replacing or deleting a chunked value (see put_consul) doesn't leave them behind
+    Consul ignores a delete-tree with nothing under it
+    """
+    return {'KV': {'Verb': 'delete-tree', 'Key': CONSUL_SEP.join([c_key, CHUNK_DIR, ''])}}
+
+def _txn_set(s_item, cas=False):
+    """
+    The operations to write an item in a transaction
+    """
+    operation = {'Verb': 'set',
+                 'Key': join_prefix(s_item, CONSUL_SEP).key,
+                 'Value': _txn_value(s_item.value)}
+    if cas:
+        operation['Verb'] = 'cas'
+        operation['Index'] = _modify_index(s_item)
+    return [{'KV': operation}, _txn_clear_chunks(operation['Key'])]
+
+def _txn_errors(exception):
+    """
+    Rolled back transactions come back as a 409 with the per operation errors in the body,
+    which python-consul raises as a ClientError of '409 <body>'
+    Returns the list of errors, or None if the exception wasn't a rolled back transaction
+    """
+    code, _, body = str(exception).partition(' ')
+    if code != '409':
+        return None
+    try:
+        return json.loads(body).get('Errors') or None
+    except (ValueError, AttributeError):
+        return None
+
+def _run_txn(s_items, operations, conn):
+    """
+    Run the operations for s_items in a single transaction, returning a Result for each item
+    operations[i] is the list of operations for s_items[i]
+    Transactions are all or nothing, so when some operations fail, the rest of the items are retried without them
+    """
+    results = {}
+    pending = list(range(len(s_items)))
+    while pending:
+        # The item each operation in the transaction belongs to, to map errors back to them
+        owners = [x for x in pending for _ in operations[x]]
+        try:
+            raw = conn.txn.put([op for x in pending for op in operations[x]])
+            errors = raw.get('Errors') or []
+        except ConsulException as e:
+            errors = _txn_errors(e)
+            if errors is None:
+                for index in pending:
+                    results[index] = _failed(s_items[index], e)
+                break
+        except socket.error as e:
+            for index in pending:
+                results[index] = _failed(s_items[index], e)
+            break
+        if not errors:
+            for index in pending:
+                results[index] = Result(result=s_items[index], raw=raw)
+            break
+        failed = set()
+        for error in errors:
+            index = owners[error['OpIndex']]
+            failed.add(index)
+            results[index] = Result(invalid=s_items[index],
+                                    exception=ConsulException(error.get('What')),
+                                    raw=error)
+        pending = [x for x in pending if x not in failed]
+    return [results[x] for x in range(len(s_items))]
+
+def _txn_delete(s_item, cas=False):
+    """
+    The operations to delete an item in a transaction
+    """
+    operation = {'Verb': 'delete',
+                 'Key': join_prefix(s_item, CONSUL_SEP).key}
+    if cas:
+        operation['Verb'] = 'delete-cas'
+        operation['Index'] = _modify_index(s_item)
+    return [{'KV': operation}, _txn_clear_chunks(operation['Key'])]
+
+def _txn_many(s_items, make_operations, conn, max_ops):
+    if conn is None:
+        conn = get_connection()
+    pairs = ((x, make_operations(x)) for x in s_items)
+    # Consul limits both the number of operations and the size of a transaction, a few large values can hit either
+    for batch in _txn_batches(pairs, max_ops, TXN_MAX_BYTES, get_operations=lambda x: x[1]):
+        chunk = [x for x, _ in batch]
+        operations = [x for _, x in batch]
+        results = _run_txn(chunk, operations, conn)
+        cache = get_cache()
+        if cache is not None:
+            for item_operations in operations:
+                cache.invalidate(conn, item_operations[0]['KV']['Key'])
+        for res in results:
+            yield res
+
+def put_consul_many(s_items, conn=None, cas=False, max_ops=TXN_MAX_OPS):
+    """
+    Write items to consul in bulk, packing up to max_ops operations (two per item, see _txn_set) and TXN_MAX_BYTES
+    of values into each /v1/txn request
+    Yields a Result for every item, failed operations are mapped back to an invalid Result for their item
+    If cas is set, each write only succeeds if the key's ModifyIndex still matches the one the item was read with
+    """
+    return _txn_many(s_items, partial(_txn_set, cas=cas), conn, max_ops)
+
+def delete_consul_many(s_items, conn=None, cas=False, max_ops=TXN_MAX_OPS):
+    """
+    Delete the keys for items from consul in bulk, the same way put_consul_many writes them
+    If cas is set, a key is only deleted if its ModifyIndex still matches the one the item was read with
+    """
+    return _txn_many(s_items, partial(_txn_delete, cas=cas), conn, max_ops)
+
+def _same_consul_value(s_item, s_existing):
+    # Consul only stores strings, so compare values the way they would be written
+    return _txn_value(s_item.value) == _txn_value(s_existing.value)
+
+def _strip_prefix(s_item):
+    """
+    Drop leading and trailing separators from an item's prefix, the way consul prefixes are read back,
+    Ex: 'dev/app/' becomes 'dev/app', so the item isn't written to dev/app//KEY
+    """
+    if not s_item.prefix:
+        return s_item
+    c_prefix = s_item.prefix.strip(CONSUL_SEP)
+    if c_prefix == s_item.prefix:
+        return s_item
+    return s_item.clone(prefix=c_prefix)
+
+def _read_destination(c_prefix, conn):
+    """
+    Read the keys directly under a prefix in full, so a read that fails part way through is caught too
+    Returns a Result with a list of items (empty if there are none), or the failed read
+    """
+    # Always revalidate a cached read, a stale view of the destination would skip needed writes
+    res = _get_consul(Item(prefix=c_prefix), conn, recurse=True, ttl=0)
+    existing = [x for x in res.result or [] if x.prefix == c_prefix]
+    if res.exception is not None:
+        return res
+    return Result(existing)
+
+def diff_consul(s_items, prefix, conn=None):
+    """
+    Read a consul prefix once, and work out which items would be added, changed, or left unchanged
+    by writing them to it, and which keys directly under the prefix have no matching item (removed)
+    Item prefixes are compared without their leading or trailing separators, the same as prefix
+    Changed items carry the ModifyIndex of the key they replace, for check-and-set writes
+    Transient failures reading the prefix are retried, anything else is raised
+    """
+    c_prefix = prefix.strip(CONSUL_SEP)
+    s_items = list(map(_strip_prefix, s_items))
+    res = retry_call(_read_destination, c_prefix, conn)
+    if res.exception is not None:
+        # Diffing against a destination we couldn't read would rewrite every key, and never delete any
+        raise res.exception
+    existing = res.result
+    diff = diff_items(s_items, existing, same_value=_same_consul_value)
+    lookup = {(x.prefix, x.key): x for x in existing}
+    def with_index(s_item):
+        extra = dict(s_item.extra) if isinstance(s_item.extra, dict) else {}
+        extra['ModifyIndex'] = _modify_index(lookup[(s_item.prefix, s_item.key)])
+        return s_item.clone(extra=extra)
+    diff.changed = [with_index(x) for x in diff.changed]
+    return diff
+
+def apply_consul_diff(diff, conn=None, delete_orphans=False, cas=False, max_ops=TXN_MAX_OPS):
+    """
+    Write only the added and changed items from a diff, and delete the removed keys if delete_orphans is set
+    Yields a Result for every item written or deleted
+    """
+    for res in put_consul_many(chain(diff.added, diff.changed), conn, cas, max_ops):
+        yield res
+    if delete_orphans:
+        for res in delete_consul_many(diff.removed, conn, cas, max_ops):
+            yield res
+
+
+class ConsulSync(object):
+    """
+    Sync items to a consul prefix, only writing the keys that were added or changed
+    Use it as the function for batch_action. The diff from the last call is kept in .diff for reporting
+    If the prefix can't be read, every item comes back as a failed Result, and .diff is None
+    """
+    def __init__(self, prefix, conn=None, delete_orphans=False, cas=False):
+        self.prefix = prefix
+        self.conn = conn
+        self.delete_orphans = delete_orphans
+        self.cas = cas
+        self.diff = None
+        self.__name__ = 'sync_consul'
+    def __call__(self, s_items):
+        s_items = list(s_items)
+        self.diff = None
+        try:
+            self.diff = diff_consul(s_items, self.prefix, self.conn)
+        except (ConsulException, socket.error) as e:
+            # Nothing is written without a diff, so the sync fails as a whole rather than being retried piecemeal
+            logging.error('Failed to read {} to sync it: {}'.format(self.prefix, e))
+            return [Result(invalid=x, exception=e) for x in s_items]
+        return apply_consul_diff(self.diff, self.conn, self.delete_orphans, self.cas)
+    def retry(self, s_items):
+        """
+        Re-submit failed writes and deletes from the last call, without diffing them again (see RetryScheduler)
+        """
+        removed = set((x.prefix, x.key) for x in self.diff.removed)
+        s_items = list(s_items)
+        to_delete = [x for x in s_items if (x.prefix, x.key) in removed]
+        to_put = [x for x in s_items if (x.prefix, x.key) not in removed]
+        return chain(put_consul_many(to_put, self.conn, self.cas),
+                     delete_consul_many(to_delete, self.conn, self.cas))
+
+def sync_consul(s_items, prefix, conn=None, delete_orphans=False, cas=False):
+    """
+    Write only the items that differ from what is already under prefix, see ConsulSync
+    """
+    return ConsulSync(prefix, conn, delete_orphans, cas)(s_items)
+
+
+class WatchEvent(SauronPrimitive):
+    """
+    A change seen by watch_consul_prefix
+      * index: the X-Consul-Index of the read that saw the change
+      * diff: an ItemDiff of the keys that were added, changed, or removed since the last event
+      * store: an ItemStore of every key currently under the prefix
+      * initial: set on the first event, where every key is in diff.added
+    """
+    __slots__ = ['index', 'diff', 'store', 'initial']
+    def __init__(self, index=None, diff=None, store=None, initial=False):
+        self.index = index
+        self.diff = diff
+        self.store = store
+        self.initial = initial
+
+def _backoff(failures, max_backoff=WATCH_MAX_BACKOFF):
+    delay = min(max_backoff, WATCH_MIN_BACKOFF * 2 ** (failures - 1))
+    return random.uniform(delay / 2, delay)
+
+def watch_consul_prefix(s_item, conn=None, wait=WATCH_WAIT, max_backoff=WATCH_MAX_BACKOFF):
+    """
+    Watch the keys directly under the item's prefix with consul blocking queries, yielding a WatchEvent
+    each time any of them change. The first event has the full contents of the prefix.
+    Each query waits until the prefix's X-Consul-Index moves past the last one seen (or for wait),
+    failed queries are retried with a jittered exponential backoff, so this runs until the generator is closed
+    """
+    if conn is None:
+        conn = get_connection()
+    c_prefix = s_item.prefix.strip(CONSUL_SEP)
+    store = ItemStore(sep=CONSUL_SEP)
+    index = None
+    failures = 0
+    initial = True
+    while True:
+        try:
+            new_index, data = conn.kv.get(c_prefix, recurse=True, index=index, wait=wait)
+            # Failed reads raise, so an invalid Result here just means the prefix is empty
+            found = _read_result(Item(prefix=c_prefix), data, recurse=True, conn=conn).result or []
+        except (ConsulException, socket.error) as e:
+            failures += 1
+            delay = _backoff(failures, max_backoff)
+            logging.warning('Watching {} failed ({}), retrying in {:.1f}s'.format(c_prefix, e, delay))
+            time.sleep(delay)
+            continue
+        failures = 0
+        new_index = int(new_index)
+        if index is not None and new_index == index:
+            # The wait ran out without any changes
+            continue
+        current = [x for x in found if x.prefix == c_prefix]
+        diff = diff_items(current, store, same_value=_same_consul_value)
+        for s_removed in diff.removed:
+            store.delete(s_removed)
+        store.update(diff.added)
+        store.update(diff.changed)
+        # The index can go backwards (Ex: after a consul restore), in which case start again from scratch
+        index = new_index if new_index > 0 and (index is None or new_index > index) else None
+        if initial or diff.added or diff.changed or diff.removed:
+            yield WatchEvent(new_index, diff, store, initial)
+            initial = False
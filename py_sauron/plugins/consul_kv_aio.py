@@ -0,0 +1,187 @@
+"""
+asyncio versions of the consul key/value plugins, for reading or writing lots of independent keys at once.
+
+Run them through primitives.item_async.async_item_action to bound how many requests are in flight. Ex:
+
+    async def main(items):
+        try:
+            return await async_item_action(items, [is_consul_prefix, put_consul], concurrency=64)
+        finally:
+            await close_async_connections()
+    asyncio.run(main(items))
+
+The requests are made with aiohttp, using python-consul's endpoints and response handling, so the same
+settings and environment variables as the synchronous plugins apply.
+"""
+import asyncio
+import socket
+import ssl
+from weakref import WeakKeyDictionary
+
+import aiohttp
+from consul import base, ConsulException
+
+from primitives.item_primitives import Result
+from primitives.item_async import DEFAULT_CONCURRENCY
+from plugins.consul_connection import CONNECTIONS
+from plugins.consul_kv import _read_key, _read_result, is_retryable_error, _is_chunk_key, _manifest, _chunk_keys, \
+    _join_chunks, _txn_set
+
+
+class HTTPClient(base.HTTPClient):
+    """
+    aiohttp transport for python-consul. The session is created the first time a request is made,
+    inside the running event loop, and holds at most limit connections open to consul
+    """
+    def __init__(self, *args, limit=DEFAULT_CONCURRENCY, **kwargs):
+        super(HTTPClient, self).__init__(*args, **kwargs)
+        self.limit = limit
+        self.session = None
+    def _ssl(self):
+        if self.scheme != 'https':
+            return None
+        if not self.verify:
+            return False
+        # verify can also be the path to a CA bundle, the same as with requests
+        cafile = self.verify if isinstance(self.verify, str) else None
+        context = ssl.create_default_context(cafile=cafile)
+        if isinstance(self.cert, (tuple, list)):
+            context.load_cert_chain(*self.cert)
+        elif self.cert:
+            context.load_cert_chain(self.cert)
+        return context
+    def _session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, ssl=self._ssl())
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+    async def _request(self, callback, method, uri, data=None):
+        async with self._session().request(method, uri, data=data) as resp:
+            body = await resp.text(encoding='utf-8')
+        if resp.status == 599:
+            raise base.Timeout
+        return callback(base.Response(resp.status, resp.headers, body))
+    def get(self, callback, path, params=None):
+        return self._request(callback, 'GET', self.uri(path, params))
+    def put(self, callback, path, params=None, data=''):
+        return self._request(callback, 'PUT', self.uri(path, params), data=data)
+    def delete(self, callback, path, params=None):
+        return self._request(callback, 'DELETE', self.uri(path, params))
+    def post(self, callback, path, params=None, data=''):
+        return self._request(callback, 'POST', self.uri(path, params), data=data)
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncConsul(base.Consul):
+    """
+    A consul client whose endpoint methods return coroutines, Ex: index, data = await conn.kv.get(key)
+    """
+    def __init__(self, *args, limit=DEFAULT_CONCURRENCY, **kwargs):
+        self.limit = limit
+        super(AsyncConsul, self).__init__(*args, **kwargs)
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return HTTPClient(host, port, scheme, verify, cert, limit=self.limit)
+    async def close(self):
+        await self.http.close()
+
+
+# aiohttp sessions belong to the event loop they were created in, so clients are shared per loop
+_CLIENTS = WeakKeyDictionary()
+
+def get_async_connection(limit=DEFAULT_CONCURRENCY, **overrides):
+    """
+    Get the async consul client for the running event loop, using the settings from configure_connection
+    updated with any overrides. limit caps the number of connections the client opens to consul
+    """
+    loop = asyncio.get_running_loop()
+    settings = dict(CONNECTIONS.defaults, **overrides)
+    client_key = (limit,) + tuple(sorted(settings.items()))
+    clients = _CLIENTS.setdefault(loop, {})
+    conn = clients.get(client_key)
+    if conn is None:
+        conn = clients[client_key] = AsyncConsul(limit=limit, **settings)
+    return conn
+
+async def close_async_connections():
+    """
+    Close the clients created for the running event loop. Call this before the loop finishes
+    """
+    clients = _CLIENTS.pop(asyncio.get_running_loop(), {})
+    for conn in clients.values():
+        await conn.close()
+
+
+REQUEST_ERRORS = (ConsulException, aiohttp.ClientError, asyncio.TimeoutError, socket.error)
+
+def _failed(s_item, exception):
+    # aiohttp's errors are all connection or payload failures, the same as socket errors for the sync client
+    retry = is_retryable_error(exception) or isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError))
+    return Result(invalid=s_item, exception=exception, retry=retry)
+
+async def _put_consul(s_item, conn):
+    if conn is None:
+        conn = get_async_connection()
+    # A transaction rather than a plain put, so the chunks of a chunked value being replaced go with it
+    try:
+        raw = await conn.txn.put(_txn_set(s_item))
+    except REQUEST_ERRORS as e:
+        return _failed(s_item, e)
+    if raw.get('Errors'):
+        return Result(invalid=s_item, raw=raw)
+    return Result(s_item, raw=raw)
+
+async def _fetch_chunks(record, conn, found):
+    """
+    Resolve a record to its full value if it holds a chunked value's manifest, fetching any chunks
+    that weren't part of the read concurrently
+    """
+    manifest = _manifest(record)
+    if manifest is None:
+        return record
+    keys = _chunk_keys(record, manifest)
+    missing = [x for x in keys if x not in found]
+    fetched = await asyncio.gather(*[conn.kv.get(x) for x in missing])
+    found = dict(found, **{c_key: data for c_key, (index, data) in zip(missing, fetched)})
+    return _join_chunks(record, manifest, [found.get(x) for x in keys])
+
+async def _resolve_chunks(data, conn, recurse):
+    if not data:
+        return data
+    if not recurse:
+        return await _fetch_chunks(data, conn, {})
+    chunks = {x['Key']: x for x in data if _is_chunk_key(x['Key'])}
+    return [await _fetch_chunks(x, conn, chunks) for x in data if not _is_chunk_key(x['Key'])]
+
+async def _get_consul(s_item, conn, recurse=False):
+    if conn is None:
+        conn = get_async_connection()
+    c_key = _read_key(s_item, recurse)
+    if c_key is None:
+        return []
+    try:
+        index, data = await conn.kv.get(c_key, recurse=recurse)
+        data = await _resolve_chunks(data, conn, recurse)
+    except REQUEST_ERRORS as e:
+        return _failed(s_item, e)
+    return _read_result(s_item, data, recurse)
+
+async def get_consul_by_prefix(s_item, conn=None):
+    """
+    Query consul recursively to get anything matching the items's prefix
+    """
+    return await _get_consul(s_item, conn, recurse=True)
+
+async def get_consul(s_item, conn=None):
+    """
+    Query consul for the prefix and key of the provided item
+    """
+    return await _get_consul(s_item, conn)
+
+async def put_consul(s_item, conn=None):
+    """
+    Write an item to consul
+    """
+    return await _put_consul(s_item, conn)
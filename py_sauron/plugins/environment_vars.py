@@ -22,3 +22,16 @@ def lookup_env(s_item):
     if d_item.value:
         return Result(result=d_item)
     return Result(invalid=d_item)
+
+def lookup_env_many(s_items, env_prefix=''):
+    """
+    Lookup many items from the shell environment variables at once, for use as a resolve_layers source
+    env_prefix is added to the front of each key (Ex: 'bamboo_'). Only the items that are set are returned
+    """
+    environ_vars = os.environ
+    found = []
+    for s_item in s_items:
+        env_key = '{}{}'.format(env_prefix, join_prefix(s_item, sep='_').key)
+        if env_key in environ_vars:
+            found.append(s_item.clone(value=environ_vars[env_key]))
+    return found
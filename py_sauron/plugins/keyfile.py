@@ -1,51 +1,60 @@
-from itertools import chain, tee
 import re
 
 from utils import filter_both
-from primitives.item_primitives import Result, join_prefix
+from primitives.item_primitives import Item, Result, join_prefix
 
 def _keyfile_valid_key(s_item):
     valid_regex = r'^[0-9A-Z\_]+$'
     return re.match(valid_regex, s_item.key)
 
-def _valid_prefix(s_item):
-    if s_item.prefix is not None:
-        return True
-    return False
+def _keyfile_valid_item(s_item):
+    return s_item.prefix is None and _keyfile_valid_key(s_item)
 
 def serialize_keyfile(s_items, seperator='='):
-    no_prefix, has_prefix = filter_both(lambda x: x.prefix is None, s_items)
-    valid_keys, invalid_keys = filter_both(_keyfile_valid_key, no_prefix)
-    valid, result = tee(valid_keys)
-    invalid = chain(has_prefix, invalid_keys)
+    valid_items, invalid = filter_both(_keyfile_valid_item, s_items)
+    # The output needs every valid item anyway, so collect them once and reuse them for the result
+    valid = list(valid_items)
     to_lines = map(lambda x: '{}{}{}'.format(x.key,
                                              seperator,
                                              x.value), valid)
     output = '\n'.join(to_lines)
-    return Result(result=result,
+    return Result(result=valid,
                   invalid=invalid,
                   output=output)
 
 def serialize_shell(items):
     key_valid, key_invalid = filter_both(_keyfile_valid_key, items)
-    no_prefix, has_prefix = filter_both(lambda x: x.prefix is None, key_valid)
-    valid_prefix, invalid_prefix = filter_both(_valid_prefix, has_prefix)
 
     # If we had a valid prefix and a valid key, join them together to make a valid item
-    joined_prefixes = map(join_prefix, valid_prefix)
-
-    # Join all our valid results together and join our invalid results together
-    valid, result = tee(chain(no_prefix, joined_prefixes))
-    invalid = chain(key_invalid, has_prefix)
+    valid = list(map(join_prefix, key_valid))
 
     # prepare an output with all of our valid items
     to_lines = map(lambda x: 'export {}={}'.format(x.key, x.value), valid)
     output = '\n'.join(to_lines)
 
-    return Result(result=result,
-                  invalid=invalid,
+    return Result(result=valid,
+                  invalid=key_invalid,
                   output=output)
 
+def read_keyfile(infile, seperator='='):
+    """
+    Read the items from a keyfile, the KEY=value lines written by serialize_keyfile (or serialize_shell)
+    Blank lines and # comments are skipped. Later lines for the same key win, the same as when the file is sourced
+    Raises a ValueError for any other line
+    """
+    items = []
+    for number, line in enumerate(infile, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[len('export '):]
+        key, found, value = line.partition(seperator)
+        if not found or not re.match(r'^[0-9A-Za-z\_]+$', key):
+            raise ValueError('Invalid keyfile line {}: {}'.format(number, line))
+        items.append(Item(key=key, value=value))
+    return items
+
 def write_keyfiles(items,
                    destination,
                    overwrite=True):
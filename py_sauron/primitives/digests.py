@@ -0,0 +1,72 @@
+"""
+Compact digests of item attributes, used to remember which items have been seen in a stream
+without holding on to the items themselves.
+"""
+from hashlib import blake2b
+import os
+import sqlite3
+from tempfile import mkstemp
+
+KEY_DIGEST_SIZE = 16
+VALUE_DIGEST_SIZE = 8
+
+
+def key_digest(*parts):
+    return blake2b(repr(parts).encode(), digest_size=KEY_DIGEST_SIZE).digest()
+
+def value_digest(value):
+    return blake2b(repr(value).encode(), digest_size=VALUE_DIGEST_SIZE).digest()
+
+
+class DigestTable(object):
+    """
+    A mapping of key digests to value digests.
+    If max_entries is set, the table holds at most that many entries in memory. Once it is full,
+    the entries are spilled to an sqlite database in spill_dir (or the default temp directory)
+    and later lookups check both.
+    """
+    __slots__ = ['memory', 'max_entries', 'spill_dir', 'db', 'db_path']
+    def __init__(self, max_entries=None, spill_dir=None):
+        self.memory = {}
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.db = None
+        self.db_path = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def _open_db(self):
+        handle, self.db_path = mkstemp(prefix='sauron-digests-', suffix='.sqlite', dir=self.spill_dir)
+        os.close(handle)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE digests (key BLOB PRIMARY KEY, value BLOB) WITHOUT ROWID')
+    def _spill(self):
+        if self.db is None:
+            self._open_db()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?)', self.memory.items())
+        self.memory = {}
+    def get(self, s_key):
+        """
+        Return the value digest stored for s_key, or None if it hasn't been seen
+        """
+        found = self.memory.get(s_key)
+        if found is None and self.db is not None:
+            row = self.db.execute('SELECT value FROM digests WHERE key = ?', (s_key,)).fetchone()
+            if row is not None:
+                found = row[0]
+        return found
+    def add(self, s_key, s_value=b''):
+        self.memory[s_key] = s_value
+        if self.max_entries is not None and len(self.memory) >= self.max_entries:
+            self._spill()
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = None
+            self.db_path = None
+        self.memory = {}
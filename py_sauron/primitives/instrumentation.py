@@ -0,0 +1,157 @@
+"""
+Opt in timing and outcome counts for the actions run by item_action and operate.
+
+Instrumentation is off by default. Pipelines check whether it is enabled once, when they are compiled,
+so leaving it off costs nothing per item.
+"""
+from contextlib import contextmanager
+from inspect import iscoroutinefunction
+import json
+import random
+from time import perf_counter
+
+MAX_SAMPLES = 2048
+PERCENTILES = [50, 90, 99]
+
+
+class ActionStats(object):
+    """
+    Call counts and latency for a single action. Latency percentiles are calculated from a
+    reservoir sample of at most MAX_SAMPLES calls, so memory use doesn't grow with the number of items
+    """
+    __slots__ = ['name', 'calls', 'valid', 'invalid', 'exceptions', 'total_seconds', 'samples']
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.valid = 0
+        self.invalid = 0
+        self.exceptions = 0
+        self.total_seconds = 0.0
+        self.samples = []
+    def record(self, seconds, outcome):
+        self.calls += 1
+        self.total_seconds += seconds
+        if outcome == 'valid':
+            self.valid += 1
+        elif outcome == 'invalid':
+            self.invalid += 1
+        else:
+            self.exceptions += 1
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            slot = random.randrange(self.calls)
+            if slot < MAX_SAMPLES:
+                self.samples[slot] = seconds
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+    def summary(self):
+        summary = {'calls': self.calls,
+                   'valid': self.valid,
+                   'invalid': self.invalid,
+                   'exceptions': self.exceptions,
+                   'total_seconds': self.total_seconds,
+                   'mean_seconds': self.total_seconds / self.calls if self.calls else None}
+        for pct in PERCENTILES:
+            summary['p{}_seconds'.format(pct)] = self.percentile(pct)
+        return summary
+
+
+class Instrumentation(object):
+    """
+    Collection of ActionStats keyed by action name. Actions with the same name share their stats,
+    so the same action used in multiple pipelines is reported once
+    """
+    def __init__(self):
+        self.enabled = False
+        self.actions = {}
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+    def reset(self):
+        self.actions = {}
+    def stats_for(self, name):
+        stats = self.actions.get(name)
+        if stats is None:
+            stats = self.actions[name] = ActionStats(name)
+        return stats
+    def wrap(self, name, action, classify):
+        """
+        Wrap an action so each call is timed, and its return value is classified as 'valid' or 'invalid'
+        Exceptions are counted and re-raised. Coroutine functions are timed until they complete
+        """
+        stats = self.stats_for(name)
+        if iscoroutinefunction(action):
+            async def timed_async(s_obj):
+                start = perf_counter()
+                try:
+                    res = await action(s_obj)
+                except Exception:
+                    stats.record(perf_counter() - start, 'exception')
+                    raise
+                stats.record(perf_counter() - start, classify(res))
+                return res
+            timed_async.__name__ = name
+            return timed_async
+        def timed(s_obj):
+            start = perf_counter()
+            try:
+                res = action(s_obj)
+            except Exception:
+                stats.record(perf_counter() - start, 'exception')
+                raise
+            stats.record(perf_counter() - start, classify(res))
+            return res
+        timed.__name__ = name
+        return timed
+    def wrap_stream(self, name, s_objs, classify):
+        """
+        Time how long each result takes to come out of a stream, Ex: the results of a bulk action
+        """
+        stats = self.stats_for(name)
+        s_objs = iter(s_objs)
+        while True:
+            start = perf_counter()
+            try:
+                res = next(s_objs)
+            except StopIteration:
+                return
+            except Exception:
+                stats.record(perf_counter() - start, 'exception')
+                raise
+            stats.record(perf_counter() - start, classify(res))
+            yield res
+    @contextmanager
+    def timer(self, name):
+        """
+        Time a block of code (Ex: reading from a source) as a single call
+        Does nothing if instrumentation isn't enabled
+        """
+        if not self.enabled:
+            yield
+            return
+        stats = self.stats_for(name)
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            stats.record(perf_counter() - start, 'exception')
+            raise
+        stats.record(perf_counter() - start, 'valid')
+    def summary(self):
+        return {name: stats.summary() for name, stats in self.actions.items()}
+    def write_summary(self, destination):
+        with open(destination, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+INSTRUMENTATION = Instrumentation()
+
+def enable_instrumentation():
+    INSTRUMENTATION.enable()
+    return INSTRUMENTATION
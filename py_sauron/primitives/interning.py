@@ -0,0 +1,26 @@
+"""
+Flyweight storage for prefix and key strings.
+
+Large consul and cloudformation reads produce the same prefixes (Ex: 'Outputs', stack names, shared
+consul directories) over and over. Interning them means every item with the same prefix shares a single
+string instead of holding its own copy.
+"""
+from sys import intern
+
+_enabled = True
+
+
+def set_interning(enabled):
+    """
+    Turn interning on or off, mainly so its effect can be measured
+    """
+    global _enabled
+    _enabled = enabled
+
+def intern_str(value):
+    """
+    Return the shared copy of a string. Anything that isn't a string is returned untouched
+    """
+    if _enabled and type(value) is str:
+        return intern(value)
+    return value
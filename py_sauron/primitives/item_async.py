@@ -0,0 +1,86 @@
+"""
+asyncio versions of the item pipelines, for actions that spend most of their time waiting on the network.
+
+Actions can be plain functions or coroutine functions. Items are run through the pipeline concurrently,
+with at most `concurrency` of them in flight at once, so thousands of independent lookups or writes
+overlap their waits instead of running one after another.
+"""
+import asyncio
+from inspect import isawaitable
+
+from primitives.item_primitives import Result, Item, accept_none_items, compile_actions, make_valid
+
+DEFAULT_CONCURRENCY = 32
+
+
+class AsyncPipeline(object):
+    """
+    A CompiledPipeline that awaits any action returning an awaitable
+    Calling it on an item has the same result as calling the CompiledPipeline, and shares its stage counts
+    """
+    __slots__ = ['pipeline']
+    def __init__(self, actions):
+        self.pipeline = compile_actions(actions)
+    async def __call__(self, s_obj):
+        # Mirrors CompiledPipeline.__call__
+        if isinstance(s_obj, Result):
+            if not s_obj.result:
+                return s_obj
+            target = s_obj.result
+        elif isinstance(s_obj, Item):
+            target = s_obj
+        else:
+            return s_obj
+        passed = self.pipeline.passed
+        rejected = self.pipeline.rejected
+        for index, action in enumerate(self.pipeline.stages):
+            s_obj = action(target)
+            if isawaitable(s_obj):
+                s_obj = await s_obj
+            if isinstance(s_obj, Result):
+                if not s_obj.result:
+                    rejected[index] += 1
+                    return s_obj
+                target = s_obj.result
+            elif isinstance(s_obj, Item):
+                target = s_obj
+            else:
+                passed[index] += 1
+                return s_obj
+            passed[index] += 1
+        return s_obj
+    async def run(self, s_items, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Run every item through the pipeline, with at most concurrency items in flight
+        Returns a list of the results, in the same order as s_items
+        """
+        results = []
+        s_items = iter(s_items)
+        async def worker():
+            # Workers share the iterator, each one takes the next item as soon as it is free
+            for s_item in s_items:
+                index = len(results)
+                results.append(None)
+                results[index] = await self(s_item)
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        return results
+    def stats(self):
+        return self.pipeline.stats()
+
+
+def compile_async_actions(actions=[make_valid]):
+    return AsyncPipeline(actions)
+
+@accept_none_items
+async def async_item_action(s_items, actions=[make_valid], concurrency=DEFAULT_CONCURRENCY):
+    """
+    The async version of item_action. Actions may be coroutine functions, Ex: the getters in plugins.consul_kv_aio
+    Unlike item_action this isn't lazy, the items are all processed before the list of results is returned
+    """
+    return await compile_async_actions(actions).run(s_items, concurrency)
@@ -0,0 +1,177 @@
+"""
+Columnar storage for large numbers of items.
+
+An ItemBatch holds the prefix, key, value and extra attributes of many items as parallel lists
+instead of one Item object per value. The batch_* operations work on whole columns at once, so
+transforming a batch only allocates new column lists rather than a new Item for every element.
+"""
+from itertools import repeat
+
+from primitives.item_primitives import Item, Result, SauronPrimitive, accept_none_items
+from primitives.interning import intern_str
+
+
+class ItemView(Item):
+    """
+    A thin, read only view of a single row in an ItemBatch.
+    It behaves like an Item for comparisons, hashing and clone(), so Item-at-a-time code
+    (item_action, plugins, etc) can consume a batch without converting it first
+    """
+    __slots__ = ['batch', 'index']
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+    @property
+    def key(self):
+        return self.batch.keys[self.index]
+    @property
+    def value(self):
+        return self.batch.values[self.index]
+    @property
+    def prefix(self):
+        return self.batch.prefixes[self.index]
+    @property
+    def extra(self):
+        return self.batch.extras[self.index]
+    def materialize(self):
+        """
+        Return a standalone Item with the same attributes as this row
+        """
+        return Item(key=self.key, value=self.value, prefix=self.prefix, extra=self.extra)
+    def clone(self, key=None, value=None, prefix=None, extra=None, drop=[]):
+        return self.materialize().clone(key=key, value=value, prefix=prefix, extra=extra, drop=drop)
+
+
+class ItemBatch(SauronPrimitive):
+    """
+    A batch of items stored as parallel columns.
+    Prefixes and keys are interned so repeated strings (Ex: 'Outputs' or a shared consul directory)
+    are only stored once
+    """
+    __slots__ = ['prefixes', 'keys', 'values', 'extras']
+    def __init__(self, prefixes=None, keys=None, values=None, extras=None):
+        columns = [None if x is None else list(x) for x in (prefixes, keys, values, extras)]
+        size = max([len(x) for x in columns if x is not None] or [0])
+        prefixes, keys, values, extras = [[None] * size if x is None else x for x in columns]
+        self.prefixes = list(map(intern_str, prefixes))
+        self.keys = list(map(intern_str, keys))
+        self.values = values
+        self.extras = extras
+        if not len(self.prefixes) == len(self.keys) == len(self.values) == len(self.extras):
+            raise ValueError('ItemBatch columns must all be the same length')
+    @classmethod
+    def from_items(cls, s_items):
+        """
+        Build a batch from any iterable of Items
+        """
+        prefixes = []
+        keys = []
+        values = []
+        extras = []
+        for s_item in s_items:
+            prefixes.append(s_item.prefix)
+            keys.append(s_item.key)
+            values.append(s_item.value)
+            extras.append(s_item.extra)
+        return cls(prefixes, keys, values, extras)
+    def _with_columns(self, prefixes=None, keys=None, values=None, extras=None):
+        """
+        Make a new batch sharing any column that wasn't replaced
+        Columns passed in are assumed to already be interned
+        """
+        n_batch = self.__class__.__new__(self.__class__)
+        n_batch.prefixes = self.prefixes if prefixes is None else prefixes
+        n_batch.keys = self.keys if keys is None else keys
+        n_batch.values = self.values if values is None else values
+        n_batch.extras = self.extras if extras is None else extras
+        return n_batch
+    def __len__(self):
+        return len(self.keys)
+    def __iter__(self):
+        """
+        Iterate over the batch as ItemViews, this keeps item-at-a-time code working
+        """
+        return map(ItemView, repeat(self), range(len(self)))
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ItemBatch index out of range')
+        return ItemView(self, index)
+    def __repr__(self):
+        return '{} {}'.format(self.__class__.__name__, {'size': len(self)})
+    def items(self):
+        """
+        Materialize the batch into a list of standalone Items
+        """
+        return [Item(key=k, value=v, prefix=p, extra=e)
+                for p, k, v, e in zip(self.prefixes, self.keys, self.values, self.extras)]
+    def select(self, mask):
+        """
+        Return a new batch made of the rows where mask is truthy
+        """
+        rows = [i for i, keep in enumerate(mask) if keep]
+        return self.take(rows)
+    def take(self, rows):
+        """
+        Return a new batch made of the given row indexes
+        """
+        return self._with_columns(prefixes=[self.prefixes[i] for i in rows],
+                                  keys=[self.keys[i] for i in rows],
+                                  values=[self.values[i] for i in rows],
+                                  extras=[self.extras[i] for i in rows])
+
+
+@accept_none_items
+def to_batch(s_items):
+    """
+    Convert an iterable of items into an ItemBatch. Batches are passed through unchanged
+    """
+    if isinstance(s_items, ItemBatch):
+        return s_items
+    return ItemBatch.from_items(s_items)
+
+def batch_join_prefix(s_batch, sep=''):
+    """
+    Batch version of join_prefix. Every row with a prefix has it joined onto the key
+    """
+    keys = [k if p is None else '{}{}{}'.format(p, sep, k)
+            for p, k in zip(s_batch.prefixes, s_batch.keys)]
+    return s_batch._with_columns(prefixes=[None] * len(s_batch), keys=keys)
+
+def batch_split_by_sep(s_batch, sep):
+    """
+    Batch version of split_by_sep.
+    Rows that already have a prefix can't be split, and are returned in the invalid batch
+    """
+    valid_rows = []
+    invalid_rows = []
+    prefixes = []
+    keys = []
+    for row, (prefix, key) in enumerate(zip(s_batch.prefixes, s_batch.keys)):
+        if prefix is not None:
+            invalid_rows.append(row)
+            continue
+        spl = key.split(sep)
+        valid_rows.append(row)
+        prefixes.append(intern_str(sep.join(spl[:-1])))
+        keys.append(intern_str(spl[-1]))
+    valid = s_batch._with_columns(prefixes=prefixes,
+                                  keys=keys,
+                                  values=[s_batch.values[i] for i in valid_rows],
+                                  extras=[s_batch.extras[i] for i in valid_rows])
+    if invalid_rows:
+        return Result(result=valid, invalid=s_batch.take(invalid_rows))
+    return Result(result=valid)
+
+def batch_new_prefix(s_batch, prefix):
+    """
+    Batch version of new_prefix, every row shares the same interned prefix
+    """
+    return s_batch._with_columns(prefixes=[intern_str(prefix)] * len(s_batch))
+
+def batch_drop_prefix(s_batch):
+    """
+    Batch version of drop_prefix
+    """
+    return s_batch._with_columns(prefixes=[None] * len(s_batch))
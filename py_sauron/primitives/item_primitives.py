@@ -1,8 +1,10 @@
-from itertools import groupby
-from functools import reduce, wraps
-from collections import defaultdict
+from functools import partial, wraps
+from itertools import chain
 
-from utils import filter_both
+from utils import partition
+from primitives.digests import DigestTable, key_digest, value_digest
+from primitives.instrumentation import INSTRUMENTATION
+from primitives.interning import intern_str
 
 class SauronPrimitive(object):
     """
@@ -51,6 +53,14 @@ class Result(SauronPrimitive):
         self.exception = exception
         self.retry = retry
         self.output = output
+    @classmethod
+    def partition(cls, pred, s_items):
+        """
+        Lazily split items into a Result, with the items matching pred as the result and the rest as invalid
+        pred is only called once per item, and neither side is fully buffered, see utils.partition
+        """
+        match, no_match = partition(pred, s_items)
+        return cls(result=match, invalid=no_match)
 
 
 class Item(SauronPrimitive):
@@ -61,8 +71,11 @@ class Item(SauronPrimitive):
     def __init__(self, key=None, value=None, prefix=None, extra=None):
         self.key = key
         self.value = value
-        self.prefix = prefix
+        self.prefix = intern_str(prefix)
         self.extra = extra
+    def __repr__(self):
+        rep = {x: getattr(self, x) for x in Item.__slots__ if getattr(self, x)}
+        return '{} {}'.format(self.__class__.__name__, rep)
     def __eq__(self, other):
         return (self.prefix, self.key, self.value) == (other.prefix, other.key, other.value)
     def __ne__(self, other):
@@ -99,7 +112,7 @@ class Item(SauronPrimitive):
             n_prefix = self.prefix
         if extra:
             n_extra = extra
-        elif 'extra' in 'drop':
+        elif 'extra' in drop:
             n_extra = None
         else:
             n_extra = self.extra
@@ -109,6 +122,103 @@ class Item(SauronPrimitive):
                      prefix=n_prefix,
                      extra=n_extra)
 
+class FrozenItem(Item):
+    """
+    Immutable Item. The sort key and hash are calculated once when the item is created, which keeps
+    dedup, sorting, and set based comparisons of large numbers of items cheap. The value has to be hashable.
+    Since it can't change, clone() and evolve() return the same object when nothing would change
+    """
+    __slots__ = ['sort_key', '_hash']
+    def __init__(self, key=None, value=None, prefix=None, extra=None):
+        prefix = intern_str(prefix)
+        set_attr = object.__setattr__
+        set_attr(self, 'key', key)
+        set_attr(self, 'value', value)
+        set_attr(self, 'prefix', prefix)
+        set_attr(self, 'extra', extra)
+        sort_key = (prefix, key, value)
+        set_attr(self, 'sort_key', sort_key)
+        set_attr(self, '_hash', hash(sort_key))
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+    def __eq__(self, other):
+        if isinstance(other, FrozenItem):
+            return self._hash == other._hash and self.sort_key == other.sort_key
+        return Item.__eq__(self, other)
+    def __lt__(self, other):
+        if isinstance(other, FrozenItem):
+            return self.sort_key < other.sort_key
+        return Item.__lt__(self, other)
+    def __gt__(self, other):
+        if isinstance(other, FrozenItem):
+            return self.sort_key > other.sort_key
+        return Item.__gt__(self, other)
+    def __hash__(self):
+        return self._hash
+    def __reduce__(self):
+        return (self.__class__, (self.key, self.value, self.prefix, self.extra))
+    def clone(self, key=None, value=None, prefix=None, extra=None, drop=[]):
+        """
+        Same as Item.clone, but returns this item if nothing changes
+        """
+        if not (key or value or prefix or extra or drop):
+            return self
+        return Item.clone(self, key=key, value=value, prefix=prefix, extra=extra, drop=drop)
+    def evolve(self, **changes):
+        """
+        Return an item with the given attributes replaced. Unlike clone, attributes can be set to None or ''
+        Unchanged attributes are shared with this item, and if nothing changes this item is returned
+        """
+        fields = {'key': self.key, 'value': self.value, 'prefix': self.prefix, 'extra': self.extra}
+        for name, n_value in changes.items():
+            if name not in fields:
+                raise TypeError('{} has no attribute {}'.format(self.__class__.__name__, name))
+            fields[name] = n_value
+        if all(fields[x] is getattr(self, x) for x in changes):
+            return self
+        return self.__class__(**fields)
+
+def freeze(s_item):
+    """
+    Make a FrozenItem out of an item, FrozenItems are returned as is
+    """
+    if isinstance(s_item, FrozenItem):
+        return s_item
+    return FrozenItem(key=s_item.key, value=s_item.value, prefix=s_item.prefix, extra=s_item.extra)
+
+def evolve_items(s_items, **changes):
+    """
+    Bulk version of FrozenItem.evolve, the same changes are applied to every item
+    Plain Items are frozen with the changes already applied, rather than frozen and then evolved
+    """
+    for name in changes:
+        if name not in Item.__slots__:
+            raise TypeError('FrozenItem has no attribute {}'.format(name))
+    evolved = []
+    for s_item in s_items:
+        if isinstance(s_item, FrozenItem):
+            evolved.append(s_item.evolve(**changes))
+        else:
+            fields = {'key': s_item.key, 'value': s_item.value, 'prefix': s_item.prefix, 'extra': s_item.extra}
+            fields.update(changes)
+            evolved.append(FrozenItem(**fields))
+    return evolved
+
+def pure_action(func):
+    """
+    Mark an action as a pure transform. Pure actions only look at the item they are given and
+    don't talk to the outside world, so compile_actions is free to fuse adjacent ones together
+    """
+    func.pure = True
+    return func
+
+def is_pure_action(action):
+    if isinstance(action, partial):
+        return is_pure_action(action.func)
+    return getattr(action, 'pure', False)
+
 def accept_none_item(func):
     @wraps(func)
     def wrapped(s_item, *args, **kwargs):
@@ -125,6 +235,7 @@ def accept_none_items(func):
         return func(s_items, *args, **kwargs)
     return wrapped
 
+@pure_action
 @accept_none_item
 def join_prefix(s_item, sep=''):
     prefix = s_item.prefix
@@ -135,6 +246,7 @@ def join_prefix(s_item, sep=''):
         n_item = s_item
     return n_item
 
+@pure_action
 @accept_none_item
 def split_prefix(s_item, prefix, sep=''):
     """
@@ -149,6 +261,7 @@ def split_prefix(s_item, prefix, sep=''):
     n_item = s_item.clone(key=n_key, prefix=prefix)
     return n_item
 
+@pure_action
 @accept_none_item
 def split_by_sep(s_item, sep):
     """
@@ -161,38 +274,177 @@ def split_by_sep(s_item, sep):
     if prefix is not None:
         return Result(invalid=s_item)
     spl = key.split(sep)
-    n_key = spl[-1]
+    # The same key names show up under lots of prefixes (Ex: consul directories), so share them
+    n_key = intern_str(spl[-1])
     n_prefix = sep.join(spl[:-1])
     n_item = s_item.clone(key=n_key,
                           prefix=n_prefix)
     return n_item
 
+@pure_action
 @accept_none_item
 def new_prefix(s_item, prefix):
     n_item = s_item.clone(prefix=prefix)
     return n_item
 
+@pure_action
 @accept_none_item
 def drop_prefix(s_item):
     n_item = s_item.clone(drop='prefix')
     return n_item
 
+@pure_action
 @accept_none_item
 def drop_value(s_item):
     return s_item.clone(drop='value')
 
+@pure_action
 @accept_none_item
 def make_valid(s_item):
     return Result(result=s_item)
 
+@pure_action
 @accept_none_item
 def make_invalid(s_item):
     return Result(invalid=s_item)
 
+def action_name(action):
+    if isinstance(action, partial):
+        return action_name(action.func)
+    return getattr(action, '__name__', repr(action))
+
+def _fuse_actions(actions):
+    """
+    Compose a run of pure actions into a single action, unwrapping results between them
+    """
+    if len(actions) == 1:
+        return actions[0]
+    def fused(s_obj):
+        for action in actions:
+            if isinstance(s_obj, Result):
+                if not s_obj.result:
+                    return s_obj
+                s_obj = action(s_obj.result)
+            elif isinstance(s_obj, Item):
+                s_obj = action(s_obj)
+            else:
+                return s_obj
+        return s_obj
+    fused.__name__ = '+'.join(map(action_name, actions))
+    return fused
+
+def _outcome(s_obj):
+    if isinstance(s_obj, Result) and not s_obj.result:
+        return 'invalid'
+    return 'valid'
+
+def _instrument(action):
+    timed = INSTRUMENTATION.wrap(action_name(action), action, _outcome)
+    timed.pure = is_pure_action(action)
+    return timed
+
+class StageStats(SauronPrimitive):
+    """
+    Count of the items that made it through (passed) or were stopped by (rejected) a pipeline stage
+    """
+    __slots__ = ['name', 'passed', 'rejected']
+    def __init__(self, name=None, passed=0, rejected=0):
+        self.name = name
+        self.passed = passed
+        self.rejected = rejected
+
+class CompiledPipeline(object):
+    """
+    A list of actions compiled into a single callable. Calling it on an item has the same result as
+    folding action_on_result over the actions, but adjacent pure actions are fused into one stage,
+    and an invalid result stops the pipeline immediately instead of being passed along to every
+    remaining action.
+    """
+    __slots__ = ['stages', 'names', 'passed', 'rejected']
+    def __init__(self, actions):
+        if INSTRUMENTATION.enabled:
+            actions = [_instrument(x) for x in actions]
+        stages = []
+        pure_run = []
+        for action in actions:
+            if is_pure_action(action):
+                pure_run.append(action)
+                continue
+            if pure_run:
+                stages.append(_fuse_actions(pure_run))
+                pure_run = []
+            stages.append(action)
+        if pure_run:
+            stages.append(_fuse_actions(pure_run))
+        self.stages = stages
+        self.names = [action_name(x) for x in stages]
+        self.passed = [0] * len(stages)
+        self.rejected = [0] * len(stages)
+    def __call__(self, s_obj):
+        if isinstance(s_obj, Result):
+            if not s_obj.result:
+                return s_obj
+            target = s_obj.result
+        elif isinstance(s_obj, Item):
+            target = s_obj
+        else:
+            return s_obj
+        passed = self.passed
+        rejected = self.rejected
+        for index, action in enumerate(self.stages):
+            s_obj = action(target)
+            if isinstance(s_obj, Result):
+                if not s_obj.result:
+                    rejected[index] += 1
+                    return s_obj
+                target = s_obj.result
+            elif isinstance(s_obj, Item):
+                target = s_obj
+            else:
+                # Just drop it through if we don't specifically know how to handle it.
+                passed[index] += 1
+                return s_obj
+            passed[index] += 1
+        return s_obj
+    def run(self, s_items):
+        return map(self, s_items)
+    def stats(self):
+        """
+        Per stage counts of passed and rejected items
+        """
+        return [StageStats(name, passed, rejected)
+                for name, passed, rejected in zip(self.names, self.passed, self.rejected)]
+
+def compile_actions(actions=[make_valid]):
+    """
+    Compile a list of actions once, so it can be applied to a large number of items
+    """
+    return CompiledPipeline(actions)
+
 @accept_none_items
 def item_action(s_items, actions=[make_valid]):
-    per_item = lambda elem: reduce(lambda l, r: action_on_result(r, l), actions, elem)
-    return map(per_item, s_items)
+    return compile_actions(actions).run(s_items)
+
+def _has_result(s_obj):
+    if isinstance(s_obj, Result):
+        return bool(s_obj.result)
+    return isinstance(s_obj, Item)
+
+def _unwrap(s_obj):
+    if isinstance(s_obj, Result):
+        return s_obj.result
+    return s_obj
+
+def batch_action(s_objs, batch_func):
+    """
+    Hand every valid item in a stream of items and results (Ex: the output of item_action) to a function
+    that handles them in bulk, like put_consul_many. Invalid results are passed through untouched
+    """
+    valid, passthrough = partition(_has_result, s_objs)
+    results = batch_func(map(_unwrap, valid))
+    if INSTRUMENTATION.enabled:
+        results = INSTRUMENTATION.wrap_stream(action_name(batch_func), results, _outcome)
+    return chain(results, passthrough)
 
 def action_on_result(pred, s_obj):
     if isinstance(s_obj, Result):
@@ -206,25 +458,47 @@ def action_on_result(pred, s_obj):
 
 @accept_none_items
 def get_by_prefix(s_items, prefix):
-    result, invalid = filter_both(lambda x: x.prefix == prefix, s_items)
-    return Result(result=result,
-                  invalid=invalid)
+    return Result.partition(lambda x: x.prefix == prefix, s_items)
+
+def dedup_stream(s_items, max_entries=None, spill_dir=None):
+    """
+    Single pass dedup of a (possibly unsorted) stream of items, keyed on prefix and key
+    Yields a valid Result the first time a prefix/key is seen, nothing for exact duplicates,
+    and an invalid Result for any item whose value conflicts with the first one seen.
+    Only a digest of each prefix/key and value is kept, see DigestTable for spilling to disk
+    """
+    with DigestTable(max_entries, spill_dir) as seen:
+        for s_item in s_items:
+            s_key = key_digest(s_item.prefix, s_item.key)
+            s_value = value_digest(s_item.value)
+            found = seen.get(s_key)
+            if found is None:
+                seen.add(s_key, s_value)
+                yield Result(result=s_item)
+            elif found != s_value:
+                yield Result(invalid=s_item)
 
 @accept_none_items
-def dedup_items(s_items):
-    return map(lambda x: x[0], groupby(s_items))
+def dedup_items(s_items, max_entries=None, spill_dir=None):
+    """
+    Remove duplicate items from a stream, the first occurrence of each item is kept
+    """
+    with DigestTable(max_entries, spill_dir) as seen:
+        for s_item in s_items:
+            s_key = key_digest(s_item.prefix, s_item.key, s_item.value)
+            if seen.get(s_key) is None:
+                seen.add(s_key)
+                yield s_item
 
 @accept_none_items
-def dedup_prefix_keys(s_items, invalid_fatal=True):
+def dedup_prefix_keys(s_items, invalid_fatal=True, max_entries=None, spill_dir=None):
     valid = []
     invalid = []
-    dedupped = dedup_items(s_items)
-    item_groups = {k: list(g) for k, g in groupby(dedupped, key=lambda x: (x.prefix, x.key))}
-    for prefix, key in item_groups.items():
-        if key:
-            valid.extend(key)
+    for res in dedup_stream(s_items, max_entries, spill_dir):
+        if res.result:
+            valid.append(res.result)
         else:
-            invalid.extend(key)
+            invalid.append(res.invalid)
     if invalid and invalid_fatal:
         raise KeyError('Overlapping Key Value Pairs: {}'.format(invalid))
     return Result(result=valid,
@@ -232,28 +506,53 @@ def dedup_prefix_keys(s_items, invalid_fatal=True):
 
 def fill_values(required_items, source_items, invalid_fatal=True):
     """
-    Make a dictionary with values of None out of our required items
-    go through the source items and fill in all our keys
-    This will give us a dictionary containing our default values
-    Now we just need to iterate over our known items, and overwrite any defaults
-    Once we've got the resulting dictionary, we can check to make sure we don't have any
-    values of none remaining
+    Fill in the values of our required items from a single list of source items
+    Any values already set on the required items act as defaults
+    This is resolve_layers with a single layer, see it for the details
     """
-    result = defaultdict(lambda x: None)
+    return resolve_layers(required_items, [('source', source_items)], invalid_fatal)
+
+def resolve_layers(required_items, layers, invalid_fatal=True):
+    """
+    Fill in the values of our required items from an ordered list of (name, source) layers,
+    highest precedence first. A source is either an iterable of items, or a function that
+    accepts a list of the items that are still missing and returns the items it found (Ex: a bulk lookup)
+    Each layer is only searched for keys that are still missing, and once every key has a value the remaining layers
+    aren't read at all. Across layers the first one with a non None value for a key wins, within a layer the last
+    value for a key wins, the same as fill_values has always done with its single source.
+    Any values already set on the required items are used as defaults for keys no layer could fill.
+    The resulting items record the name of the layer that supplied their value as extra={'layer': name}
+    Raises a ValueError if any values are still missing, unless invalid_fatal is False
+    """
+    defaults = {}
     for r_item in required_items:
-        result[r_item.key] = r_item.value
-    s_item_dict = {}
-    for src_item in source_items:
-        src_key = src_item.key
-        src_value = src_item.value
-        if src_key in result and src_value != None:
-            result[src_key] = src_value
+        defaults[r_item.key] = r_item.value
+    # dicts keep their insertion order, so this doubles as an ordered set of the keys left to find
+    missing = dict.fromkeys(defaults)
+    found = {}
+    for name, source in layers:
+        if not missing:
+            break
+        if callable(source):
+            src_items = source([Item(key=x) for x in missing])
+        else:
+            src_items = source
+        if src_items is None:
+            continue
+        layer_found = {}
+        for src_item in src_items:
+            if src_item.key in missing and src_item.value is not None:
+                layer_found[src_item.key] = src_item.value
+        for src_key, value in layer_found.items():
+            found[src_key] = (value, name)
+            del missing[src_key]
 
     base_valid = []
     base_invalid = []
-    for key, value in result.items():
+    for key, default in defaults.items():
+        value, layer = found.get(key, (default, 'default'))
         if value:
-            base_valid.append(Item(key=key, value=value))
+            base_valid.append(Item(key=key, value=value, extra={'layer': layer}))
         else:
             base_invalid.append(Item(key=key, value=value))
     if base_invalid == []:
@@ -275,4 +574,7 @@ def inspector(ins):
 
 @accept_none_items
 def operate(s_items):
+    if INSTRUMENTATION.enabled:
+        with INSTRUMENTATION.timer('operate'):
+            return [x for x in s_items]
     return [x for x in s_items]
@@ -0,0 +1,183 @@
+"""
+Indexed storage for items that are selected from more than once.
+
+Items are indexed by (prefix, key) for direct lookups, and by the segments of their prefix
+for subtree queries. Reading a large source into a store once lets later selections skip
+rescanning the whole stream.
+"""
+from primitives.item_primitives import SauronPrimitive, Result, accept_none_items
+
+
+class _PrefixNode(object):
+    """
+    A single segment in the prefix trie. items holds every item whose prefix ends at this node
+    """
+    __slots__ = ['children', 'items']
+    def __init__(self):
+        self.children = {}
+        self.items = {}
+
+
+class ItemStore(SauronPrimitive):
+    """
+    Items indexed by (prefix, key), and by their prefix segments split on sep
+    Inserting an item with the same prefix and key as an existing item replaces it
+    """
+    __slots__ = ['sep', 'index', 'root']
+    def __init__(self, s_items=None, sep='/'):
+        self.sep = sep
+        self.index = {}
+        self.root = _PrefixNode()
+        if s_items is not None:
+            self.update(s_items)
+    def __repr__(self):
+        return '{} {}'.format(self.__class__.__name__, {'size': len(self), 'sep': self.sep})
+    def __len__(self):
+        return len(self.index)
+    def __iter__(self):
+        return iter(list(self.index.values()))
+    def __contains__(self, s_item):
+        return (s_item.prefix, s_item.key) in self.index
+    def _segments(self, prefix):
+        """
+        Split a prefix into its trie path. Leading or trailing seperators are ignored,
+        so 'dev/app' and 'dev/app/' end up on the same node
+        """
+        if prefix is None:
+            return []
+        stripped = prefix.strip(self.sep)
+        if not stripped:
+            return []
+        return stripped.split(self.sep)
+    def _node(self, prefix, create=False):
+        node = self.root
+        for segment in self._segments(prefix):
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[segment] = _PrefixNode()
+            node = child
+        return node
+    def insert(self, s_item):
+        """
+        Add an item to the store, replacing any item with the same prefix and key
+        """
+        index_key = (s_item.prefix, s_item.key)
+        self.index[index_key] = s_item
+        self._node(s_item.prefix, create=True).items[index_key] = s_item
+        return s_item
+    def update(self, s_items):
+        for s_item in s_items:
+            self.insert(s_item)
+        return self
+    def delete(self, s_item):
+        """
+        Remove the item with a matching prefix and key
+        Returns a valid Result with the removed item, or an invalid Result if it wasn't in the store
+        """
+        index_key = (s_item.prefix, s_item.key)
+        if index_key not in self.index:
+            return Result(invalid=s_item)
+        removed = self.index.pop(index_key)
+        segments = self._segments(s_item.prefix)
+        path = [self.root]
+        for segment in segments:
+            path.append(path[-1].children[segment])
+        del path[-1].items[index_key]
+        # Prune any nodes that no longer hold items or children
+        for depth in range(len(segments), 0, -1):
+            node = path[depth]
+            if node.items or node.children:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+        return Result(result=removed)
+    def get(self, prefix, key):
+        """
+        Get the item matching prefix and key, or None if there is no match
+        """
+        return self.index.get((prefix, key))
+    def lookup(self, s_item):
+        """
+        Look up an item by its prefix and key
+        Returns a valid Result of the stored item, or an invalid Result of the requested item
+        """
+        found = self.index.get((s_item.prefix, s_item.key))
+        if found is None:
+            return Result(invalid=s_item)
+        return Result(result=found)
+    def by_prefix(self, prefix):
+        """
+        Items with exactly the given prefix.
+        Unlike get_by_prefix, the result is looked up rather than filtered, so there is no invalid attribute
+        """
+        node = self._node(prefix)
+        if node is None:
+            return Result(result=[])
+        return Result(result=[x for x in node.items.values() if x.prefix == prefix])
+    def subtree(self, prefix):
+        """
+        All items with the given prefix, or with a prefix nested beneath it.
+        Ex: 'dev/app' will return items prefixed with 'dev/app' and 'dev/app/service'
+        """
+        node = self._node(prefix)
+        if node is None:
+            return Result(result=[])
+        found = []
+        to_visit = [node]
+        while to_visit:
+            current = to_visit.pop()
+            found.extend(current.items.values())
+            to_visit.extend(current.children.values())
+        return Result(result=found)
+
+
+@accept_none_items
+def make_store(s_items, sep='/'):
+    """
+    Read an iterable of items into an ItemStore
+    """
+    return ItemStore(s_items, sep=sep)
+
+
+class ItemDiff(SauronPrimitive):
+    """
+    The difference between a set of items and the items already at a destination, matched on prefix and key
+      * added: items that aren't at the destination
+      * changed: items whose value differs from the destination's
+      * removed: destination items that have no matching item (orphans)
+      * unchanged: items whose value already matches the destination's
+    """
+    __slots__ = ['added', 'changed', 'removed', 'unchanged']
+    def __init__(self, added=None, changed=None, removed=None, unchanged=None):
+        self.added = added or []
+        self.changed = changed or []
+        self.removed = removed or []
+        self.unchanged = unchanged or []
+    def counts(self):
+        return {x: len(getattr(self, x)) for x in self.__slots__}
+
+def _same_value(s_item, s_existing):
+    return s_item.value == s_existing.value
+
+def diff_items(s_items, s_existing, same_value=_same_value, sep='/'):
+    """
+    Compare items against the items already at a destination (Ex: a recursive read of a consul prefix)
+    same_value(item, existing) decides if an item needs writing, by default the values have to be equal
+    Items in the changed list are the new items, not the ones being replaced
+    """
+    store = s_existing if isinstance(s_existing, ItemStore) else make_store(s_existing, sep=sep)
+    diff = ItemDiff()
+    seen = set()
+    for s_item in s_items:
+        index_key = (s_item.prefix, s_item.key)
+        seen.add(index_key)
+        existing = store.get(*index_key)
+        if existing is None:
+            diff.added.append(s_item)
+        elif same_value(s_item, existing):
+            diff.unchanged.append(s_item)
+        else:
+            diff.changed.append(s_item)
+    diff.removed = [x for x in store if (x.prefix, x.key) not in seen]
+    return diff
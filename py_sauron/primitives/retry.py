@@ -0,0 +1,168 @@
+"""
+Retrying items whose actions failed with a transient error.
+
+Plugins mark those failures by returning an invalid Result with retry set, Ex: a socket error talking to consul,
+or cloudformation throttling a request. RetryScheduler runs items through a pipeline (and optionally a bulk
+destination, like put_consul_many), collects the retryable failures, and re-submits them in batches after
+a jittered backoff, until they succeed or run out of attempts.
+"""
+from itertools import islice
+import logging
+import random
+import time
+
+from primitives.item_primitives import SauronPrimitive, Result, compile_actions, make_valid, action_name, _outcome
+from primitives.instrumentation import INSTRUMENTATION
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+
+
+def is_retryable(s_obj):
+    return isinstance(s_obj, Result) and bool(s_obj.retry) and not s_obj.result
+
+def backoff_delay(attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    """
+    Full jitter: a random delay of up to base_delay * 2^(attempt - 1), capped at max_delay,
+    so clients that failed together don't all retry together
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+def _chunks(s_items, size):
+    s_items = iter(s_items)
+    while True:
+        chunk = list(islice(s_items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RetryReport(SauronPrimitive):
+    """
+    The outcome of a RetryScheduler run
+      * result: every successful Result (or item)
+      * invalid: the Results that failed for good, including retryable ones that ran out of attempts
+      * attempts: the number of rounds it took
+      * retried: the number of times an item was re-submitted
+    """
+    __slots__ = ['result', 'invalid', 'attempts', 'retried']
+    def __init__(self, result=None, invalid=None, attempts=0, retried=0):
+        self.result = result or []
+        self.invalid = invalid or []
+        self.attempts = attempts
+        self.retried = retried
+
+
+class RetryScheduler(object):
+    """
+    Run items through a list of actions, then optionally hand the valid ones to batch_func in bulk
+    (like batch_action). Items that fail with a retryable Result are re-submitted, batch_size at a time,
+    after a jittered backoff, up to max_attempts rounds each for the actions and for the writes.
+    Items failing in the actions are retried from the start of the pipeline, and batch_func is only called
+    once they have all made it through (or failed for good), with every valid item, Ex: so ConsulSync diffs
+    the whole set exactly once. batch_func is called even if no items made it through.
+    Items failing in batch_func are only re-submitted to retry_func (batch_func by default), Ex: a sync
+    retries its failed writes with put_consul_many rather than diffing them again
+    """
+    def __init__(self, actions=[make_valid], batch_func=None, retry_func=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, batch_size=None, sleep=time.sleep):
+        self.pipeline = compile_actions(actions)
+        self.batch_func = batch_func
+        self.retry_func = retry_func or batch_func
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.sleep = sleep
+    def _batches(self, s_items):
+        if self.batch_size is None:
+            return [s_items] if s_items else []
+        return _chunks(s_items, self.batch_size)
+    def _wait(self, attempt, count):
+        """
+        Back off before the attempt'th round of a stage
+        """
+        if attempt > 1:
+            delay = backoff_delay(attempt - 1, self.base_delay, self.max_delay)
+            logging.info('Retrying {} items in {:.2f}s (attempt {} of {})'.format(
+                count, delay, attempt, self.max_attempts))
+            self.sleep(delay)
+    def _run_batch(self, batch_func, batch, report, retry_batch):
+        results = batch_func(batch)
+        if INSTRUMENTATION.enabled:
+            results = INSTRUMENTATION.wrap_stream(action_name(batch_func), results, _outcome)
+        for res in results:
+            if is_retryable(res):
+                retry_batch.append(res)
+            elif isinstance(res, Result) and not res.result:
+                report.invalid.append(res)
+            else:
+                report.result.append(res)
+    def run(self, s_items):
+        report = RetryReport()
+        pending = list(s_items)
+        to_batch = []
+        attempt = 0
+        while pending:
+            attempt += 1
+            self._wait(attempt, len(pending))
+            retry_items = []
+            for batch in self._batches(pending):
+                for s_item, res in zip(batch, map(self.pipeline, batch)):
+                    if is_retryable(res):
+                        retry_items.append((s_item, res))
+                    elif isinstance(res, Result) and not res.result:
+                        report.invalid.append(res)
+                    elif self.batch_func is None:
+                        report.result.append(res)
+                    else:
+                        to_batch.append(res.result if isinstance(res, Result) else res)
+            if attempt >= self.max_attempts:
+                report.invalid.extend(res for _, res in retry_items)
+                break
+            pending = [x for x, _ in retry_items]
+            report.retried += len(pending)
+        report.attempts = attempt
+        if self.batch_func is None:
+            return report
+
+        # Everything that made it through the pipeline is written in one go, then failed writes are retried
+        retry_batch = []
+        self._run_batch(self.batch_func, to_batch, report, retry_batch)
+        report.attempts += 1
+        batch_attempt = 1
+        while retry_batch and batch_attempt < self.max_attempts:
+            batch_attempt += 1
+            pending_batch = [x.invalid for x in retry_batch]
+            retry_batch = []
+            report.retried += len(pending_batch)
+            self._wait(batch_attempt, len(pending_batch))
+            for batch in self._batches(pending_batch):
+                self._run_batch(self.retry_func, batch, report, retry_batch)
+            report.attempts += 1
+        report.invalid.extend(retry_batch)
+        return report
+
+
+def retry_call(func, *args, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+               max_delay=DEFAULT_MAX_DELAY, sleep=time.sleep, **kwargs):
+    """
+    Call a function returning a Result (Ex: get_cfn_stack) until it stops asking to be retried,
+    backing off between attempts. Returns the last Result
+    """
+    attempt = 1
+    res = func(*args, **kwargs)
+    while is_retryable(res) and attempt < max_attempts:
+        delay = backoff_delay(attempt, base_delay, max_delay)
+        logging.info('Retrying {} in {:.2f}s ({})'.format(getattr(func, '__name__', func), delay, res.exception))
+        sleep(delay)
+        attempt += 1
+        res = func(*args, **kwargs)
+    return res
+
+def retry_item_action(s_items, actions=[make_valid], **kwargs):
+    """
+    item_action with retries, returns a RetryReport. See RetryScheduler for the options
+    """
+    return RetryScheduler(actions, **kwargs).run(s_items)
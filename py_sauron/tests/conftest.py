@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other as top level packages (primitives, plugins), the same as when run from py_sauron
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
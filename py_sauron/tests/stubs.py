@@ -0,0 +1,235 @@
+"""
+In-process stand-ins for consul and cloudformation, shared by the tests and benchmark.py.
+They only implement what py_sauron actually calls.
+"""
+import asyncio
+from base64 import b64decode, b64encode
+from collections import Counter
+import json
+import time
+
+# Round trip time for the slow consul stubs, roughly a request to a consul agent on the local network
+CONSUL_LATENCY = 0.001
+# Round trip time for the cloudformation stubs that wait, and the number of stacks in each DescribeStacks page
+CFN_LATENCY = 0.001
+CFN_PAGE_SIZE = 100
+
+
+class FakeKV(object):
+    def __init__(self):
+        self.data = {}
+        self.flags = {}
+        self.index = 0
+    def _record(self, key):
+        value, modify_index = self.data[key]
+        return {'Key': key, 'Value': value, 'ModifyIndex': modify_index, 'Flags': self.flags.get(key, 0)}
+    def get(self, key, recurse=False, keys=False, **kwargs):
+        if recurse:
+            # Like consul, a listing has the highest ModifyIndex of the keys in it, and a single key the index of the store
+            matches = [self._record(x) for x in sorted(self.data) if x.startswith(key)]
+            index = max([x['ModifyIndex'] for x in matches] or [self.index])
+            if keys:
+                return index, [x['Key'] for x in matches] or None
+            return index, matches or None
+        if key in self.data:
+            return self.index, self._record(key)
+        return self.index, None
+    def _dirs(self):
+        """
+        How many keys are under each directory (prefix ending in /), so deleting a tree that is already empty,
+        Ex: the chunks of a key that was never chunked, doesn't scan every key. Keys set straight in data are
+        picked up by counting again whenever the number of keys doesn't add up
+        """
+        if getattr(self, 'dir_total', None) != len(self.data):
+            self.dirs = Counter(x[:i + 1] for x in self.data for i, c in enumerate(x) if c == '/')
+            self.dir_total = len(self.data)
+        return self.dirs
+    def _count(self, key, change):
+        dirs = self._dirs()
+        for i, c in enumerate(key):
+            if c == '/':
+                dirs[key[:i + 1]] += change
+        self.dir_total += change
+    def put(self, key, value, flags=None, **kwargs):
+        if isinstance(value, str):
+            value = value.encode()
+        if key not in self.data:
+            self._count(key, 1)
+        self.index += 1
+        self.data[key] = (value, self.index)
+        self.flags[key] = flags or 0
+        return True
+    def delete(self, key, recurse=False, **kwargs):
+        if recurse and key.endswith('/') and key not in self.data and not self._dirs()[key]:
+            return True
+        for x in [x for x in self.data if x == key or (recurse and x.startswith(key))]:
+            self._count(x, -1)
+            del self.data[x]
+        return True
+
+
+class FakeTxn(object):
+    def __init__(self, kv):
+        self.kv = kv
+    def put(self, payload):
+        errors = []
+        for index, operation in enumerate(payload):
+            op = operation['KV']
+            current = self.kv.data.get(op['Key'], (None, 0))[1]
+            if op['Verb'] in ('cas', 'delete-cas') and op['Index'] != current:
+                errors.append({'OpIndex': index, 'What': 'failed to set key {}, index is stale'.format(op['Key'])})
+        if errors:
+            return {'Results': None, 'Errors': errors}
+        results = []
+        for operation in payload:
+            op = operation['KV']
+            # Straight to FakeKV, so a SlowFakeKV only waits once for the whole transaction (see SlowFakeTxn)
+            if op['Verb'] in ('set', 'cas'):
+                FakeKV.put(self.kv, op['Key'], b64decode(op['Value']), op.get('Flags'))
+                results.append({'KV': self.kv._record(op['Key'])})
+            elif op['Verb'] in ('delete', 'delete-cas'):
+                self.kv.data.pop(op['Key'], None)
+            elif op['Verb'] == 'delete-tree':
+                FakeKV.delete(self.kv, op['Key'], recurse=True)
+        return {'Results': results, 'Errors': None}
+
+
+class FakeConsul(object):
+    def __init__(self):
+        self.kv = FakeKV()
+        self.txn = FakeTxn(self.kv)
+
+
+class FakeStreamResponse(object):
+    def __init__(self, body):
+        self.status_code = 200
+        self.headers = {}
+        self.body = body
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class FakeHTTP(object):
+    """
+    The std client's transport, serving recursive reads of a FakeKV as a json body to stream
+    """
+    verify = True
+    cert = None
+    def __init__(self, kv):
+        self.kv = kv
+        self.session = self
+    def uri(self, path, params=None):
+        return path
+    def get(self, uri, **kwargs):
+        prefix = uri[len('/v1/kv/'):]
+        records = [dict(x, Value=b64encode(x['Value']).decode()) for x in self.kv.get(prefix, recurse=True)[1]]
+        return FakeStreamResponse(json.dumps(records).encode())
+
+
+class FakeStreamingConsul(FakeConsul):
+    token = None
+    dc = None
+    consistency = 'default'
+    def __init__(self):
+        super(FakeStreamingConsul, self).__init__()
+        self.http = FakeHTTP(self.kv)
+
+
+class SlowFakeKV(FakeKV):
+    """
+    A FakeKV that waits CONSUL_LATENCY on every request, like a real round trip to consul
+    """
+    def get(self, key, recurse=False, **kwargs):
+        time.sleep(CONSUL_LATENCY)
+        return super(SlowFakeKV, self).get(key, recurse, **kwargs)
+    def put(self, key, value, **kwargs):
+        time.sleep(CONSUL_LATENCY)
+        return super(SlowFakeKV, self).put(key, value, **kwargs)
+
+
+class SlowFakeTxn(FakeTxn):
+    def put(self, payload):
+        time.sleep(CONSUL_LATENCY)
+        return super(SlowFakeTxn, self).put(payload)
+
+
+class FakeAsyncKV(object):
+    """
+    The async client's kv endpoint, waiting CONSUL_LATENCY on every request without blocking the event loop
+    """
+    def __init__(self, kv):
+        self.kv = kv
+    async def get(self, key, recurse=False, **kwargs):
+        await asyncio.sleep(CONSUL_LATENCY)
+        return self.kv.get(key, recurse, **kwargs)
+    async def put(self, key, value, **kwargs):
+        await asyncio.sleep(CONSUL_LATENCY)
+        return self.kv.put(key, value, **kwargs)
+
+
+class FakeAsyncTxn(object):
+    def __init__(self, kv):
+        self.txn = FakeTxn(kv)
+    async def put(self, payload):
+        await asyncio.sleep(CONSUL_LATENCY)
+        return self.txn.put(payload)
+
+
+class FakeAsyncConsul(object):
+    def __init__(self, kv):
+        self.kv = FakeAsyncKV(kv)
+        self.txn = FakeAsyncTxn(kv)
+
+
+class FakeClientError(Exception):
+    pass
+
+
+class FakeStack(object):
+    class meta(object):
+        class client(object):
+            class exceptions(object):
+                ClientError = FakeClientError
+    def __init__(self, name, parameters, outputs):
+        self.name = name
+        self.stack_name = name
+        self.parameters = parameters
+        self.outputs = outputs
+    def reload(self):
+        pass
+
+
+class FakeCfnClient(object):
+    exceptions = FakeStack.meta.client.exceptions
+    def __init__(self, stacks, latency=0):
+        self.stacks = stacks
+        self.latency = latency
+    def get_paginator(self, operation):
+        return self
+    def paginate(self):
+        stacks = sorted(self.stacks.values(), key=lambda x: x.name)
+        for start in range(0, len(stacks), CFN_PAGE_SIZE):
+            time.sleep(self.latency)
+            yield {'Stacks': [{'StackName': x.name,
+                               'StackId': 'arn:aws:cloudformation:stack/{}'.format(x.name),
+                               'Parameters': x.parameters,
+                               'Outputs': x.outputs} for x in stacks[start:start + CFN_PAGE_SIZE]]}
+
+
+class FakeCfnResource(object):
+    """
+    latency is how long each request waits, Ex: CFN_LATENCY
+    """
+    def __init__(self, stacks, latency=0):
+        self.stacks = stacks
+        self.latency = latency
+        self.meta = FakeStack.meta()
+        self.meta.client = FakeCfnClient(stacks, latency)
+    def Stack(self, name):
+        time.sleep(self.latency)
+        return self.stacks[name]
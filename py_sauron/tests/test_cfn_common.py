@@ -0,0 +1,50 @@
+import os
+
+from plugins import cfn_common
+
+DEPLOY_COPY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'deploy', 'ml_py_deploy',
+                           'cfn_common.py')
+
+
+def test_deploy_shares_cfn_common():
+    # deploy links to this module rather than keeping a copy, so their template hashes can't drift apart
+    assert os.path.samefile(DEPLOY_COPY, cfn_common.__file__)
+
+def test_json_templates_hash_like_their_parsed_form():
+    body = '{"Resources": {"B": {"Type": "AWS::SNS::Topic"}, "A": {"Type": "AWS::SNS::Topic"}}}'
+    parsed = {'Resources': {'A': {'Type': 'AWS::SNS::Topic'}, 'B': {'Type': 'AWS::SNS::Topic'}}}
+    assert cfn_common.stack_template_hash(body) == cfn_common.stack_template_hash(parsed)
+
+def test_expected_parameters_fill_in_defaults():
+    defaults = {'Swarm': None, 'Public': 'true', 'Port': '80'}
+    given = [{'ParameterKey': 'Swarm', 'ParameterValue': 'dev'}, {'ParameterKey': 'Port', 'ParameterValue': 8080}]
+    assert cfn_common.expected_parameters(defaults, given) == {'Swarm': 'dev', 'Public': 'true', 'Port': '8080'}
+
+class PendingChangeSet(object):
+    def describe_change_set(self, **kwargs):
+        return {'Status': 'CREATE_PENDING'}
+
+def test_change_set_wait_gives_up_at_the_timeout():
+    now = [0]
+    def sleep(delay):
+        now[0] += delay
+    status, _ = cfn_common.wait_for_change_set(PendingChangeSet(), 'app', 'deploy', timeout=60, sleep=sleep,
+                                               clock=lambda: now[0])
+    assert status == 'CREATE_PENDING' and 60 <= now[0] < 70
+
+class Throttled(Exception):
+    response = {'Error': {'Code': 'Throttling'}}
+
+class ThrottledChangeSet(object):
+    def __init__(self):
+        self.calls = 0
+    def describe_change_set(self, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            raise Throttled()
+        return {'Status': 'CREATE_COMPLETE'}
+
+def test_change_set_wait_rides_out_throttling():
+    client = ThrottledChangeSet()
+    status, _ = cfn_common.wait_for_change_set(client, 'app', 'deploy', sleep=lambda x: None)
+    assert status == 'CREATE_COMPLETE' and client.calls == 2
@@ -0,0 +1,53 @@
+import socket
+
+import pytest
+
+pytest.importorskip('consul')
+
+from primitives.item_primitives import Item
+from plugins.consul_cache import ConsulCache
+from plugins.consul_kv import get_consul, get_consul_by_prefix, put_consul, CHUNK_DIR
+from tests.stubs import FakeConsul
+
+
+class DownKV(object):
+    def get(self, *args, **kwargs):
+        raise socket.error('connection refused')
+
+
+class DownConsul(object):
+    kv = DownKV()
+
+
+def test_connection_errors_are_retryable():
+    for getter in (get_consul, get_consul_by_prefix):
+        res = getter(Item(prefix='dev/app', key='A'), DownConsul())
+        assert res.invalid and res.retry and isinstance(res.exception, socket.error)
+
+def test_missing_chunk_while_streaming_is_retryable():
+    conn = FakeConsul()
+    conn.kv.put('dev/app/A', 'a')
+    put_consul(Item(prefix='dev/app', key='BIG', value='x' * 300000), conn, chunked=True)
+    for key in [x for x in conn.kv.data if '/{}/'.format(CHUNK_DIR) in x]:
+        del conn.kv.data[key]
+    res = get_consul_by_prefix(Item(prefix='dev/app'), conn)
+    assert [x.key for x in res.result] == ['A']
+    assert res.retry and res.exception is not None
+
+def test_cached_single_key_is_revalidated_with_one_request(tmp_path):
+    conn = FakeConsul()
+    conn.kv.put('dev/app/A', 'a')
+    conn.kv.put('dev/app/B', 'b')
+    requests = []
+    get = conn.kv.get
+    conn.kv.get = lambda *args, **kwargs: requests.append(kwargs.get('keys', False)) or get(*args, **kwargs)
+    with ConsulCache(str(tmp_path / 'cache.db')) as cache:
+        _, record = cache.get(conn, 'dev/app/A')
+        del requests[:]
+        # B was written after A, so the index of the store has moved on but A hasn't changed
+        assert cache.get(conn, 'dev/app/A', ttl=0)[1] == record
+        assert requests == [True]
+        conn.kv.put('dev/app/A', 'new')
+        del requests[:]
+        assert cache.get(conn, 'dev/app/A', ttl=0)[1]['Value'] == b'new'
+        assert requests == [True, False]
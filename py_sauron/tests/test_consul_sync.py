@@ -0,0 +1,90 @@
+from functools import partial
+
+import pytest
+
+pytest.importorskip('consul')
+
+from consul import ConsulException
+
+from primitives.item_primitives import Item, Result, operate
+from primitives.retry import RetryScheduler, retry_call
+from plugins import consul_kv
+from plugins.consul_kv import ConsulSync
+from tests.stubs import FakeConsul
+
+
+def make_conn(values):
+    conn = FakeConsul()
+    for key, value in values.items():
+        conn.kv.put(key, value)
+    return conn
+
+def test_sync_destination_with_trailing_separator():
+    conn = make_conn({'dev/app/A': 'a', 'dev/app/B': 'b'})
+    sync = ConsulSync('dev/app/', conn, delete_orphans=True)
+    results = operate(sync([Item(prefix='dev/app/', key='A', value='a'),
+                            Item(prefix='dev/app/', key='B', value='new')]))
+    assert all(x.result for x in results)
+    assert sync.diff.counts() == {'added': 0, 'changed': 1, 'removed': 0, 'unchanged': 1}
+    assert sorted(conn.kv.data) == ['dev/app/A', 'dev/app/B']
+    assert conn.kv.data['dev/app/B'][0] == b'new'
+
+def test_sync_retries_without_diffing_again():
+    conn = make_conn({'dev/app/A': 'old', 'dev/app/B': 'old'})
+    sync = ConsulSync('dev/app', conn, delete_orphans=True)
+    lookups = {'B': 0}
+    def flaky(s_item):
+        # B fails once with a transient error before making it through the pipeline
+        if s_item.key == 'B' and not lookups['B']:
+            lookups['B'] += 1
+            return Result(invalid=s_item, retry=True)
+        return Result(result=s_item)
+    scheduler = RetryScheduler([flaky], sync, sync.retry, sleep=lambda x: None)
+    report = scheduler.run([Item(prefix='dev/app', key='A', value='a'), Item(prefix='dev/app', key='B', value='b')])
+    assert not report.invalid
+    assert sync.diff.counts() == {'added': 0, 'changed': 2, 'removed': 0, 'unchanged': 0}
+    assert {x: conn.kv.data[x][0] for x in conn.kv.data} == {'dev/app/A': b'a', 'dev/app/B': b'b'}
+
+def test_sync_empty_source_deletes_orphans():
+    conn = make_conn({'dev/app/A': 'a'})
+    sync = ConsulSync('dev/app', conn, delete_orphans=True)
+    report = RetryScheduler(batch_func=sync, retry_func=sync.retry, sleep=lambda x: None).run([])
+    assert not report.invalid
+    assert sync.diff.counts()['removed'] == 1
+    assert conn.kv.data == {}
+
+def test_sync_fails_if_destination_cannot_be_read(monkeypatch):
+    monkeypatch.setattr(consul_kv, 'retry_call', partial(retry_call, sleep=lambda x: None))
+    conn = make_conn({'dev/app/A': 'a'})
+    def down(*args, **kwargs):
+        raise ConsulException('500 unavailable')
+    conn.kv.get = down
+    sync = ConsulSync('dev/app', conn, delete_orphans=True)
+    report = RetryScheduler(batch_func=sync, retry_func=sync.retry, sleep=lambda x: None).run(
+        [Item(prefix='dev/app', key='B', value='b')])
+    assert sync.diff is None
+    assert [x.invalid.key for x in report.invalid] == ['B']
+    assert list(conn.kv.data) == ['dev/app/A']
+
+def test_put_many_splits_transactions_by_size():
+    conn = make_conn({})
+    payloads = []
+    put = conn.txn.put
+    conn.txn.put = lambda payload: payloads.append(sum(x['KV']['Verb'] == 'set' for x in payload)) or put(payload)
+    value = 'x' * (consul_kv.TXN_MAX_BYTES // 2)
+    items = [Item(key='dev/big/{}'.format(x), value=value) for x in range(4)]
+    results = list(consul_kv.put_consul_many(items, conn))
+    assert all(x.result for x in results)
+    # Each value is half the limit before base64 makes it larger, so only one fits in a transaction
+    assert payloads == [1, 1, 1, 1]
+    assert sorted(conn.kv.data) == ['dev/big/{}'.format(x) for x in range(4)]
+
+def test_plain_writes_and_deletes_remove_chunks():
+    conn = make_conn({})
+    big = 'x' * (consul_kv.CHUNK_THRESHOLD + 1)
+    for key in ('A', 'B', 'C'):
+        consul_kv.put_consul(Item(prefix='dev/app', key=key, value=big), conn, chunked=True)
+    consul_kv.put_consul(Item(prefix='dev/app', key='A', value='small'), conn)
+    assert all(x.result for x in consul_kv.put_consul_many([Item(prefix='dev/app', key='B', value='small')], conn))
+    assert all(x.result for x in consul_kv.delete_consul_many([Item(prefix='dev/app', key='C')], conn))
+    assert sorted(conn.kv.data) == ['dev/app/A', 'dev/app/B']
@@ -0,0 +1,29 @@
+import io
+
+from primitives.item_primitives import Item, FrozenItem, evolve_items, fill_values, resolve_layers
+from plugins.keyfile import read_keyfile
+
+
+def test_fill_values_last_value_wins():
+    required = [Item(key='Swarm'), Item(key='Port', value='80')]
+    source = [Item(key='Swarm', value='old'), Item(key='Swarm', value='new')]
+    assert {x.key: x.value for x in fill_values(required, source).result} == {'Swarm': 'new', 'Port': '80'}
+
+def test_resolve_layers_first_layer_wins():
+    required = [Item(key='Swarm'), Item(key='Port')]
+    keyfile = read_keyfile(io.StringIO('# overrides\nSwarm=dev\nexport Swarm=test\n'))
+    lookups = []
+    def environment(missing):
+        lookups.append([x.key for x in missing])
+        return [Item(key='Swarm', value='prod'), Item(key='Port', value='8080')]
+    filled = resolve_layers(required, [('keyfile', keyfile), ('environment', environment)]).result
+    assert {x.key: (x.value, x.extra['layer']) for x in filled} == {'Swarm': ('test', 'keyfile'),
+                                                                    'Port': ('8080', 'environment')}
+    assert lookups == [['Port']]
+
+def test_evolve_items_freezes_with_the_changes():
+    frozen = FrozenItem(key='B', value='b', prefix='dev')
+    evolved = evolve_items([Item(key='A', value='a', prefix='dev'), frozen], prefix='prod')
+    assert all(isinstance(x, FrozenItem) for x in evolved)
+    assert [(x.prefix, x.key, x.value) for x in evolved] == [('prod', 'A', 'a'), ('prod', 'B', 'b')]
+    assert evolve_items([frozen], prefix='dev')[0] is frozen
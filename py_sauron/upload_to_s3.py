@@ -9,8 +9,10 @@ from tempfile import TemporaryDirectory
 import boto3
 
 from primitives.item_primitives import Item
+from primitives.retry import retry_call
 from plugins.cloudformation import get_cfn_stack
 from plugins.consul_kv import get_consul
+from plugins.consul_cache import configure_cache
 
 
 BUCKET_LOOKUP_KEY = 'S3Bucket'
@@ -52,6 +54,11 @@ def parse_args():
                         required=False,
                         default='',
                         help='Prefix to add when uploading file (Ex: Directory within an S3 bucket)')
+
+    parser.add_argument('--consul-cache',
+                        required=False,
+                        default=os.environ.get('SAURON_CONSUL_CACHE'),
+                        help='Cache consul lookups in this file, to share them with other runs (Default: $SAURON_CONSUL_CACHE)')
                         
     return parser.parse_args()
 
@@ -103,6 +110,7 @@ def main():
     output = args.output
     output_prefix = args.output_prefix
     output_lookup = args.output_lookup
+    configure_cache(args.consul_cache)
     if output_lookup == 'consul':
         bucket_item = get_consul(Item(prefix=output, key=BUCKET_LOOKUP_KEY)).result
         if bucket_item is not None:
@@ -111,8 +119,14 @@ def main():
         else:
             raise KeyError('Key {} not found in {}'.format(BUCKET_LOOKUP_KEY, output))
     elif output_lookup == 'cfn':
-        cfn_lookup_results = get_cfn_stack(output).result
-        output_bucket = [x.value for x in cfn_lookup_results if x.prefix == 'Outputs' and x.key == BUCKET_LOOKUP_KEY][0]
+        stack_res = retry_call(get_cfn_stack, output)
+        if stack_res.retry:
+            raise stack_res.exception
+        # A single lookup, so a scan is cheaper than building an ItemStore of the stack
+        bucket_item = next((x for x in stack_res.result or [] if x.prefix == 'Outputs' and x.key == BUCKET_LOOKUP_KEY), None)
+        if bucket_item is None:
+            raise KeyError('Output {} not found in {}'.format(BUCKET_LOOKUP_KEY, output))
+        output_bucket = bucket_item.value
     else:
         output_bucket = output
         
@@ -2,10 +2,111 @@
 Assorted functions for clarifying or simplifying operations
 """
 
-from itertools import tee, filterfalse
-from collections import namedtuple
+from collections import deque, namedtuple
+import os
+import pickle
+from tempfile import TemporaryFile
+
+DEFAULT_MAX_BUFFER = 10000
+
+Filtered = namedtuple('Filtered', ['match', 'no_match'])
+
+
+class _SpillQueue(object):
+    """
+    FIFO queue that keeps up to max_buffer items in memory, and pickles anything past that to a temporary file
+    """
+    __slots__ = ['memory', 'max_buffer', 'spill_dir', 'spill', 'spilled', 'read_pos', 'closed']
+    def __init__(self, max_buffer, spill_dir=None):
+        self.memory = deque()
+        self.max_buffer = max_buffer
+        self.spill_dir = spill_dir
+        self.spill = None
+        self.spilled = 0
+        self.read_pos = 0
+        self.closed = False
+    def __len__(self):
+        return len(self.memory) + self.spilled
+    def push(self, item):
+        # Nobody is going to read from a closed queue, so there's no point holding on to anything
+        if self.closed:
+            return
+        # Once anything has been spilled, keep spilling until it has all been read back to preserve ordering
+        if self.spilled == 0 and len(self.memory) < self.max_buffer:
+            self.memory.append(item)
+            return
+        if self.spill is None:
+            self.spill = TemporaryFile(dir=self.spill_dir)
+        self.spill.seek(0, os.SEEK_END)
+        pickle.dump(item, self.spill, pickle.HIGHEST_PROTOCOL)
+        self.spilled += 1
+    def pop(self):
+        if not self.memory:
+            self._refill()
+        return self.memory.popleft()
+    def _refill(self):
+        """
+        Read up to max_buffer spilled items back into memory
+        """
+        self.spill.seek(self.read_pos)
+        while self.spilled and len(self.memory) < self.max_buffer:
+            self.memory.append(pickle.load(self.spill))
+            self.spilled -= 1
+        self.read_pos = self.spill.tell()
+        if self.spilled == 0:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.read_pos = 0
+    def close(self):
+        self.closed = True
+        self.memory.clear()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class _Partitioner(object):
+    """
+    Shared state for the two sides of a partition. Whichever side is being consumed pulls from the input,
+    and routes anything belonging to the other side into that side's queue
+    """
+    __slots__ = ['pred', 'items', 'queues', 'done']
+    def __init__(self, pred, items, max_buffer, spill_dir):
+        self.pred = pred
+        self.items = iter(items)
+        self.queues = (_SpillQueue(max_buffer, spill_dir), _SpillQueue(max_buffer, spill_dir))
+        self.done = False
+    def side(self, match):
+        own = self.queues[not match]
+        other = self.queues[match]
+        try:
+            while True:
+                if own:
+                    yield own.pop()
+                    continue
+                if self.done:
+                    return
+                try:
+                    item = next(self.items)
+                except StopIteration:
+                    self.done = True
+                    return
+                if bool(self.pred(item)) == match:
+                    yield item
+                else:
+                    other.push(item)
+        finally:
+            own.close()
+
+
+def partition(pred, items, max_buffer=DEFAULT_MAX_BUFFER, spill_dir=None):
+    """
+    Split items into lazy match and no_match iterators, calling pred exactly once for each item.
+    The sides can be consumed in any order. Items read while consuming one side are queued for the other,
+    with at most max_buffer of them held in memory and the rest written to a temporary file
+    """
+    partitioner = _Partitioner(pred, items, max_buffer, spill_dir)
+    return Filtered(partitioner.side(True), partitioner.side(False))
 
 def filter_both(pred, items):
-    valid, invalid = tee(items)
-    filtered = namedtuple('Filtered', ['match', 'no_match'])
-    return filtered(filter(pred, valid), filterfalse(pred, invalid))
+    return partition(pred, items)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Continuously replicate the keys under a consul prefix to another prefix or to a keyfile.
+
+Ex: ./watch_consul.py -p dev/app --destination-prefix dev/app-copy
+    ./watch_consul.py -p dev/app --keyfile app.env
+"""
+import argparse
+from functools import partial
+import logging
+import os
+from tempfile import NamedTemporaryFile
+
+from primitives.item_primitives import Item, operate, new_prefix, drop_prefix, item_action
+from primitives.item_store import ItemDiff
+from plugins.consul_kv import watch_consul_prefix, apply_consul_diff, sync_consul, WATCH_WAIT, CONSUL_SEP
+from plugins.consul_connection import get_connection
+from plugins.keyfile import serialize_keyfile
+
+try:
+    debug = os.environ['SAURON_LOGLEVEL']
+except KeyError:
+    debug = 'INFO'
+if debug == 'DEBUG':
+    logging.basicConfig(level=logging.DEBUG)
+elif debug == 'INFO':
+    logging.basicConfig(level=logging.INFO)
+else:
+    logging.basicConfig(level=logging.ERROR)
+
+
+def get_cli_opts():
+    description = 'Watch a consul prefix, and copy every change to another prefix or a keyfile as it happens'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-p', '--source-prefix',
+                        required=True,
+                        dest='source_prefix',
+                        help='Consul prefix to watch, only the keys directly under it are copied')
+
+    destination = parser.add_mutually_exclusive_group(required=True)
+    destination.add_argument('-o', '--destination-prefix',
+                             dest='destination_prefix',
+                             help='Consul prefix to copy the keys to')
+
+    destination.add_argument('-k', '--keyfile',
+                             dest='keyfile',
+                             help='Keyfile to rewrite with the current keys after every change')
+
+    parser.add_argument('--delete-orphans',
+                        dest='delete_orphans',
+                        action='store_true',
+                        help='Delete keys from the destination prefix when they are removed from the source')
+
+    parser.add_argument('--wait',
+                        default=WATCH_WAIT,
+                        help='How long each blocking query waits for a change, Ex: 30s or 5m')
+
+    return parser.parse_args()
+
+
+def apply_to_prefix(event, dest_prefix, delete_orphans=False, resync=False):
+    """
+    Copy the changes from a WatchEvent to dest_prefix.
+    The first event (or any after a failed write) is diffed against the destination, later ones only write their changes
+    Returns the number of writes that failed
+    """
+    conn = get_connection()
+    # Keys are read back without the trailing separator, Ex: dev/app/ is dev/app
+    dest_prefix = dest_prefix.strip(CONSUL_SEP)
+    moved = partial(new_prefix, prefix=dest_prefix)
+    if event.initial or resync:
+        results = sync_consul(item_action(event.store, [moved]), dest_prefix, conn, delete_orphans)
+    else:
+        diff = ItemDiff(added=list(map(moved, event.diff.added)),
+                        changed=list(map(moved, event.diff.changed)),
+                        removed=list(map(moved, event.diff.removed)))
+        results = apply_consul_diff(diff, conn, delete_orphans)
+    failed = [x for x in operate(results) if x.invalid]
+    for res in failed:
+        logging.error('Failed to write {}: {}'.format(res.invalid, res.exception))
+    return len(failed)
+
+def apply_to_keyfile(event, destination):
+    """
+    Rewrite the keyfile with every key currently under the watched prefix.
+    The new file is written next to the old one and moved into place, so readers never see a partial file
+    """
+    items = sorted(map(drop_prefix, event.store), key=lambda x: x.key)
+    result = serialize_keyfile(items)
+    for s_item in result.invalid:
+        logging.warning('Skipping {}, it is not a valid keyfile key'.format(s_item.key))
+    directory = os.path.dirname(os.path.abspath(destination))
+    with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        f.write(result.output + '\n')
+    os.replace(f.name, destination)
+    return 0
+
+
+def main():
+    args = get_cli_opts()
+    if args.delete_orphans and not args.destination_prefix:
+        raise ValueError('--destination-prefix is required for --delete-orphans')
+
+    resync = False
+    for event in watch_consul_prefix(Item(prefix=args.source_prefix), wait=args.wait):
+        counts = event.diff.counts()
+        logging.info('{} changed at index {}: {} added, {} changed, {} removed'.format(
+            args.source_prefix, event.index, counts['added'], counts['changed'], counts['removed']))
+        if args.destination_prefix:
+            failed = apply_to_prefix(event, args.destination_prefix, args.delete_orphans, resync)
+        else:
+            failed = apply_to_keyfile(event, args.keyfile)
+        # If anything failed to write, diff the whole prefix against the destination on the next change
+        resync = failed > 0
+
+if __name__ == '__main__':
+    main()